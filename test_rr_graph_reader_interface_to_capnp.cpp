@@ -12,10 +12,12 @@ int main(int argc, char * argv[]) {
 		throw std::runtime_error("No file argument provided");
 	}
 
-	::capnp::MallocMessageBuilder builder;
+	std::ifstream is(argv[1], std::ios::binary | std::ios::ate);
+	::capnp::MallocMessageBuilder builder(uxsd::CapnpRrGraph::first_segment_words(is.tellg()));
+	is.seekg(0);
 	auto graph = builder.initRoot<ucap::RrGraph>();
 	uxsd::CapnpRrGraph test;
-	load_rr_graph_xml(test, graph, argv[1]);
+	load_rr_graph_xml(test, graph, argv[1], is);
 
 	try {
 		auto fs = kj::newDiskFilesystem();
@@ -0,0 +1,88 @@
+#include <assert.h>
+#include <sys/stat.h>
+#include <chrono>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include "compact_bench_uxsdcxx.h"
+#include "compact_bench_uxsdcxx_model.h"
+#include "compact_bench_uxsdcxx_capnp.h"
+
+/* Benchmark of the encodings of write_netlist_capnp_file: the size of the
+ * file, and the time to write it and to load it again.
+ * Usage: ./capnp_encoding_bench.test [number of cells] */
+
+/* A netlist in which most attributes have their default values, so its
+ * Cap'n Proto message has many zero bytes. */
+static std::string make_netlist(size_t num_cells){
+	std::ostringstream os;
+	os << "<netlist>\n";
+	for(size_t i=0; i<num_cells; i++){
+		os << "<cell name=\"c" << i << "\" library=\"" << (i % 10 ? "std" : "io") << "\" delay=\"" << (i % 4 ? 0 : 0.25) << "\">\n";
+		os << "<pin name=\"a\" dir=\"in\" width=\"1\"/>\n";
+		os << "<pin name=\"b\" dir=\"in\" width=\"" << (i % 8 ? 1 : 8) << "\"/>\n";
+		os << "<pin name=\"y\" dir=\"out\" width=\"1\"/>\n";
+		os << "</cell>\n";
+	}
+	os << "</netlist>\n";
+	return os.str();
+}
+
+static std::string to_xml(uxsd::ModelNetlist &model, uxsd::t_netlist *root){
+	std::ostringstream os;
+	uxsd::write_netlist_xml(model, root, os);
+	return os.str();
+}
+
+/* Best of three runs of fn, in milliseconds. */
+template<typename F>
+static double best_ms(F fn){
+	double best = 1e30;
+	for(int i=0; i<3; i++){
+		auto start = std::chrono::steady_clock::now();
+		fn();
+		best = std::min(best, std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count());
+	}
+	return best;
+}
+
+int main(int argc, char **argv){
+	size_t num_cells = argc > 1 ? std::stoul(argv[1]) : 200000;
+	uxsd::ModelNetlist model;
+	auto root = model.root();
+	{
+		std::istringstream is(make_netlist(num_cells));
+		uxsd::load_netlist_xml(model, root, "bench", is);
+	}
+	std::string xml = to_xml(model, root);
+
+	const char *names[] = {"flat  ", "packed", "zstd  "};
+	double flat_size = 0, flat_load_ms = 0;
+	for(auto encoding : {uxsd::CapnpEncoding::FLAT, uxsd::CapnpEncoding::PACKED, uxsd::CapnpEncoding::ZSTD}){
+		std::string filename = "capnp_encoding_bench.bin";
+		double write_ms = best_ms([&]{
+			uxsd::write_netlist_capnp_file(model, root, filename.c_str(), encoding);
+		});
+		struct stat st;
+		stat(filename.c_str(), &st);
+		double load_ms = best_ms([&]{
+			uxsd::ModelNetlist reloaded;
+			auto reloaded_root = reloaded.root();
+			uxsd::load_netlist_capnp_file(reloaded, filename.c_str(), reloaded_root);
+		});
+
+		/* The content must survive the round trip. */
+		uxsd::ModelNetlist reloaded;
+		auto reloaded_root = reloaded.root();
+		uxsd::load_netlist_capnp_file(reloaded, filename.c_str(), reloaded_root);
+		assert(to_xml(reloaded, reloaded_root) == xml);
+
+		if(encoding == uxsd::CapnpEncoding::FLAT){
+			flat_size = st.st_size;
+			flat_load_ms = load_ms;
+		}
+		std::cout << names[(int)encoding] << ": " << st.st_size << " bytes (" << 100.0 * st.st_size / flat_size << "%), write "
+				<< write_ms << " ms, load " << load_ms << " ms (" << 100.0 * load_ms / flat_load_ms << "%)" << std::endl;
+	}
+	return 0;
+}
@@ -0,0 +1,173 @@
+#include <assert.h>
+#include <chrono>
+#include <deque>
+#include <iostream>
+#include <iterator>
+#include <sstream>
+#include <string>
+#include <thread>
+#include <vector>
+#include "compact_bench_uxsdcxx.h"
+#include "compact_bench_uxsdcxx_model.h"
+#include "compact_bench_uxsdcxx_capnp.h"
+
+/* Benchmark of parallel loads with load_netlist_capnp_file: the time to load
+ * a netlist on 1, 2, 4... threads, up to one per core or max threads.
+ * Usage: ./capnp_parallel_bench.test [number of cells] [max threads] [range size] */
+
+struct Pin {
+	std::string name;
+	uxsd::enum_pin_dir dir;
+	unsigned int width;
+};
+
+struct Cell {
+	std::string name;
+	std::string library;
+	float delay;
+	std::vector<Pin> pins;
+};
+
+struct Netlist {
+	std::vector<Cell> cells;
+};
+
+struct VectorNetlistContextTypes : public uxsd::DefaultNetlistContextTypes {
+	using PinReadContext = Pin *;
+	using CellReadContext = Cell *;
+	using NetlistReadContext = Netlist *;
+	using PinWriteContext = Pin *;
+	using CellWriteContext = Cell *;
+	using NetlistWriteContext = Netlist *;
+};
+
+/* An implementation of NetlistBase over vectors, which can load its cells in
+ * parallel. Every range of cells is loaded into a Netlist of its own, and
+ * merge_range_netlist_cell moves them into the document in order. */
+class VectorNetlist : public uxsd::NetlistBase<VectorNetlistContextTypes> {
+public:
+	void start_load(const std::function<void(const char *)> *) override {}
+	void finish_load() override { ranges_.clear(); }
+	void start_write() override {}
+	void finish_write() override {}
+	void error_encountered(const char *file, int line, const char *message) override {
+		throw std::runtime_error(std::string(message) + " occured at file: " + file + " line: " + std::to_string(line));
+	}
+
+	uxsd::enum_pin_dir get_pin_dir(Pin *&ctx) override { return ctx->dir; }
+	void set_pin_dir(uxsd::enum_pin_dir dir, Pin *&ctx) override { ctx->dir = dir; }
+	const char *get_pin_name(Pin *&ctx) override { return ctx->name.c_str(); }
+	void set_pin_name(const char *name, Pin *&ctx) override { ctx->name = name; }
+	unsigned int get_pin_width(Pin *&ctx) override { return ctx->width; }
+	void set_pin_width(unsigned int width, Pin *&ctx) override { ctx->width = width; }
+
+	float get_cell_delay(Cell *&ctx) override { return ctx->delay; }
+	void set_cell_delay(float delay, Cell *&ctx) override { ctx->delay = delay; }
+	const char *get_cell_library(Cell *&ctx) override { return ctx->library.c_str(); }
+	void set_cell_library(const char *library, Cell *&ctx) override { ctx->library = library; }
+	const char *get_cell_name(Cell *&ctx) override { return ctx->name.c_str(); }
+	void set_cell_name(const char *name, Cell *&ctx) override { ctx->name = name; }
+	void preallocate_cell_pin(Cell *&ctx, size_t size) override { ctx->pins.reserve(size); }
+	Pin *add_cell_pin(Cell *&ctx) override {
+		ctx->pins.emplace_back();
+		return &ctx->pins.back();
+	}
+	void finish_cell_pin(Pin *&) override {}
+	size_t num_cell_pin(Cell *&ctx) override { return ctx->pins.size(); }
+	Pin *get_cell_pin(int n, Cell *&ctx) override { return &ctx->pins[n]; }
+
+	void preallocate_netlist_cell(Netlist *&ctx, size_t size) override { ctx->cells.reserve(size); }
+	Cell *add_netlist_cell(Netlist *&ctx) override {
+		ctx->cells.emplace_back();
+		return &ctx->cells.back();
+	}
+	void finish_netlist_cell(Cell *&) override {}
+	size_t num_netlist_cell(Netlist *&ctx) override { return ctx->cells.size(); }
+	Cell *get_netlist_cell(int n, Netlist *&ctx) override { return &ctx->cells[n]; }
+
+	/* Called on the loading thread, so ranges_ needs no lock. */
+	Netlist *start_range_netlist_cell(Netlist *&, size_t begin, size_t end) override {
+		ranges_.emplace_back();
+		ranges_.back().cells.reserve(end - begin);
+		return &ranges_.back();
+	}
+	void merge_range_netlist_cell(Netlist *&ctx, Netlist *&range_ctx, size_t, size_t) override {
+		std::move(range_ctx->cells.begin(), range_ctx->cells.end(), std::back_inserter(ctx->cells));
+		std::vector<Cell>().swap(range_ctx->cells);
+	}
+
+private:
+	std::deque<Netlist> ranges_;
+};
+
+static std::string make_netlist(size_t num_cells){
+	std::ostringstream os;
+	os << "<netlist>\n";
+	for(size_t i=0; i<num_cells; i++){
+		os << "<cell name=\"c" << i << "\" library=\"" << (i % 10 ? "std" : "io") << "\" delay=\"" << (i % 4 ? 0 : 0.25) << "\">\n";
+		os << "<pin name=\"a\" dir=\"in\" width=\"1\"/>\n";
+		os << "<pin name=\"b\" dir=\"in\" width=\"" << (i % 8 ? 1 : 8) << "\"/>\n";
+		os << "<pin name=\"y\" dir=\"out\" width=\"1\"/>\n";
+		os << "</cell>\n";
+	}
+	os << "</netlist>\n";
+	return os.str();
+}
+
+template<typename T, typename C>
+static std::string to_xml(T &impl, C root){
+	std::ostringstream os;
+	uxsd::write_netlist_xml(impl, root, os);
+	return os.str();
+}
+
+/* Best of three runs of fn, in milliseconds. */
+template<typename F>
+static double best_ms(F fn){
+	double best = 1e30;
+	for(int i=0; i<3; i++){
+		auto start = std::chrono::steady_clock::now();
+		fn();
+		best = std::min(best, std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count());
+	}
+	return best;
+}
+
+int main(int argc, char **argv){
+	size_t num_cells = argc > 1 ? std::stoul(argv[1]) : 1000000;
+	size_t max_threads = argc > 2 ? std::stoul(argv[2]) : std::max(1u, std::thread::hardware_concurrency());
+	size_t range_size = argc > 3 ? std::stoul(argv[3]) : uxsd::CapnpLoadOptions().range_size;
+	uxsd::ModelNetlist model;
+	auto root = model.root();
+	{
+		std::istringstream is(make_netlist(num_cells));
+		uxsd::load_netlist_xml(model, root, "bench", is);
+	}
+	std::string xml = to_xml(model, root);
+	const char *filename = "capnp_parallel_bench.bin";
+	uxsd::write_netlist_capnp_file(model, root, filename);
+
+	double serial_ms = 0;
+	for(size_t num_threads = 1; num_threads <= max_threads; num_threads *= 2){
+		uxsd::CapnpLoadOptions options;
+		options.num_threads = num_threads;
+		options.range_size = range_size;
+		double load_ms = best_ms([&]{
+			VectorNetlist impl;
+			Netlist netlist;
+			Netlist *context = &netlist;
+			uxsd::load_netlist_capnp_file(impl, filename, context, options);
+		});
+
+		/* The cells must be in the same order as in a serial load. */
+		VectorNetlist impl;
+		Netlist netlist;
+		Netlist *context = &netlist;
+		uxsd::load_netlist_capnp_file(impl, filename, context, options);
+		assert(to_xml(impl, context) == xml);
+
+		if(num_threads == 1) serial_ms = load_ms;
+		std::cout << num_threads << " threads: load " << load_ms << " ms (" << serial_ms / load_ms << "x)" << std::endl;
+	}
+	return 0;
+}
@@ -0,0 +1,84 @@
+#include <assert.h>
+#include <fcntl.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include <chrono>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include "compact_bench_uxsdcxx.h"
+#include "compact_bench_uxsdcxx_model.h"
+#include "compact_bench_uxsdcxx_capnp.h"
+
+/* Benchmark of write_netlist_capnp_stream against write_netlist_capnp_file: the
+ * time to write and to load a netlist. The stream never holds more than
+ * chunk size cells in a message.
+ * Usage: ./capnp_stream_bench.test [number of cells] [chunk size] */
+
+static std::string make_netlist(size_t num_cells){
+	std::ostringstream os;
+	os << "<netlist>\n";
+	for(size_t i=0; i<num_cells; i++){
+		os << "<cell name=\"c" << i << "\" library=\"" << (i % 10 ? "std" : "io") << "\" delay=\"" << (i % 4 ? 0 : 0.25) << "\">\n";
+		os << "<pin name=\"a\" dir=\"in\" width=\"1\"/>\n";
+		os << "<pin name=\"b\" dir=\"in\" width=\"" << (i % 8 ? 1 : 8) << "\"/>\n";
+		os << "<pin name=\"y\" dir=\"out\" width=\"1\"/>\n";
+		os << "</cell>\n";
+	}
+	os << "</netlist>\n";
+	return os.str();
+}
+
+static std::string to_xml(uxsd::ModelNetlist &model, uxsd::t_netlist *root){
+	std::ostringstream os;
+	uxsd::write_netlist_xml(model, root, os);
+	return os.str();
+}
+
+/* Runs fn once and prints its time. */
+template<typename F>
+static void measure(const char *what, F fn){
+	auto start = std::chrono::steady_clock::now();
+	fn();
+	double ms = std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+	std::cout << what << ": " << ms << " ms" << std::endl;
+}
+
+int main(int argc, char **argv){
+	size_t num_cells = argc > 1 ? std::stoul(argv[1]) : 1000000;
+	size_t chunk_size = argc > 2 ? std::stoul(argv[2]) : 65536;
+	uxsd::ModelNetlist model;
+	auto root = model.root();
+	{
+		std::istringstream is(make_netlist(num_cells));
+		uxsd::load_netlist_xml(model, root, "bench", is);
+	}
+	std::string xml = to_xml(model, root);
+	const char *stream_name = "capnp_stream_bench.stream";
+	const char *file_name = "capnp_stream_bench.bin";
+
+	measure("stream write", [&]{
+		int fd = open(stream_name, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+		uxsd::write_netlist_capnp_stream(model, root, fd, chunk_size);
+		close(fd);
+	});
+	uxsd::ModelNetlist streamed;
+	auto streamed_root = streamed.root();
+	measure("stream load ", [&]{
+		int fd = open(stream_name, O_RDONLY);
+		uxsd::load_netlist_capnp_stream(streamed, fd, streamed_root, stream_name);
+		close(fd);
+	});
+	assert(to_xml(streamed, streamed_root) == xml);
+
+	measure("file write  ", [&]{
+		uxsd::write_netlist_capnp_file(model, root, file_name);
+	});
+	uxsd::ModelNetlist loaded;
+	auto loaded_root = loaded.root();
+	measure("file load   ", [&]{
+		uxsd::load_netlist_capnp_file(loaded, file_name, loaded_root);
+	});
+	assert(to_xml(loaded, loaded_root) == xml);
+	return 0;
+}
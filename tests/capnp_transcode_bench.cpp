@@ -0,0 +1,80 @@
+#include <assert.h>
+#include <chrono>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include "compact_bench_uxsdcxx_transcode.h"
+
+/* Benchmark of the fused transcoders: the time to convert a netlist from XML
+ * to a Cap'n Proto message and back with transcode_netlist_*, and with
+ * CapnpNetlist driven by load_netlist_xml and write_netlist_xml.
+ * Usage: ./capnp_transcode_bench.test [number of cells] */
+
+static std::string make_netlist(size_t num_cells){
+	std::ostringstream os;
+	os << "<netlist>\n";
+	for(size_t i=0; i<num_cells; i++){
+		os << "<cell name=\"c" << i << "\" library=\"" << (i % 10 ? "std" : "io") << "\" delay=\"" << (i % 4 ? 0 : 0.25) << "\">\n";
+		os << "<pin name=\"a\" dir=\"in\" width=\"1\"/>\n";
+		os << "<pin name=\"b\" dir=\"in\" width=\"" << (i % 8 ? 1 : 8) << "\"/>\n";
+		os << "<pin name=\"y\" dir=\"out\" width=\"1\"/>\n";
+		os << "</cell>\n";
+	}
+	os << "</netlist>\n";
+	return os.str();
+}
+
+/* Best of three runs of fn, in milliseconds. */
+template<typename F>
+static double best_ms(F fn){
+	double best = 1e30;
+	for(int i=0; i<3; i++){
+		auto start = std::chrono::steady_clock::now();
+		fn();
+		best = std::min(best, std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count());
+	}
+	return best;
+}
+
+int main(int argc, char **argv){
+	size_t num_cells = argc > 1 ? std::stoul(argv[1]) : 200000;
+	std::string xml = make_netlist(num_cells);
+
+	/* Both build the same message, which is written back as the same XML. */
+	std::string interface_xml, fused_xml;
+	double interface_load_ms = best_ms([&]{
+		::capnp::MallocMessageBuilder builder(uxsd::CapnpNetlist::first_segment_words(xml.size()));
+		auto root = builder.initRoot<ucap::Netlist>();
+		uxsd::CapnpNetlist capnp;
+		std::istringstream is(xml);
+		uxsd::load_netlist_xml(capnp, root, "bench", is);
+	});
+	double fused_load_ms = best_ms([&]{
+		::capnp::MallocMessageBuilder builder(uxsd::CapnpNetlist::first_segment_words(xml.size()));
+		std::istringstream is(xml);
+		uxsd::transcode_netlist_xml_to_capnp(is, builder.initRoot<ucap::Netlist>(), "bench");
+	});
+
+	::capnp::MallocMessageBuilder builder(uxsd::CapnpNetlist::first_segment_words(xml.size()));
+	std::istringstream is(xml);
+	uxsd::transcode_netlist_xml_to_capnp(is, builder.initRoot<ucap::Netlist>(), "bench");
+	auto reader = builder.getRoot<ucap::Netlist>().asReader();
+	double interface_write_ms = best_ms([&]{
+		interface_xml.clear();
+		uxsd::CapnpNetlist capnp;
+		uxsd::XmlWriter w(interface_xml);
+		uxsd::write_netlist_xml(capnp, reader, w);
+	});
+	double fused_write_ms = best_ms([&]{
+		fused_xml.clear();
+		uxsd::XmlWriter w(fused_xml);
+		uxsd::transcode_netlist_capnp_to_xml(reader, w, "bench");
+	});
+	assert(fused_xml == interface_xml);
+
+	std::cout << "XML to Cap'n Proto: CapnpNetlist " << interface_load_ms << " ms, fused " << fused_load_ms
+			<< " ms (" << interface_load_ms / fused_load_ms << "x)" << std::endl;
+	std::cout << "Cap'n Proto to XML: CapnpNetlist " << interface_write_ms << " ms, fused " << fused_write_ms
+			<< " ms (" << interface_write_ms / fused_write_ms << "x)" << std::endl;
+	return 0;
+}
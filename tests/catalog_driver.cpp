@@ -1,67 +1,108 @@
-#include <fstream>
-#include <string>
-#include <limits>
-#include <assert.h>
 #include "catalog_uxsdcxx.h"
+#include "catalog_uxsdcxx_model.h"
+#include "xml_driver.h"
 
-int main(int argc, char **argv){
-	uxsd::catalog catalog0;
-	std::ifstream is;
-	is.open(argv[1]);
-	assert(catalog0.load(is));
-	is.close();
+/* A catalog of books with the given IDs, whose authors recommend the given IDREFs. */
+static std::string make_catalog(std::initializer_list<std::pair<const char *, const char *>> books){
+	std::ostringstream os;
+	os << "<catalog>\n";
+	for(auto &book : books){
+		os << "<book id=\"" << book.first << "\" available=\"1\"><isbn>1</isbn><title>T</title><genre>fiction</genre>";
+		os << "<author recommends=\"" << book.second << "\"><name>N</name><born>B</born></author></book>\n";
+	}
+	os << "</catalog>\n";
+	return os.str();
+}
 
-	std::string of_name = std::string(argv[1]) + ".generated";
-	std::ofstream os;
-	os.open(of_name);
-	os.precision(std::numeric_limits<float>::max_digits10);
-	catalog0.write(os);
-	os.close();
+/* strict_ids reports duplicate IDs and dangling IDREFs. Otherwise, they're accepted. */
+template<typename Load>
+static void check_ids(Load load){
+	uxsd::XmlLoadOptions strict;
+	strict.strict_ids = true;
+	std::string valid = make_catalog({{"A", "B"}, {"B", "A"}});
+	std::string duplicate = make_catalog({{"A", "B"}, {"A", "A"}});
+	std::string dangling = make_catalog({{"A", "B"}, {"B", "C"}});
+	const char *filename = "catalog_ids.xml.generated";
+	assert(load_error<uxsd::ModelCatalog>(load, filename, valid, strict) == "");
+	assert(load_error<uxsd::ModelCatalog>(load, filename, duplicate, strict).find("Duplicate") != std::string::npos);
+	assert(load_error<uxsd::ModelCatalog>(load, filename, dangling, strict).find("Dangling") != std::string::npos);
+	assert(load_error<uxsd::ModelCatalog>(load, filename, duplicate, uxsd::XmlLoadOptions()) == "");
+	assert(load_error<uxsd::ModelCatalog>(load, filename, dangling, uxsd::XmlLoadOptions()) == "");
+}
 
-	/* Read back the generated file. */
-	uxsd::catalog catalog1;
-	is.open(of_name);
-	assert(catalog1.load(is));
-	is.close();
+/* Begin a book and set its ISBN, leaving out the ID if id is null. */
+static void push_book(uxsd::PushCatalog &push, const char *id){
+	push.begin_catalog_book(true);
+	if(id) push.set_book_id(id);
+	push.set_book_isbn(1);
+}
 
-	/* Compare the two memory representations. */
-	assert(catalog0.books.size() == catalog1.books.size());
-	for(int i=0; i<catalog0.books.size(); i++){
-		auto &book0 = catalog0.books[i];
-		auto &book1 = catalog1.books[i];
-		assert(book0.available == book1.available);
-		assert(strcmp(book0.id, book1.id) == 0);
-		assert(book0.isbn == book1.isbn);
-		assert(book0.genre == book1.genre);
-		if(book0.title.lang != NULL && book1.title.lang != NULL){
-			assert(strcmp(book0.title.lang, book1.title.lang) == 0);
-		}else{
-			assert(book0.title.lang == NULL);
-			assert(book1.title.lang == NULL);
-		}
-		assert(strcmp(book0.title.value, book1.title.value) == 0);
-		assert(book0.authors.size() == book1.authors.size());
-		for(int j=0; j<book0.authors.size(); j++){
-			auto &auth0 = book0.authors[j];
-			auto &auth1 = book1.authors[j];
-			if(auth0.recommends != NULL && auth1.recommends != NULL){
-				assert(strcmp(auth0.recommends, auth1.recommends) == 0);
-			}else{
-				assert(auth0.recommends == NULL);
-				assert(auth1.recommends == NULL);
-			}
-			assert(strcmp(auth0.name, auth1.name) == 0);
-			assert(strcmp(auth0.born, auth1.born) == 0);
-			assert(auth0.has_died == auth1.has_died);
-			if(auth0.has_died){
-				assert(strcmp(auth0.died, auth1.died) == 0);
-			}
-		}
+/* PushCatalog writes what write_catalog_xml writes for the same document, and
+ * rejects calls which don't follow the schema. */
+template<typename Load, typename Write>
+static void check_push(Load load, Write write){
+	std::ostringstream pushed;
+	{
+		uxsd::XmlWriter w(pushed);
+		uxsd::PushCatalog push(w);
+		push.begin_catalog();
+		push_book(push, "A");
+		push.begin_book_title();
+		push.set_title_value("T");
+		push.end_book_title();
+		push.set_book_genre(uxsd::enum_genre::FICTION);
+		push.begin_book_author();
+		push.set_author_recommends("A");
+		push.set_author_name("N");
+		push.set_author_born("B");
+		push.end_book_author();
+		push.end_catalog_book();
+		push.end_catalog();
 	}
+	uxsd::ModelCatalog model;
+	auto root = model.root();
+	std::istringstream is(make_catalog({{"A", "A"}}));
+	load(model, root, "text", is);
+	std::ostringstream written;
+	write(model, root, written);
+	assert(pushed.str() == written.str());
+
+	std::ostringstream os;
+	uxsd::XmlWriter w(os);
+	/* The title before the ISBN. */
+	assert(error_of([&]{
+		uxsd::PushCatalog push(w);
+		push.begin_catalog();
+		push.begin_catalog_book(true);
+		push.set_book_id("A");
+		push.begin_book_title();
+	}).find("Expected isbn, found title") != std::string::npos);
+	/* An author's recommendation after its name. */
+	assert(error_of([&]{
+		uxsd::PushCatalog push(w);
+		push.begin_catalog();
+		push_book(push, "A");
+		push.begin_book_title();
+		push.set_title_value("T");
+		push.end_book_title();
+		push.set_book_genre(uxsd::enum_genre::FICTION);
+		push.begin_book_author();
+		push.set_author_name("N");
+		push.set_author_recommends("A");
+	}).find("set_author_recommends") != std::string::npos);
+	/* No ID. */
+	assert(error_of([&]{
+		uxsd::PushCatalog push(w);
+		push.begin_catalog();
+		push_book(push, nullptr);
+	}).find("required attributes id") != std::string::npos);
+}
 
-	std::string of_name_2 = of_name + ".2";
-	os.open(of_name_2);
-	os.precision(std::numeric_limits<float>::max_digits10);
-	catalog1.write(os);
-	os.close();
+int main(int argc, char **argv){
+	auto load = [](auto &&... args){ return uxsd::load_catalog_xml(args...); };
+	auto write = [](auto &&... args){ return uxsd::write_catalog_xml(args...); };
+	auto load_cached = [](auto &&... args){ return uxsd::load_catalog_cached(args...); };
+	check_ids(load);
+	check_push(load, write);
+	return run_xml_tests<uxsd::ModelCatalog, uxsd::DomCatalog>(argc, argv, load, write, load_cached);
 }
@@ -0,0 +1,78 @@
+#include <assert.h>
+#include <chrono>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include "compact_bench_uxsdcxx.h"
+#include "compact_bench_uxsdcxx_model.h"
+
+/* Benchmark of the output profiles of write_netlist_xml: the size of the
+ * output and the time to load it again.
+ * Usage: ./compact_bench.test [number of cells] */
+
+/* A netlist in which most attributes have their default values. */
+static std::string make_netlist(size_t num_cells){
+	std::ostringstream os;
+	os << "<netlist>\n";
+	for(size_t i=0; i<num_cells; i++){
+		os << "<cell name=\"c" << i << "\" library=\"" << (i % 10 ? "std" : "io") << "\" delay=\"" << (i % 4 ? 0 : 0.25) << "\">\n";
+		os << "<pin name=\"a\" dir=\"in\" width=\"1\"/>\n";
+		os << "<pin name=\"b\" dir=\"in\" width=\"" << (i % 8 ? 1 : 8) << "\"/>\n";
+		os << "<pin name=\"y\" dir=\"out\" width=\"1\"/>\n";
+		os << "</cell>\n";
+	}
+	os << "</netlist>\n";
+	return os.str();
+}
+
+static std::string write(uxsd::ModelNetlist &model, uxsd::t_netlist *root, uxsd::XmlWriteProfile profile){
+	uxsd::XmlWriteOptions options;
+	options.profile = profile;
+	std::ostringstream os;
+	uxsd::write_netlist_xml(model, root, os, options);
+	return os.str();
+}
+
+/* Best of three loads of text into a new model, in milliseconds. */
+static double load_ms(const std::string &text){
+	double best = 1e30;
+	for(int i=0; i<3; i++){
+		uxsd::ModelNetlist model;
+		auto root = model.root();
+		std::istringstream is(text);
+		auto start = std::chrono::steady_clock::now();
+		uxsd::load_netlist_xml(model, root, "bench", is);
+		best = std::min(best, std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count());
+	}
+	return best;
+}
+
+int main(int argc, char **argv){
+	size_t num_cells = argc > 1 ? std::stoul(argv[1]) : 200000;
+	uxsd::ModelNetlist model;
+	auto root = model.root();
+	{
+		std::istringstream is(make_netlist(num_cells));
+		uxsd::load_netlist_xml(model, root, "bench", is);
+	}
+
+	std::string pretty = write(model, root, uxsd::XmlWriteProfile::PRETTY);
+	double pretty_ms = load_ms(pretty);
+	std::cout << "pretty   : " << pretty.size() << " bytes, load " << pretty_ms << " ms" << std::endl;
+	for(auto profile : {uxsd::XmlWriteProfile::COMPACT, uxsd::XmlWriteProfile::CANONICAL}){
+		std::string text = write(model, root, profile);
+		double ms = load_ms(text);
+
+		/* The content must survive the round trip. */
+		uxsd::ModelNetlist reloaded;
+		auto reloaded_root = reloaded.root();
+		std::istringstream is(text);
+		uxsd::load_netlist_xml(reloaded, reloaded_root, "bench", is);
+		assert(write(reloaded, reloaded_root, uxsd::XmlWriteProfile::PRETTY) == pretty);
+
+		std::cout << (profile == uxsd::XmlWriteProfile::COMPACT ? "compact  : " : "canonical: ")
+				<< text.size() << " bytes (" << 100.0 * text.size() / pretty.size() << "%), load "
+				<< ms << " ms (" << 100.0 * ms / pretty_ms << "%)" << std::endl;
+	}
+	return 0;
+}
@@ -0,0 +1,32 @@
+#include "defaults_uxsdcxx.h"
+#include "defaults_uxsdcxx_model.h"
+#include "xml_driver.h"
+
+/* The first item has no attributes and the second one sets them to their
+ * defaults, so PRETTY writes both with the defaults and COMPACT leaves them out. */
+static void check_defaults(const char *filename){
+	uxsd::ModelDefaults model;
+	auto root = model.root();
+	std::ifstream is(filename);
+	uxsd::load_defaults_xml(model, root, filename, is);
+
+	const char *item = "<item accent=\"caf\303\251\" backslash=\"a\\b\" newline=\"one&#xA;two\" quote=\"say &quot;hi&quot;\" trigraph=\"?\?/\"/>\n";
+	const char *other = "<item accent=\"cafe\" backslash=\"a\" newline=\"one\" quote=\"say\" trigraph=\"??\"/>";
+	std::ostringstream pretty;
+	uxsd::write_defaults_xml(model, root, pretty);
+	assert(pretty.str() == std::string("<defaults>\n") + item + item + other + "\n</defaults>\n");
+
+	uxsd::XmlWriteOptions options;
+	options.profile = uxsd::XmlWriteProfile::COMPACT;
+	std::ostringstream compact;
+	uxsd::write_defaults_xml(model, root, compact, options);
+	assert(compact.str() == std::string("<defaults><item/><item/>") + other + "</defaults>");
+}
+
+int main(int argc, char **argv){
+	auto load = [](auto &&... args){ return uxsd::load_defaults_xml(args...); };
+	auto write = [](auto &&... args){ return uxsd::write_defaults_xml(args...); };
+	auto load_cached = [](auto &&... args){ return uxsd::load_defaults_cached(args...); };
+	check_defaults(argv[1]);
+	return run_xml_tests<uxsd::ModelDefaults, uxsd::DomDefaults>(argc, argv, load, write, load_cached);
+}
@@ -0,0 +1,92 @@
+#include <assert.h>
+#include <fcntl.h>
+#include <chrono>
+#include <iostream>
+#include <random>
+#include <sstream>
+#include <string>
+#include <vector>
+#include "catalog_uxsdcxx.h"
+
+/* Benchmark of XmlWriter's escaping against a naive byte loop.
+ * Usage: ./escape_bench.test [total MiB] */
+
+static void naive_escape(uxsd::XmlWriter &w, const char *x, bool attribute){
+	for(; *x; x++){
+		switch(*x){
+		case '&': w.put("&amp;"); break;
+		case '<': w.put("&lt;"); break;
+		case '\r': w.put("&#xD;"); break;
+		case '>': if(attribute) w.put(x, 1); else w.put("&gt;"); break;
+		case '"': if(attribute) w.put("&quot;"); else w.put(x, 1); break;
+		case '\t': if(attribute) w.put("&#x9;"); else w.put(x, 1); break;
+		case '\n': if(attribute) w.put("&#xA;"); else w.put(x, 1); break;
+		default: w.put(x, 1);
+		}
+	}
+}
+
+/* Strings of mostly clean text, with a special character once in every
+ * `clean` bytes on average. */
+static std::vector<std::string> make_strings(size_t total, size_t clean){
+	const char specials[] = "&<>\"\t\n\r";
+	std::mt19937 rng(1);
+	std::vector<std::string> out;
+	size_t n = 0;
+	while(n < total){
+		size_t len = 1 + rng() % 200;
+		std::string s;
+		for(size_t i=0; i<len; i++){
+			if(clean > 0 && rng() % clean == 0) s += specials[rng() % 7];
+			else s += 'a' + rng() % 26;
+		}
+		n += len;
+		out.push_back(std::move(s));
+	}
+	return out;
+}
+
+template<typename F>
+static double time_ms(F fn){
+	auto start = std::chrono::steady_clock::now();
+	fn();
+	return std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+}
+
+int main(int argc, char **argv){
+	size_t total = (argc > 1 ? std::stoul(argv[1]) : 64) << 20;
+	for(size_t clean : {0, 1000, 50, 8}){
+		std::vector<std::string> strings = make_strings(total, clean);
+		for(bool attribute : {false, true}){
+			std::ostringstream naive, escaped;
+			{
+				uxsd::XmlWriter naive_w(naive), escaped_w(escaped);
+				for(const std::string &s : strings){
+					naive_escape(naive_w, s.c_str(), attribute);
+					if(attribute) escaped_w.attribute(s.c_str());
+					else escaped_w.value(s.c_str());
+				}
+			}
+			assert(naive.str() == escaped.str());
+
+			/* Time both against /dev/null, so only the escaping differs. */
+			int fd = open("/dev/null", O_WRONLY);
+			double naive_ms = time_ms([&]{
+				uxsd::XmlWriter w(fd);
+				for(const std::string &s : strings) naive_escape(w, s.c_str(), attribute);
+			});
+			double writer_ms = time_ms([&]{
+				uxsd::XmlWriter w(fd);
+				for(const std::string &s : strings){
+					if(attribute) w.attribute(s.c_str());
+					else w.value(s.c_str());
+				}
+			});
+			close(fd);
+
+			std::cout << (attribute ? "attribute" : "text     ") << (clean ? " 1/" + std::to_string(clean) : " clean") << ": "
+					<< "naive " << naive_ms << " ms, XmlWriter " << writer_ms << " ms" << std::endl;
+		}
+	}
+	return 0;
+}
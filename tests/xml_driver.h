@@ -0,0 +1,152 @@
+#pragma once
+#include <assert.h>
+#include <cstdio>
+#include <fstream>
+#include <sstream>
+#include <string>
+
+/* Checks shared by the *_driver.cpp tests, whose headers are generated with
+ * --all-features. Model is the generated ModelFoo and Dom is DomFoo. load, write
+ * and load_cached call load_foo_xml, write_foo_xml and load_foo_cached with their
+ * arguments, so that one lambda covers all of their overloads:
+ *
+ *     auto load = [](auto &&... args){ return uxsd::load_foo_xml(args...); };
+ */
+
+/* Load in_name into a model and write it to out_name. */
+template<typename Model, typename Load, typename Write>
+void round_trip(Load load, Write write, const std::string &in_name, const std::string &out_name){
+	Model model;
+	auto root = model.root();
+	std::ifstream is(in_name);
+	load(model, root, in_name.c_str(), is);
+	std::ofstream os(out_name);
+	write(model, root, os);
+}
+
+/* Load filename into a new model with options, and write it in the pretty profile. */
+template<typename Model, typename Load, typename Write>
+std::string load_and_write(Load load, Write write, const char *filename, const uxsd::XmlLoadOptions &options){
+	Model model;
+	auto root = model.root();
+	std::ifstream is(filename);
+	load(model, root, filename, is, options);
+	std::ostringstream os;
+	write(model, root, os);
+	return os.str();
+}
+
+/* Return the message of the std::runtime_error which fn throws, or an empty
+ * string if it doesn't throw. */
+template<typename Fn>
+std::string error_of(Fn fn){
+	try {
+		fn();
+	} catch(const std::runtime_error &ex) {
+		return ex.what();
+	}
+	return "";
+}
+
+/* Write text to filename, load it into a new model and return the error which
+ * the load reported, if any. ModelFoo reports errors by throwing. */
+template<typename Model, typename Load>
+std::string load_error(Load load, const std::string &filename, const std::string &text, const uxsd::XmlLoadOptions &options){
+	std::ofstream(filename) << text;
+	return error_of([&]{
+		Model model;
+		auto root = model.root();
+		std::ifstream is(filename);
+		load(model, root, filename.c_str(), is, options);
+	});
+}
+
+/* Writing filename on several threads gives the same bytes as a serial write,
+ * in every profile. */
+template<typename Model, typename Load, typename Write>
+void check_parallel_write(Load load, Write write, const char *filename){
+	Model model;
+	auto root = model.root();
+	std::ifstream is(filename);
+	load(model, root, filename, is);
+	for(auto profile : {uxsd::XmlWriteProfile::PRETTY, uxsd::XmlWriteProfile::COMPACT, uxsd::XmlWriteProfile::CANONICAL}){
+		uxsd::XmlWriteOptions options;
+		options.profile = profile;
+		std::ostringstream serial;
+		write(model, root, serial, options);
+		options.num_threads = 4;
+		options.range_size = 1;
+		std::ostringstream parallel;
+		write(model, root, parallel, options);
+		assert(serial.str() == parallel.str());
+	}
+}
+
+/* Loads with hash-consing and from a reused arena give the same document as a
+ * plain load. */
+template<typename Model, typename Load, typename Write>
+void check_load_options(Load load, Write write, const char *filename, const std::string &expected){
+	uxsd::XmlLoadOptions options;
+	options.hash_cons = true;
+	assert((load_and_write<Model>(load, write, filename, options) == expected));
+
+	uxsd::XmlArena arena;
+	uxsd::XmlLoadOptions arena_options;
+	arena_options.arena = &arena;
+	for(int i = 0; i < 2; i++)
+		assert((load_and_write<Model>(load, write, filename, arena_options) == expected));
+}
+
+/* load_foo_cached misses and writes the snapshot the first time, and hits it the
+ * second time. Both give the same document as a plain load. */
+template<typename Model, typename LoadCached, typename Write>
+void check_cached(LoadCached load_cached, Write write, const char *filename, const std::string &expected){
+	std::remove((std::string(filename) + ".uxsdcache").c_str());
+	for(bool hit : {false, true}){
+		Model model;
+		auto root = model.root();
+		assert(load_cached(model, root, filename) == hit);
+		std::ostringstream os;
+		write(model, root, os);
+		assert(os.str() == expected);
+	}
+}
+
+/* DomFoo writes a parsed document as ModelFoo does, and a load through it
+ * builds the same document. */
+template<typename Dom, typename Load, typename Write>
+void check_dom(Load load, Write write, const char *filename, const std::string &expected){
+	pugi::xml_document doc;
+	assert(doc.load_file(filename));
+	pugi::xml_node root = doc.document_element();
+	Dom dom;
+	std::ostringstream os;
+	write(dom, root, os);
+	assert(os.str() == expected);
+
+	pugi::xml_document loaded;
+	pugi::xml_node loaded_root = loaded.append_child(root.name());
+	std::ifstream is(filename);
+	load(dom, loaded_root, filename, is);
+	std::ostringstream loaded_os;
+	write(dom, loaded_root, loaded_os);
+	assert(loaded_os.str() == expected);
+}
+
+/* Run the checks on the document argv[1]. It's written to argv[1].generated,
+ * which is read back and written to argv[1].generated.2. The Makefile checks
+ * that both are the same. */
+template<typename Model, typename Dom, typename Load, typename Write, typename LoadCached>
+int run_xml_tests(int argc, char **argv, Load load, Write write, LoadCached load_cached){
+	assert(argc == 2);
+	std::string of_name = std::string(argv[1]) + ".generated";
+	round_trip<Model>(load, write, argv[1], of_name);
+	round_trip<Model>(load, write, of_name, of_name + ".2");
+
+	std::string expected = load_and_write<Model>(load, write, argv[1], uxsd::XmlLoadOptions());
+	check_parallel_write<Model>(load, write, argv[1]);
+	check_load_options<Model>(load, write, argv[1], expected);
+	check_cached<Model>(load_cached, write, argv[1], expected);
+	check_dom<Dom>(load, write, argv[1], expected);
+	return 0;
+}
@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 import sys
 
 import xmlschema # type: ignore
-from uxsdcxx.capnp import render_capnp_file, render_header_file, render_impl_header_file
+from uxsdcxx.capnp import intern_strings, render_capnp_file, render_header_file, render_impl_header_file
 from uxsdcxx.schema import UxsdSchema
+from uxsdcxx.transcode import render_transcode_header_file, render_transcode_main_file
 
 def main():
-	input_file = os.path.abspath(sys.argv[1])
+	parser = argparse.ArgumentParser(description="Generate a Cap'n Proto schema and C++ converters from an XSD schema.")
+	parser.add_argument("schema", help="XSD schema to generate code for")
+	parser.add_argument("--intern-strings", nargs="?", const="", metavar="TYPE.FIELD,...",
+		help="store strings as indices into a table of the distinct strings of the document: "
+		"the given fields, such as edge.seg_name, or every string attribute and element if none are given")
+	args = parser.parse_args()
+	input_file = os.path.abspath(args.schema)
 	base = os.path.splitext(os.path.basename(input_file))[0]
 	capnp_file_name = base + "_uxsdcxx.capnp"
 	capnp_header_file_name = base + "_uxsdcxx_capnp.h"
 	capnp_header_impl_file_name = base + "_uxsdcxx_capnp_impl.h"
 	interface_file_name = base + "_uxsdcxx_interface.h"
+	header_file_name = base + "_uxsdcxx.h"
+	transcode_header_file_name = base + "_uxsdcxx_transcode.h"
+	transcode_main_file_name = base + "_uxsdcxx_transcode.cpp"
 	cmdline = " ".join(sys.argv)
 	schema = UxsdSchema(xmlschema.XMLSchema(input_file))
+	if args.intern_strings is not None:
+		try:
+			intern_strings(schema, args.intern_strings.split(",") if args.intern_strings else None)
+		except ValueError as e:
+			parser.error(str(e))
+
 	with open(capnp_file_name, "w") as capnp_file:
 		capnp_file.write(render_capnp_file(schema, cmdline, input_file))
 
@@ -25,5 +42,11 @@ def main():
 	with open(capnp_header_impl_file_name, "w") as header_impl_file:
 		header_impl_file.write(render_impl_header_file(schema, cmdline, capnp_file_name, interface_file_name, input_file))
 
+	with open(transcode_header_file_name, "w") as transcode_header_file:
+		transcode_header_file.write(render_transcode_header_file(schema, cmdline, header_file_name, capnp_header_file_name, capnp_header_impl_file_name, input_file))
+
+	with open(transcode_main_file_name, "w") as transcode_main_file:
+		transcode_main_file.write(render_transcode_main_file(schema, cmdline, transcode_header_file_name, input_file))
+
 if __name__ == "__main__":
 	main()
@@ -1,29 +1,44 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 import sys
 
 import xmlschema # type: ignore
-from uxsdcxx.cpp import render_interface_header_file, render_header_file, render_impl_file
+from uxsdcxx.cpp import FEATURES, render_interface_header_file, render_header_file, render_impl_file
+from uxsdcxx.model import render_model_header_file
 from uxsdcxx.schema import UxsdSchema
 
 def main() -> None:
-	input_file = os.path.abspath(sys.argv[1])
+	parser = argparse.ArgumentParser(description="Generate a C++ loader, validator and writer from an XSD schema.")
+	parser.add_argument("schema", help="XSD schema to generate code for")
+	parser.add_argument("--instrument", action="store_true",
+		help="count the calls and cycles of every load_*, lex_* and callback, and print a report after every load")
+	for feature, help in FEATURES.items():
+		parser.add_argument("--" + feature, dest="features", action="append_const", const=feature, default=[], help=help)
+	parser.add_argument("--all-features", action="store_true", help="generate all of the above")
+	args = parser.parse_args()
+	features = set(FEATURES) if args.all_features else set(args.features)
+	input_file = os.path.abspath(args.schema)
 	base = os.path.splitext(os.path.basename(input_file))[0]
 	interface_header_file_name = base + "_uxsdcxx_interface.h"
 	header_file_name = base + "_uxsdcxx.h"
 	impl_file_name = base + "_uxsdcxx.cpp"
+	model_header_file_name = base + "_uxsdcxx_model.h"
 	cmdline = " ".join(sys.argv)
 	schema = UxsdSchema(xmlschema.validators.XMLSchema10(input_file))
 	interface_header_file = open(interface_header_file_name, "w")
 	interface_header_file.write(render_interface_header_file(schema, cmdline, input_file))
 	interface_header_file.close()
 	header_file = open(header_file_name, "w")
-	header_file.write(render_header_file(schema, cmdline, input_file, interface_header_file_name))
+	header_file.write(render_header_file(schema, cmdline, input_file, interface_header_file_name, args.instrument, features))
 	header_file.close()
 	impl_file= open(impl_file_name, "w")
 	impl_file.write(render_impl_file(schema, cmdline, input_file, header_file_name))
 	impl_file.close()
+	model_header_file = open(model_header_file_name, "w")
+	model_header_file.write(render_model_header_file(schema, cmdline, input_file, interface_header_file_name))
+	model_header_file.close()
 
 if __name__ == "__main__":
 	main()
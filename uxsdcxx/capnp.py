@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 from random import getrandbits
 from . import cpp_templates, cpp
 
@@ -18,6 +18,8 @@ from uxsdcxx.schema import (
 	UxsdLeaf,
 	UxsdSimple,
 	UxsdString,
+	UxsdNumber,
+	UxsdId,
 )
 
 def gen_file_id() -> str:
@@ -36,14 +38,77 @@ def to_type(t: UxsdType) -> str:
 	else:
 		return utils.to_pascalcase(t.name)
 
-def complex_to_capnp(t: UxsdComplex) -> str:
+def _gen_default(attr: UxsdAttribute) -> str:
+	"""The default value of an attribute as a capnp literal."""
+	assert attr.default_value is not None
+	if isinstance(attr.type, UxsdEnum):
+		return utils.to_camelcase(attr.default_value)
+	elif isinstance(attr.type, UxsdString):
+		return "\"%s\"" % attr.default_value.replace("\\", "\\\\").replace("\"", "\\\"")
+	return attr.default_value
+
+def _can_intern(f: Union[UxsdAttribute, UxsdElement]) -> bool:
+	"""Strings which can be interned. IDs are unique, so they are left out."""
+	if isinstance(f, UxsdElement) and f.many:
+		return False
+	return isinstance(f.type, UxsdString) and not isinstance(f.type, UxsdId)
+
+def intern_strings(schema: UxsdSchema, names: Optional[List[str]] = None) -> None:
+	"""Store strings as indices into a table of the distinct strings of the
+	document, in a strings field of the root. names are type.field pairs, such as
+	edge.seg_name, and if they are None, every string attribute and non-repeated
+	string element is interned."""
+	fields: Dict[str, Union[UxsdAttribute, UxsdElement]] = {}
+	for t in schema.complex_types:
+		for attr in t.attrs:
+			fields["%s.%s" % (t.name, attr.name)] = attr
+		if isinstance(t.content, (UxsdDfa, UxsdAll)):
+			for el in t.content.children:
+				fields["%s.%s" % (t.name, el.name)] = el
+	root = schema.root_element.type
+	assert isinstance(root, UxsdComplex)
+	if any(utils.to_camelcase(f.name) == "strings" for f in _fields(root)):
+		raise ValueError("The root type %s has a field named strings already." % root.name)
+	if names is None:
+		for f in fields.values():
+			if _can_intern(f): f.interned = True
+		return
+	for name in names:
+		if name not in fields:
+			raise ValueError("There is no field %s. Fields are named type.field." % name)
+		if not _can_intern(fields[name]):
+			raise ValueError("%s isn't a string, or is an ID or a repeated element, so it can't be interned." % name)
+		fields[name].interned = True
+
+def _fields(t: UxsdComplex) -> List[Union[UxsdAttribute, UxsdElement]]:
+	out: List[Union[UxsdAttribute, UxsdElement]] = list(t.attrs)
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		out += t.content.children
+	return out
+
+def _uses_strings(t: UxsdComplex, visiting: Optional[Set[UxsdComplex]] = None) -> bool:
+	"""Whether t or a type below it has interned fields, so that its load and
+	write functions need the strings table."""
+	if visiting is None: visiting = set()
+	if t in visiting: return False
+	visiting.add(t)
+	for f in _fields(t):
+		if f.interned: return True
+		if isinstance(f.type, UxsdComplex) and _uses_strings(f.type, visiting): return True
+	return False
+
+def complex_to_capnp(t: UxsdComplex, strings: bool = False) -> str:
+	"""If strings is set, t is the root type and gets the strings table."""
 	fields = []
 	i = 0
 	for attr in t.attrs:
 		name = utils.to_camelcase(attr.name)
 		type = to_type(attr.type)
-		if attr.default_value is not None:
-			field = "\t%s @%d :%s = %s;" % (name, i,  type, attr.default_value)
+		if attr.interned:
+			# Index 0 is the empty string, so the default is left out.
+			field = "\t%s @%d :UInt32;" % (name, i)
+		elif attr.default_value is not None:
+			field = "\t%s @%d :%s = %s;" % (name, i,  type, _gen_default(attr))
 		else:
 			field = "\t%s @%d :%s;" % (name, i, type)
 		fields.append(field)
@@ -55,6 +120,9 @@ def complex_to_capnp(t: UxsdComplex) -> str:
 			if el.many:
 				field = "\t%s @%d :List(%s);" % (utils.pluralize(name), i, type)
 				i += 1
+			elif el.interned:
+				field = "\t%s @%d :UInt32;" % (name, i)
+				i += 1
 			else:
 				field = "\t%s @%d :%s;" % (name, i, type)
 				i += 1
@@ -62,6 +130,10 @@ def complex_to_capnp(t: UxsdComplex) -> str:
 	elif isinstance(t.content, UxsdLeaf):
 		field = "\tvalue @%d :%s;" % (i, to_type(t.content.type))
 		fields.append(field)
+		i += 1
+	if strings:
+		fields.append("\t# The interned strings. Index 0 is the empty string.")
+		fields.append("\tstrings @%d :List(Text);" % i)
 	out = "struct %s {\n" % to_type(t)
 	out += "\n".join(fields)
 	out += "\n}"
@@ -78,81 +150,95 @@ def enum_to_capnp(t: UxsdEnum) -> str:
 	return out
 
 def _gen_conv_enum(t: UxsdEnum) -> str:
+	"""The .capnp enum has uxsdInvalid and then the values in schema order, like
+	enum_foo, so the ordinals are the same and the conversions are casts."""
 	pname = utils.to_pascalcase(t.name)
 	out = ""
+	for e in ['UXSD_INVALID'] + [e.upper() for e in t.enumeration]:
+		out += "static_assert(static_cast<int>(ucap::{pname}::{e}) == static_cast<int>(enum_{name}::{e}), \"ucap::{pname} is out of date\");\n".format(
+				name=t.name,
+				pname=pname,
+				e=e)
 	out += "inline enum_{name} conv_enum_{name}(ucap::{pname} e, const std::function<void(const char *)> * report_error) {{\n".format(
 			name=t.name,
 			pname=pname)
-	out += "\tswitch(e) {\n"
-	out += "\tcase ucap::{pname}::{e}:\n".format(
-			pname=pname,
-			e='UXSD_INVALID')
-	out += "\t\treturn enum_{name}::{e};\n".format(
-			name=t.name,
-			e='UXSD_INVALID')
-	for e in t.enumeration:
-		out += "\tcase ucap::{pname}::{e}:\n".format(
-				pname=pname,
-				e=e.upper())
-		out += "\t\treturn enum_{name}::{e};\n".format(
-				name=t.name,
-				e=e.upper())
-	out += "\tdefault:\n"
+	out += "\tif(static_cast<uint16_t>(e) > {n}) {{\n".format(n=len(t.enumeration))
 	out += '\t\t(*report_error)("Unknown enum_{name}");\n'.format(name=t.name)
 	out += "\t\tthrow std::runtime_error(\"Unreachable!\");\n"
 	out += "\t}\n"
+	out += "\treturn static_cast<enum_{name}>(e);\n".format(name=t.name)
 	out += "}\n"
 	out += "\n"
 	out += "inline ucap::{pname} conv_to_enum_{name}(enum_{name} e) {{\n".format(
 			name=t.name,
 			pname=pname)
-	out += "\tswitch(e) {\n"
-	out += "\tcase enum_{name}::{e}:\n".format(
-			name=t.name,
-			e='UXSD_INVALID')
-	out += "\t\treturn ucap::{pname}::{e};\n".format(
-			pname=pname,
-			e='UXSD_INVALID')
-	for e in t.enumeration:
-		out += "\tcase enum_{name}::{e}:\n".format(
-				name=t.name,
-				e=e.upper())
-		out += "\t\treturn ucap::{pname}::{e};\n".format(
-				pname=pname,
-				e=e.upper())
-	out += "\tdefault:\n"
+	out += "\tif(static_cast<uint8_t>(e) > {n})\n".format(n=len(t.enumeration))
 	out += '\t\tthrow std::runtime_error("Unknown enum_{name}");\n'.format(name=t.name)
-	out += "\t}\n"
+	out += "\treturn static_cast<ucap::{pname}>(e);\n".format(pname=pname)
 	out += "}\n"
 
 	return out
 
-def _gen_required_attribute_arg_list(t: UxsdComplex, input: str) -> str:
+def _gen_enum_converters(schema: UxsdSchema) -> str:
+	"""The converters are in both the loader and the impl header, so they are
+	guarded to let a file include both."""
+	guard = "UXSD_%s_CAPNP_ENUM_CONVERSIONS" % schema.root_element.name.upper()
+	out = ""
+	out += "\n\n/* Enum conversions from uxsd to ucap */\n"
+	out += "#ifndef %s\n" % guard
+	out += "#define %s\n" % guard
+	out += "\n".join(_gen_conv_enum(t) for t in schema.enums)
+	out += "#endif\n"
+	return out
+
+def _gen_required_attribute_arg_list(t: UxsdComplex, input: str, report_error: str = "state->report_error", strings: str = "state->strings->") -> str:
 	required_attrs = []
 
 	for attr in sorted(t.type.attrs, key=lambda attr: attr.name):
 		if cpp.pass_at_init(attr):
-			required_attrs.append(_gen_load_simple(
-				attr.type,
+			required_attrs.append(_gen_load_field(
+				attr,
 				input='{input}.get{pname}()'.format(
 					input=input,
-					pname=utils.to_pascalcase(attr.name))))
+					pname=utils.to_pascalcase(attr.name)),
+				report_error=report_error,
+				strings=strings))
 
 	if len(required_attrs) == 0:
 		return ""
 	else:
 		return ', ' + ', '.join(required_attrs)
 
-def _gen_load_simple(t: UxsdSimple, input: str) -> str:
+def _gen_load_simple(t: UxsdSimple, input: str, report_error: str = "state->report_error") -> str:
 	if isinstance(t, UxsdString):
 		return input + '.cStr()'
 	elif isinstance(t, UxsdEnum):
-		return 'conv_enum_{type}({input}, report_error)'.format(
+		return 'conv_enum_{type}({input}, {report_error})'.format(
 				type=t.name,
-				input=input)
+				input=input,
+				report_error=report_error)
 	else:
 		return input
 
+def _gen_load_field(f: Union[UxsdAttribute, UxsdElement], input: str, report_error: str = "state->report_error", strings: str = "state->strings->") -> str:
+	"""Like _gen_load_simple, but looks interned strings up with the get() of
+	the CapnpStrings which strings is the prefix of."""
+	if f.interned:
+		return '{strings}get({input}, {report_error})'.format(
+				strings=strings,
+				input=input,
+				report_error=report_error)
+	else:
+		return _gen_load_simple(f.type, input, report_error)
+
+def _gen_set_field(f: Union[UxsdAttribute, UxsdElement], input: str, strings: str = "strings.") -> str:
+	"""Like _gen_set_simple, but interns interned strings into the
+	CapnpStringTable which strings is the prefix of."""
+	if f.interned:
+		return '{strings}intern({input})'.format(strings=strings, input=input)
+	else:
+		return _gen_set_simple(f.type, input)
+
 def _gen_set_simple(t: UxsdSimple, input: str) -> str:
 	if isinstance(t, UxsdString):
 		return input
@@ -164,6 +250,31 @@ def _gen_set_simple(t: UxsdSimple, input: str) -> str:
 		return input
 
 
+# C++ types of the elements of capnp::List<T> for the builtin types.
+_list_element_types = {
+	"Text": "::capnp::Text",
+	"bool": "bool",
+	"Float32": "float",
+	"Float64": "double",
+	"Int8": "int8_t",
+	"Int16": "int16_t",
+	"Int32": "int32_t",
+	"Int64": "int64_t",
+	"UInt8": "uint8_t",
+	"UInt16": "uint16_t",
+	"UInt32": "uint32_t",
+	"UInt64": "uint64_t",
+}
+
+def _gen_list_element_type(t: UxsdSimple) -> str:
+	"""The T of the capnp::List<T> a repeated simple element is stored in."""
+	if isinstance(t, UxsdAtomic):
+		return _list_element_types[to_type(t)]
+	elif isinstance(t, UxsdEnum):
+		return "ucap::%s" % to_type(t)
+	else:
+		raise NotImplementedError(t)
+
 def union_to_capnp(t: UxsdUnion) -> str:
 	"""Declare global unnamed union inside struct."""
 	fields = []
@@ -198,64 +309,576 @@ def render_capnp_file(schema: UxsdSchema, cmdline: str, input_file: str) -> str:
 	if unions:
 		out += "\n\n"
 		out += "\n\n".join(unions)
-	complexes = [complex_to_capnp(t) for t in schema.complex_types]
+	root = schema.root_element.type
+	complexes = [complex_to_capnp(t, t is root and _uses_strings(root)) for t in schema.complex_types]
 	out += "\n\n"
 	out += "\n\n".join(complexes)
+	if _chunked_lists(schema.root_element.type):
+		out += "\n\n"
+		out += chunk_to_capnp(schema)
 	out += "\n"
 	return out
 
-# Initial memory allocation for capnp stack for error reporting.
-INITIAL_STACK_DEPTH = 20
+# Where load_*_capnp reports progress to. Bytes are the offset of the data section
+# of the last loaded struct in the message, which grows as a flat message is read
+# in order.
+capnp_progress_defn = """
+/* Internal: the ProgressReporter of a load_*_capnp call and the start of its message. */
+struct CapnpProgress {
+	ProgressReporter *reporter;
+	const ::capnp::word *base;
+	int64_t offset(::capnp::AnyStruct::Reader el) const {
+		return el.getDataSection().begin() - reinterpret_cast<const kj::byte *>(base);
+	}
+};
+"""
+
+# Options of load_*_capnp, and the thread pool of its parallel loads.
+capnp_parallel_defn = """
+/**
+ * Options for load_*_capnp.
+ *
+ * num_threads: Load the repeated children of the root and of its children on
+ *     this many threads, or one per core if 0. The default of 1 loads serially.
+ *     The implementation must then have start_range_* and merge_range_*, and
+ *     its add_* and load callbacks are called concurrently for distinct ranges.
+ * range_size: Number of such children loaded by a thread at a time. Lists
+ *     which aren't longer than this are loaded serially.
+ * progress: Report the progress of the load to this reporter. See ProgressReporter.
+ */
+struct CapnpLoadOptions {
+	size_t num_threads = 1;
+	size_t range_size = 4096;
+	ProgressReporter *progress = nullptr;
+};
+
+/**
+ * Internal helper for load_*_capnp. Calls load_range(r) for every range on
+ * a pool of num_threads threads, and merge_range(r) on the calling thread in
+ * the order of the ranges, as soon as each one is loaded.
+ *
+ * If a thread throws, the others stop and the exception is rethrown here.
+ */
+template<typename Load, typename Merge>
+inline void capnp_load_parallel(size_t num_ranges, size_t num_threads, Load load_range, Merge merge_range){
+	std::vector<char> ready(num_ranges, 0);
+	size_t next = 0;
+	bool stop = false;
+	std::exception_ptr error;
+	std::mutex lock;
+	std::condition_variable cv;
+	auto fail = [&](std::exception_ptr e){
+		if(!error) error = e;
+		stop = true;
+		cv.notify_all();
+	};
+	auto worker = [&](){
+		std::unique_lock<std::mutex> guard(lock);
+		for(;;){
+			if(stop || next >= num_ranges) return;
+			size_t r = next++;
+			guard.unlock();
+			try {
+				load_range(r);
+			} catch(...) {
+				guard.lock();
+				fail(std::current_exception());
+				return;
+			}
+			guard.lock();
+			ready[r] = 1;
+			cv.notify_all();
+		}
+	};
+
+	std::vector<std::thread> threads;
+	for(size_t i = 0; i < num_threads; i++) threads.emplace_back(worker);
+	try {
+		for(size_t r = 0; r < num_ranges; r++){
+			{
+				std::unique_lock<std::mutex> guard(lock);
+				cv.wait(guard, [&]{ return stop || ready[r]; });
+				if(stop) break;
+			}
+			merge_range(r);
+		}
+	} catch(...) {
+		std::lock_guard<std::mutex> guard(lock);
+		fail(std::current_exception());
+	}
+	for(auto &thread : threads) thread.join();
+	if(error) std::rethrow_exception(error);
+}
+
+/* Internal: the number of threads a list of n children is loaded on, or 1 if it's loaded serially. */
+inline size_t capnp_load_threads(const CapnpLoadOptions &options, size_t n){
+	size_t range_size = options.range_size ? options.range_size : 1;
+	if(options.num_threads == 1 || n <= range_size) return 1;
+	size_t num_threads = options.num_threads;
+	if(num_threads == 0) num_threads = std::thread::hardware_concurrency();
+	return std::max<size_t>(1, std::min(num_threads, (n + range_size - 1) / range_size));
+}
+"""
+
+# A read-only mapping of a message file, and the encodings of message files,
+# for load_*_capnp_file and write_*_capnp_file.
+capnp_file_defn = """
+/**
+ * A file mapped read-only into memory. Pages are read by the kernel when
+ * they're first touched, so opening a large file is cheap and only the parts
+ * of a message which are traversed are read.
+ */
+class CapnpMappedFile {
+public:
+	explicit CapnpMappedFile(const char *filename){
+		int fd = open(filename, O_RDONLY | O_CLOEXEC);
+		if(fd == -1) throw std::runtime_error(std::strerror(errno));
+		struct stat st;
+		if(fstat(fd, &st) == -1){
+			int err = errno;
+			close(fd);
+			throw std::runtime_error(std::strerror(err));
+		}
+		size_ = st.st_size;
+		if(size_ == 0){
+			close(fd);
+			throw std::runtime_error("it's empty");
+		}
+		data_ = mmap(nullptr, size_, PROT_READ, MAP_PRIVATE, fd, 0);
+		int err = errno;
+		close(fd);
+		if(data_ == MAP_FAILED) throw std::runtime_error(std::strerror(err));
+		/* Messages are mostly read from front to back. */
+		madvise(data_, size_, MADV_SEQUENTIAL);
+	}
+	~CapnpMappedFile(){
+		munmap(data_, size_);
+	}
+	CapnpMappedFile(const CapnpMappedFile &) = delete;
+	CapnpMappedFile &operator=(const CapnpMappedFile &) = delete;
+
+	kj::ArrayPtr<const kj::byte> bytes() const {
+		return kj::arrayPtr(reinterpret_cast<const kj::byte *>(data_), size_);
+	}
+
+private:
+	void *data_;
+	size_t size_;
+};
+
+/**
+ * Encodings of a message file. FLAT is the standard serialization, which is
+ * read in place. PACKED is Cap'n Proto's packing, which removes zero bytes.
+ * ZSTD is a zstd frame of the flat message, and needs UXSD_ZSTD and -lzstd.
+ * Packed and zstd messages are decoded into memory before they're read.
+ */
+enum class CapnpEncoding {FLAT, PACKED, ZSTD};
+
+/**
+ * Detect the encoding of a message file. A zstd frame starts with its magic
+ * number. A flat message is a whole number of words, and its segment table
+ * adds up to its size. Anything else is taken to be packed.
+ */
+inline CapnpEncoding capnp_detect_encoding(kj::ArrayPtr<const kj::byte> bytes){
+	auto u32 = [&](size_t i){
+		return uint32_t(bytes[i]) | uint32_t(bytes[i+1]) << 8 | uint32_t(bytes[i+2]) << 16 | uint32_t(bytes[i+3]) << 24;
+	};
+	if(bytes.size() >= 4 && u32(0) == 0xFD2FB528) return CapnpEncoding::ZSTD;
+	if(bytes.size() >= 8 && bytes.size() % sizeof(::capnp::word) == 0){
+		uint64_t segments = uint64_t(u32(0)) + 1;
+		uint64_t words = (segments + 2) / 2;
+		if(segments <= 512 && words * sizeof(::capnp::word) <= bytes.size()){
+			for(uint64_t i=0; i<segments; i++) words += u32(4 + 4*i);
+			if(words * sizeof(::capnp::word) == bytes.size()) return CapnpEncoding::FLAT;
+		}
+	}
+	return CapnpEncoding::PACKED;
+}
+
+/**
+ * Internal: the words of the flat message in a message file. A flat message
+ * is returned in place. Others are decoded into storage.
+ */
+inline kj::ArrayPtr<const ::capnp::word> capnp_decode_message(kj::ArrayPtr<const kj::byte> bytes, kj::Array<::capnp::word> &storage){
+	switch(capnp_detect_encoding(bytes)){
+	case CapnpEncoding::FLAT:
+		/* Mappings are page-aligned, but FlatArrayMessageReader needs aligned words, so make sure. */
+		if(reinterpret_cast<uintptr_t>(bytes.begin()) % alignof(::capnp::word) != 0)
+			throw std::runtime_error("it isn't mapped at a word boundary");
+		return kj::arrayPtr(reinterpret_cast<const ::capnp::word *>(bytes.begin()), bytes.size() / sizeof(::capnp::word));
+	case CapnpEncoding::PACKED:
+		try {
+			kj::ArrayInputStream in(bytes);
+			::capnp::ReaderOptions opts;
+			opts.traversalLimitInWords = std::numeric_limits<uint64_t>::max();
+			::capnp::PackedMessageReader reader(in, opts);
+			/* Copy the unpacked segments into a flat message, which is loaded like a flat file. */
+			std::vector<kj::ArrayPtr<const ::capnp::word>> segments;
+			for(kj::ArrayPtr<const ::capnp::word> segment; (segment = reader.getSegment(segments.size())) != nullptr;)
+				segments.push_back(segment);
+			storage = ::capnp::messageToFlatArray(kj::arrayPtr(segments.data(), segments.size()));
+		} catch(kj::Exception &ex) {
+			throw std::runtime_error(std::string("packed: ") + ex.getDescription().cStr());
+		}
+		return storage;
+	case CapnpEncoding::ZSTD: {
+#ifdef UXSD_ZSTD
+		unsigned long long size = ZSTD_getFrameContentSize(bytes.begin(), bytes.size());
+		if(size == ZSTD_CONTENTSIZE_ERROR) throw std::runtime_error("zstd: not a zstd frame");
+		if(size == ZSTD_CONTENTSIZE_UNKNOWN) throw std::runtime_error("zstd: the frame doesn't record its content size");
+		if(size % sizeof(::capnp::word) != 0) throw std::runtime_error("zstd: the message isn't a whole number of words");
+		storage = kj::heapArray<::capnp::word>(size / sizeof(::capnp::word));
+		size_t ret = ZSTD_decompress(storage.begin(), size, bytes.begin(), bytes.size());
+		if(ZSTD_isError(ret)) throw std::runtime_error(std::string("zstd: ") + ZSTD_getErrorName(ret));
+		if(ret != size) throw std::runtime_error("zstd: unexpected end of input");
+		return storage;
+#else
+		throw std::runtime_error("it's compressed with zstd, but uxsdcxx was compiled without UXSD_ZSTD");
+#endif
+	}
+	}
+	throw std::runtime_error("Unreachable!");
+}
+
+/* Write a message to fd in an encoding. zstd_level is only used by ZSTD. */
+inline void write_capnp_message(int fd, ::capnp::MessageBuilder &builder, CapnpEncoding encoding = CapnpEncoding::FLAT, int zstd_level = 3){
+	switch(encoding){
+	case CapnpEncoding::FLAT:
+		::capnp::writeMessageToFd(fd, builder);
+		break;
+	case CapnpEncoding::PACKED:
+		::capnp::writePackedMessageToFd(fd, builder);
+		break;
+	case CapnpEncoding::ZSTD: {
+#ifdef UXSD_ZSTD
+		kj::Array<::capnp::word> flat = ::capnp::messageToFlatArray(builder);
+		kj::ArrayPtr<const kj::byte> bytes = flat.asBytes();
+		std::vector<char> compressed(ZSTD_compressBound(bytes.size()));
+		size_t size = ZSTD_compress(compressed.data(), compressed.size(), bytes.begin(), bytes.size(), zstd_level);
+		if(ZSTD_isError(size)) throw std::runtime_error(std::string("zstd: ") + ZSTD_getErrorName(size));
+		kj::FdOutputStream(fd).write(compressed.data(), size);
+#else
+		(void)zstd_level;
+		throw std::runtime_error("Can't write zstd: uxsdcxx was compiled without UXSD_ZSTD");
+#endif
+		break;
+	}
+	}
+}
+"""
+
+# The strings tables of messages with interned strings. Both headers have them,
+# so they're guarded for when both are included.
+capnp_strings_defn = """
+#ifndef UXSD_CAPNP_STRINGS
+#define UXSD_CAPNP_STRINGS
+/**
+ * Internal: the strings table of a message which is being written. intern()
+ * returns the index of a string, adding it if it's new. Index 0 is the empty
+ * string, which null strings are written as too.
+ */
+class CapnpStringTable {
+public:
+	CapnpStringTable(){ clear(); }
+
+	void clear(){
+		index_.clear();
+		strings_.assign(1, "");
+		written_ = 0;
+	}
+	uint32_t intern(const char *value){
+		if(value == nullptr || *value == '\\0') return 0;
+		auto it = index_.emplace(value, static_cast<uint32_t>(strings_.size()));
+		if(it.second) strings_.push_back(it.first->first.c_str());
+		return it.first->second;
+	}
+	/* The number of strings added since the last write(). */
+	size_t pending() const { return strings_.size() - written_; }
+	/* Write the strings added since the last write() into a list of pending() strings. */
+	void write(::capnp::List<::capnp::Text>::Builder list){
+		for(unsigned int i = 0; i < list.size(); i++) list.set(i, strings_[written_ + i]);
+		written_ += list.size();
+	}
+
+private:
+	/* The keys are the strings, whose nodes don't move. */
+	std::unordered_map<std::string, uint32_t> index_;
+	std::vector<const char *> strings_;
+	size_t written_;
+};
+
+/**
+ * Internal: the strings table of a message which is being read. The strings
+ * point into the message, or into copies for messages which are freed before
+ * the load ends.
+ */
+class CapnpStrings {
+public:
+	void clear(){
+		strings_.clear();
+		copies_.clear();
+	}
+	void add(::capnp::List<::capnp::Text>::Reader list){
+		strings_.reserve(strings_.size() + list.size());
+		for(auto value : list) strings_.push_back(value.cStr());
+	}
+	void add_copies(::capnp::List<::capnp::Text>::Reader list){
+		strings_.reserve(strings_.size() + list.size());
+		for(auto value : list){
+			copies_.emplace_back(value.cStr(), value.size());
+			strings_.push_back(copies_.back().c_str());
+		}
+	}
+	const char *get(uint32_t index, const std::function<void(const char *)> *report_error) const {
+		if(index == 0) return "";
+		if(index >= strings_.size()){
+			(*report_error)(("String index " + std::to_string(index) + " is out of range of the strings table").c_str());
+			throw std::runtime_error("Unreachable!");
+		}
+		return strings_[index];
+	}
+
+private:
+	std::vector<const char *> strings_;
+	std::deque<std::string> copies_;
+};
+#endif
+"""
+
+# Path depth of the load state of a schema with recursive types, past which
+# the load is stopped.
+RECURSIVE_PATH_DEPTH = 64
+
+def _path_depth(t: UxsdComplex, visiting: Optional[Set[UxsdComplex]] = None) -> Optional[int]:
+	"""Levels of the path from an element of type t to its deepest descendant,
+	or None if t can contain itself."""
+	if visiting is None: visiting = set()
+	if t in visiting: return None
+	if not isinstance(t.content, (UxsdDfa, UxsdAll)): return 1
+	visiting.add(t)
+	depth = 1
+	for el in t.content.children:
+		child = 1
+		if isinstance(el.type, UxsdComplex):
+			child = _path_depth(el.type, visiting)
+			if child is None: return None
+		depth = max(depth, child + 1)
+	visiting.remove(t)
+	return depth
+
+def _gen_load_state(schema: UxsdSchema) -> str:
+	pname = utils.to_pascalcase(schema.root_element.name)
+	depth = _path_depth(schema.root_element.type)
+	out = ""
+	out += "/**\n"
+	out += " * State of a load_%s_capnp call. The loaders keep the field and the list\n" % schema.root_element.name
+	out += " * index of each level down to the current element, and the path is only\n"
+	out += " * formatted when an error is reported.\n"
+	out += " */\n"
+	out += "struct Capnp%sLoadState {\n" % pname
+	out += "\tstatic constexpr int DEPTH = %d;\n" % (depth if depth is not None else RECURSIVE_PATH_DEPTH)
+	out += "\tstatic constexpr size_t NOT_LIST = std::numeric_limits<size_t>::max();\n"
+	out += "\tconst char *filename;\n"
+	out += "\tconst std::function<void(const char *)> *report_error;\n"
+	out += "\tconst CapnpLoadOptions *options;\n"
+	out += "\tconst CapnpProgress *progress;\n"
+	if _uses_strings(schema.root_element.type):
+		out += "\tCapnpStrings *strings;\n"
+	out += "\tint depth;\n"
+	out += "\tconst char *field[DEPTH];\n"
+	out += "\tsize_t index[DEPTH];\n"
+	out += "\n"
+	out += "\tstd::string path() const {\n"
+	out += "\t\tstd::string out;\n"
+	out += "\t\tfor(int i = 0; i <= depth; i++) {\n"
+	out += "\t\t\tif(i > 0) out += \" . \";\n"
+	out += "\t\t\tout += field[i];\n"
+	out += "\t\t\tif(index[i] != NOT_LIST) out += \"[\" + std::to_string(index[i]) + \"]\";\n"
+	out += "\t\t}\n"
+	out += "\t\treturn out;\n"
+	out += "\t}\n"
+	out += "\tstd::string message(const char *message) const {\n"
+	out += "\t\treturn std::string(message) + \"\\nError occured at \" + path();\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* Sets the depth of the path to a child's level while the child is loaded,\n"
+	out += "\t * and restores it when the load of the child exits. */\n"
+	out += "\tstruct Level {\n"
+	out += "\t\tCapnp%sLoadState *state;\n" % pname
+	out += "\t\tint depth;\n"
+	out += "\t\tLevel(Capnp%sLoadState *state_in, int child_depth) : state(state_in), depth(state_in->depth) {\n" % pname
+	out += "\t\t\tstate->depth = child_depth;\n"
+	out += "\t\t}\n"
+	out += "\t\tLevel(const Level &) = delete;\n"
+	out += "\t\t~Level() { state->depth = depth; }\n"
+	out += "\t};\n"
+	out += "};\n"
+	return out
 
 def load_fn_from_element(e: UxsdElement) -> str:
 	out = ""
+	out += "/**\n"
+	out += " * Load a capnp message from data. See CapnpLoadOptions. The progress of the load\n"
+	out += " * is reported with bytes measured from the start of data.\n"
+	out += " */\n"
 	out += "template <class T, typename Context>\n"
-	out += "inline void load_%s_capnp(T &out, kj::ArrayPtr<const ::capnp::word> data, Context &context, const char * filename){\n" % e.name
+	out += "inline void load_%s_capnp(T &out, kj::ArrayPtr<const ::capnp::word> data, Context &context, const char * filename, const CapnpLoadOptions &options){\n" % e.name
 
 	out += "\t/* Remove traversal limits. */\n"
 	out += "\t::capnp::ReaderOptions opts = ::capnp::ReaderOptions();\n"
 	out += "\topts.traversalLimitInWords = std::numeric_limits<uint64_t>::max();\n"
 	out += "\t::capnp::FlatArrayMessageReader reader(data, opts);\n"
 	out += "\tauto root = reader.getRoot<ucap::{}>();\n".format(to_type(e))
-	out += "\tstd::vector<std::pair<const char*, size_t>> stack;\n"
-	out += "\tstack.reserve({});\n".format(INITIAL_STACK_DEPTH)
-	out += "\tstack.push_back(std::make_pair(\"root\", 0));\n"
+	out += "\tCapnp{}LoadState state;\n".format(utils.to_pascalcase(e.name))
+	out += "\tstate.filename = filename;\n"
+	out += "\tstate.depth = 0;\n"
+	out += "\tstate.field[0] = \"root\";\n"
+	out += "\tstate.index[0] = state.NOT_LIST;\n"
 	out += "\n"
-	out += "\tstd::function<void(const char *)> report_error = [filename, &out, &stack](const char *message){\n"
-	out += "\t\tstd::stringstream msg;\n"
-	out += "\t\tmsg << message << std::endl;\n"
-	out += "\t\tmsg << \"Error occured at \";\n"
-	out += "\t\tfor(size_t i = 0; i < stack.size(); ++i) {\n"
-	out += "\t\t\tmsg << stack[i].first << \"[\" << stack[i].second << \"]\";\n"
-	out += "\t\t\tif(i+1 < stack.size()) {\n"
-	out += "\t\t\t\tmsg << \" . \";\n"
-	out += "\t\t\t}\n"
-	out += "\t\t}\n"
-
-	out += "\t\tout.error_encountered(filename, -1, msg.str().c_str());\n"
+	out += "\tstd::function<void(const char *)> report_error = [filename, &out, &state](const char *message){\n"
+	out += "\t\tout.error_encountered(filename, -1, state.message(message).c_str());\n"
 	out += "\t};\n"
+	out += "\tProgressReporter *progress = options.progress;\n"
+	out += "\tCapnpProgress capnp_progress = {progress, data.begin()};\n"
+	out += "\tstate.report_error = &report_error;\n"
+	out += "\tstate.options = &options;\n"
+	out += "\tstate.progress = progress ? &capnp_progress : nullptr;\n"
+	if _uses_strings(e.type):
+		out += "\tCapnpStrings strings;\n"
+		out += "\tstrings.add(root.getStrings());\n"
+		out += "\tstate.strings = &strings;\n"
+	out += "\tif(progress) progress->start();\n"
 	out += "\tout.start_load(&report_error);\n"
-	out += "\tload_{}_capnp_type(root, out, context, &report_error, &stack);\n".format(e.name);
+	out += "\tload_{}_capnp_type(root, out, context, &state, 0);\n".format(e.name);
 	out += "\tout.finish_load();\n"
+	out += "\tif(progress) progress->finish(data.size() * sizeof(::capnp::word));\n"
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Load a capnp message from data. If progress is non-null, the progress of the\n"
+	out += " * load is reported to it, with bytes measured from the start of data.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_capnp(T &out, kj::ArrayPtr<const ::capnp::word> data, Context &context, const char * filename, ProgressReporter *progress = nullptr){\n" % e.name
+	out += "\tCapnpLoadOptions options;\n"
+	out += "\toptions.progress = progress;\n"
+	out += "\tload_%s_capnp(out, data, context, filename, options);\n" % e.name
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Load a capnp message from a file in any CapnpEncoding, which is detected from\n"
+	out += " * its contents. The file is mapped into memory, and a flat message is read in place\n"
+	out += " * instead of being copied. Strings passed to out point into the message, which\n"
+	out += " * is gone when the load returns. Progress is measured in the decoded message.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_capnp_file(T &out, const char * filename, Context &context, const CapnpLoadOptions &options){\n" % e.name
+	out += "\tstd::unique_ptr<CapnpMappedFile> file;\n"
+	out += "\tkj::Array<::capnp::word> decoded;\n"
+	out += "\tkj::ArrayPtr<const ::capnp::word> words;\n"
+	out += "\ttry {\n"
+	out += "\t\tfile.reset(new CapnpMappedFile(filename));\n"
+	out += "\t\twords = capnp_decode_message(file->bytes(), decoded);\n"
+	out += "\t} catch(std::runtime_error &ex) {\n"
+	out += "\t\tstd::string msg = \"Unable to read Cap'n Proto file '\" + std::string(filename) + \"', \" + ex.what() + \".\";\n"
+	out += "\t\tout.error_encountered(filename, -1, msg.c_str());\n"
+	out += "\t\tthrow std::runtime_error(msg);\n"
+	out += "\t}\n"
+	out += "\tload_%s_capnp(out, words, context, filename, options);\n" % e.name
+	out += "}\n"
+	out += "\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_capnp_file(T &out, const char * filename, Context &context, ProgressReporter *progress = nullptr){\n" % e.name
+	out += "\tCapnpLoadOptions options;\n"
+	out += "\toptions.progress = progress;\n"
+	out += "\tload_%s_capnp_file(out, filename, context, options);\n" % e.name
 	out += "}\n"
 	return out
 
 
-def load_fn_from_complex_type(t: UxsdComplex) -> str:
+def _gen_load_list_element(el: UxsdElement, suffix: str, state_type: str, state: str, state_ptr: str, context: str, data: str = "data[i]") -> str:
+	"""Load the element data at index i of a list of repeated children. state is
+	the prefix of the fields of the load state, and state_ptr a pointer to it."""
+	out = ""
+	out += "auto el = %s;\n" % data
+	out += "{state}index[depth+1] = i;\n".format(state=state)
+	out += "{state_type}::Level level({state_ptr}, depth+1);\n".format(state_type=state_type, state_ptr=state_ptr)
+	if isinstance(el.type, UxsdComplex):
+		out += "auto child_context = out.add_{suffix}({context}{required_attrs});\n".format(
+				suffix=suffix,
+				context=context,
+				required_attrs=_gen_required_attribute_arg_list(el, 'el', state + "report_error", state + "strings->"))
+		out += "load_{name}_capnp_type(el, out, child_context, {state_ptr}, depth+1);\n".format(
+				name=el.type.name,
+				state_ptr=state_ptr)
+		out += "out.finish_{suffix}(child_context);\n".format(suffix=suffix)
+	else:
+		out += "out.add_{suffix}({data}, {context});\n".format(
+				suffix=suffix,
+				data=_gen_load_simple(el.type, 'el', state + "report_error"),
+				context=context)
+	return out
+
+def _gen_load_list_parallel(el: UxsdElement, suffix: str, state: str) -> str:
+	"""Load a list of repeated children in ranges on num_threads threads. Every
+	range gets a context from start_range_* and a copy of the load state, and
+	is merged into the parent's context on this thread in order."""
+	out = ""
+	out += "size_t range_size = std::max<size_t>(1, state->options->range_size);\n"
+	out += "size_t num_ranges = (data.size() + range_size - 1) / range_size;\n"
+	out += "std::vector<Context> ranges;\n"
+	out += "ranges.reserve(num_ranges);\n"
+	out += "for(size_t r = 0; r < num_ranges; r++)\n"
+	out += "\tranges.push_back(out.start_range_{suffix}(context, r*range_size, std::min<size_t>(data.size(), (r+1)*range_size)));\n".format(suffix=suffix)
+	out += "CapnpLoadOptions serial;\n"
+	out += "capnp_load_parallel(num_ranges, num_threads, [&](size_t r){\n"
+	out += "\t{state} range_state = *state;\n".format(state=state)
+	out += "\tstd::function<void(const char *)> report_error = [&out, &range_state](const char *message){\n"
+	out += "\t\tout.error_encountered(range_state.filename, -1, range_state.message(message).c_str());\n"
+	out += "\t};\n"
+	out += "\trange_state.report_error = &report_error;\n"
+	out += "\trange_state.options = &serial;\n"
+	out += "\trange_state.progress = nullptr;\n"
+	out += "\tfor(unsigned int i = r*range_size; i < std::min<size_t>(data.size(), (r+1)*range_size); i++) {\n"
+	out += utils.indent(_gen_load_list_element(el, suffix, state, "range_state.", "&range_state", "ranges[r]"), 2)
+	out += "\t}\n"
+	out += "}, [&](size_t r){\n"
+	out += "\tsize_t end = std::min<size_t>(data.size(), (r+1)*range_size);\n"
+	out += "\tout.merge_range_{suffix}(context, ranges[r], r*range_size, end);\n".format(suffix=suffix)
+	out += "\tfor(size_t i = r*range_size; state->progress && i < end; i++) {\n"
+	out += "\t\tif(state->progress->reporter->tick(\"{name}\", i+1))\n".format(name=el.name)
+	out += "\t\t\tstate->progress->reporter->report(state->progress->offset(data[i]));\n"
+	out += "\t}\n"
+	out += "});\n"
+	return out
+
+def load_fn_from_complex_type(t: UxsdComplex, state: str, recursive: bool, progress: bool = False, stream: Optional[UxsdElement] = None) -> str:
 	"""Generate a full C++ function load_foo(&root, &out)
 	which can load an XSD complex type from DOM &root into C++ object out.
+
+	depth is the level of root in the path of the load state. Only the field and
+	the list index of each child are stored in the path before it is loaded.
+	If the schema is recursive, the depth of the path is checked.
+	If progress is set, repeated children are counted to the ProgressReporter,
+	and complex ones are loaded in parallel if options.num_threads isn't 1.
+	If stream is the root element, generate load_<t>_capnp_stream_type, which
+	loads the repeated complex children from the chunks of a stream instead.
 	"""
+	root_type = stream.type if stream is not None else None
 	out = ""
 	out += "template<class T, typename Context>\n"
-	out += "inline void load_{name}_capnp_type(const ucap::{cname}::Reader &root, T &out, Context &context, const std::function<void(const char*)> * report_error, std::vector<std::pair<const char *, size_t>> * stack){{\n".format(
+	out += "inline void load_{name}_capnp_{mode}(const ucap::{cname}::Reader &root, T &out, Context &context, {state} *state, int depth{chunks}){{\n".format(
 			name=t.name,
-			cname=utils.to_pascalcase(t.name))
+			mode="type" if root_type is None else "stream_type",
+			cname=utils.to_pascalcase(t.name),
+			state=state,
+			chunks="" if root_type is None else ", CapnpStreamReader &chunks")
 
 	out += "\t(void)root;\n"
 	out += "\t(void)out;\n"
 	out += "\t(void)context;\n"
-	out += "\t(void)report_error;\n"
-	out += "\t(void)stack;\n"
+	out += "\t(void)state;\n"
+	out += "\t(void)depth;\n"
 	out += "\n"
 	for attr in t.attrs:
 		if cpp.pass_at_init(attr):
@@ -263,69 +886,91 @@ def load_fn_from_complex_type(t: UxsdComplex) -> str:
 
 		out += "\tout.set_{suffix}({data}, context);\n".format(
 			suffix=cpp._gen_stub_suffix(attr, t.name),
-            data=_gen_load_simple(attr.type, 'root.get{pname}()'.format(
+            data=_gen_load_field(attr, 'root.get{pname}()'.format(
                 pname=utils.to_pascalcase(attr.name))))
 
+	if recursive and isinstance(t.content, (UxsdDfa, UxsdAll)) and any(isinstance(el.type, UxsdComplex) for el in t.content.children):
+		out += "\tif(depth + 1 >= state->DEPTH) (*state->report_error)(\"Elements are nested too deeply\");\n"
+
 	if isinstance(t.content, (UxsdDfa, UxsdAll)):
 		for el in t.content.children:
 			name = utils.to_pascalcase(el.name)
-			out += "\tstack->push_back(std::make_pair(\"get{}\", 0));\n".format(name)
-			if el.many:
-				out += "\t{\n"
+			if root_type is not None and _is_chunked(el):
+				out += utils.indent(_gen_load_chunks(t, el, stream, state, progress))
+			elif el.many:
 				suffix = cpp._gen_stub_suffix(el, t.name)
+				serial = ""
+				serial += "for(unsigned int i = 0; i < data.size(); i++) {\n"
+				serial += utils.indent(_gen_load_list_element(el, suffix, state, "state->", "state", "context"))
+				if progress:
+					serial += "\tif(state->progress && state->progress->reporter->tick(\"{name}\", i+1))\n".format(name=el.name)
+					if isinstance(el.type, UxsdComplex):
+						serial += "\t\tstate->progress->reporter->report(state->progress->offset(el));\n"
+					else:
+						serial += "\t\tstate->progress->reporter->report(-1);\n"
+				serial += "}\n"
+
+				out += "\t{\n"
 				out += "\t\tauto data = root.get{pname}();\n".format(pname=utils.pluralize(name))
 				out += "\t\tout.preallocate_{suffix}(context, data.size());\n".format(suffix=suffix)
-
-				out += "\t\tfor(const auto & el : data) {\n"
-				if isinstance(el.type, UxsdComplex):
-					out += "\t\t\tauto child_context = out.add_{suffix}(context{required_attrs});\n".format(
-							suffix=suffix,
-							required_attrs=_gen_required_attribute_arg_list(el, 'el'))
-					out += "\t\t\tload_{suffix}_capnp_type(el, out, child_context, report_error, stack);\n".format(
-							suffix=el.type.name)
-					out += "\t\t\tout.finish_{suffix}(child_context);\n".format(
-							suffix=suffix)
+				out += "\t\tstate->field[depth+1] = \"get{pname}\";\n".format(pname=utils.pluralize(name))
+				if progress and isinstance(el.type, UxsdComplex):
+					# Repeated children of top-level types can be large sections, so they
+					# can be loaded on the thread pool of capnp_load_parallel.
+					out += "\t\tsize_t num_threads = capnp_load_threads(*state->options, data.size());\n"
+					out += "\t\tif(num_threads > 1) {\n"
+					out += utils.indent(_gen_load_list_parallel(el, suffix, state), 3)
+					out += "\t\t} else {\n"
+					out += utils.indent(serial, 3)
+					out += "\t\t}\n"
 				else:
-					out += "\t\t\tout.add_{suffix}({data}, context);\n".format(
-							suffix=suffix,
-							data=_gen_load_simple(el, 'el.get{}()'.format(name))
-							)
-				out += "\t\t\tstack->back().second += 1;\n"
-				out += "\t\t}\n"
+					out += utils.indent(serial, 2)
 				out += "\t}\n"
 			else:
-				out += "\tif (root.has{pname}()) {{\n".format(pname=name)
+				if isinstance(el.type, UxsdComplex) or (isinstance(el.type, UxsdString) and not el.interned):
+					out += "\tif (root.has{pname}()) {{\n".format(pname=name)
+				elif el.interned:
+					# Interned strings are indices, which are 0 if unset.
+					out += "\tif (root.get{pname}() != 0) {{\n".format(pname=name)
+				else:
+					# Only pointer fields have has*(), other fields are always set.
+					out += "\t{\n"
+				out += "\t\tstate->field[depth+1] = \"get{pname}\";\n".format(pname=name)
+				out += "\t\tstate->index[depth+1] = state->NOT_LIST;\n"
+				out += "\t\t{state}::Level level(state, depth+1);\n".format(state=state)
 				if isinstance(el.type, UxsdComplex):
 					out += "\t\tauto child_el = root.get{pname}();\n".format(pname=name)
 					access = 'child_el'
 					out += "\t\tauto child_context = out.init_{suffix}(context{required_attrs});\n".format(
 							suffix=cpp._gen_stub_suffix(el, t.name),
 							required_attrs=_gen_required_attribute_arg_list(el, access))
-					out += "\t\tload_{suffix}_capnp_type({access}, out, child_context, report_error, stack);\n".format(
-							access=access,
-							suffix=el.type.name,
-							pname=name)
+					if root_type is not None and _is_stream_child(t, el, root_type):
+						out += "\t\tload_{suffix}_capnp_stream_type({access}, out, child_context, state, depth+1, chunks);\n".format(
+								access=access,
+								suffix=el.type.name)
+					else:
+						out += "\t\tload_{suffix}_capnp_type({access}, out, child_context, state, depth+1);\n".format(
+								access=access,
+								suffix=el.type.name)
 					out += "\t\tout.finish_{suffix}(child_context);\n".format(
 							suffix=cpp._gen_stub_suffix(el, t.name))
 				else:
-					out += "\t\tout.init_{suffix}({data}, context);\n".format(
+					out += "\t\tout.set_{suffix}({data}, context);\n".format(
 							suffix=cpp._gen_stub_suffix(el, t.name),
-							data=_gen_load_simple(el, 'root.get{name}()'.format(name)))
+							data=_gen_load_field(el, 'root.get{name}()'.format(name=name)))
 				out += "\t}\n"
-
-			out += "\tstack->pop_back();\n"
 	elif isinstance(t.content, UxsdLeaf):
-		out += "\tstack->push_back(std::make_pair(\"getValue\", 0));\n"
 		out += "\tout.set_{name}_value(root.getValue().cStr(), context);\n".format(
 				name=t.name)
-		out += "\tstack->pop_back();\n"
 
 	out += "}\n"
 	return out
 
 
 def _gen_write_simple(t: Union[UxsdElement, UxsdAttribute], parent: str, context: str = "context") -> str:
-	if isinstance(t.type, UxsdAtomic):
+	if t.interned:
+		return _gen_set_field(t, "in.get_%s(%s)" % (cpp._gen_stub_suffix(t, parent), context))
+	elif isinstance(t.type, UxsdAtomic):
 		if isinstance(t, UxsdElement) and t.many:
 			return "in.get_%s(i, %s)" % (cpp._gen_stub_suffix(t, parent), context)
 		else:
@@ -347,43 +992,56 @@ def _gen_write_simple(t: Union[UxsdElement, UxsdAttribute], parent: str, context
 		raise NotImplementedError(t)
 
 
-def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
-	"""Function to generate partial code which writes out an element with a complex type."""
+def _gen_write_element_body(e: UxsdElement, root: str, mode: str = "type") -> str:
+	"""Write the attributes of a complex element into the builder root, and its
+	content with write_<type>_capnp_<mode>."""
 	assert isinstance(e.type, UxsdComplex)
 	out = ""
+	for a in e.type.attrs:
+		out += _gen_write_attr(a, e.type.name, root, "child_context")
+	if e.type.content:
+		out += "write_{name}_capnp_{mode}(in, {root}, child_context{strings});\n".format(
+				root=root,
+				name=e.type.name,
+				mode=mode,
+				strings=", strings" if _uses_strings(e.type) else "")
+	return out
 
-	def _gen_write_element_body(root : str) -> str:
-		assert isinstance(e.type, UxsdComplex)
-		ouv = ""
-		if e.type.attrs:
-			for a in e.type.attrs:
-				ouv += _gen_write_attr(a, e.type.name, root, "child_context")
-			if e.type.content:
-				ouv += "write_{name}_capnp_type(in, {root}, child_context);\n".format(
-						root=root,
-						name=e.type.name)
-		else:
-			if e.type.content:
-				ouv += "write_{name}_capnp_type(in, {root}, child_context);\n".format(
-						root=root,
-						name=e.type.name)
-
-		return ouv
+def _gen_write_complex_element(e: UxsdElement, parent: str, mode: str = "type") -> str:
+	"""Function to generate partial code which writes out an element with a complex type."""
+	assert isinstance(e.type, UxsdComplex)
+	out = ""
 
 	name = cpp._gen_stub_suffix(e, parent)
 	if e.many:
 		plural_name = utils.pluralize(cpp._gen_stub_suffix(e, parent))
-		out += "size_t num_{pname} = in.num_{name}(context);\n".format(name=name, pname=plural_name)
-		out += "auto {name} = root.init{pname}(num_{name});\n".format(
-				name=plural_name,
-				pname=utils.pluralize(utils.to_pascalcase(e.name)))
-		out += "for(size_t i = 0; i < num_{name}; i++) {{\n".format(name=plural_name)
-		out += "\tauto {name} = {plural_name}[i];\n".format(
-				name=name,
-				plural_name=plural_name,
-				)
-		out += "\tauto child_context = in.get_%s(i, context);\n" % cpp._gen_stub_suffix(e, parent)
-		out += utils.indent(_gen_write_element_body(name))
+		fmt = {"name": name,
+			"plural_name": plural_name,
+			"pname": utils.pluralize(utils.to_pascalcase(e.name))}
+		out += "{\n"
+		out += "\tWriteCursor<decltype(in.get_{name}(0, context))> cursor;\n".format(**fmt)
+		out += "\tbool more = in.begin_{name}(context, cursor);\n".format(**fmt)
+		out += "\tif(cursor.size != SIZE_MAX){{\n".format(**fmt)
+		out += "\t\tauto {plural_name} = root.init{pname}(cursor.size);\n".format(**fmt)
+		out += "\t\tsize_t i = 0;\n"
+		out += "\t\tfor(; more && i < cursor.size; more = in.next_{name}(context, cursor), i++){{\n".format(**fmt)
+		out += "\t\t\tauto {name} = {plural_name}[i];\n".format(**fmt)
+		out += "\t\t\tauto child_context = cursor.value;\n"
+		out += utils.indent(_gen_write_element_body(e, name, mode), 3)
+		out += "\t\t}\n"
+		out += "\t\tif(more || i != cursor.size)\n"
+		out += "\t\t\tthrow std::runtime_error(\"begin_{name} reported \" + std::to_string(cursor.size) + \" children, but next_{name} \" + (more ? std::string(\"has more.\") : \"ended after \" + std::to_string(i) + \".\"));\n".format(**fmt)
+		out += "\t} else {\n"
+		out += "\t\t/* The cursor doesn't know how many children there are, so collect them to size the list. */\n"
+		out += "\t\tstd::vector<decltype(cursor.value)> children;\n"
+		out += "\t\tfor(; more; more = in.next_{name}(context, cursor)) children.push_back(cursor.value);\n".format(**fmt)
+		out += "\t\tauto {plural_name} = root.init{pname}(children.size());\n".format(**fmt)
+		out += "\t\tfor(size_t i = 0; i < children.size(); i++){{\n".format(**fmt)
+		out += "\t\t\tauto {name} = {plural_name}[i];\n".format(**fmt)
+		out += "\t\t\tauto &child_context = children[i];\n"
+		out += utils.indent(_gen_write_element_body(e, name, mode), 3)
+		out += "\t\t}\n"
+		out += "\t}\n"
 		out += "}\n"
 	elif e.optional:
 		out += "if(in.has_%s(context)){\n" % cpp._gen_stub_suffix(e, parent)
@@ -391,7 +1049,7 @@ def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
 				name=name,
 				pname=utils.to_pascalcase(e.name))
 		out += "\tauto child_context = in.get_%s(context);\n" % cpp._gen_stub_suffix(e, parent)
-		out += utils.indent(_gen_write_element_body(name))
+		out += utils.indent(_gen_write_element_body(e, name, mode))
 		out += "}\n"
 	else:
 		out += "{\n"
@@ -399,7 +1057,7 @@ def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
 		out += "\tauto {name} = root.init{pname}();\n".format(
 				name=name,
 				pname=utils.to_pascalcase(e.name))
-		out += utils.indent(_gen_write_element_body(name))
+		out += utils.indent(_gen_write_element_body(e, name, mode))
 		out += "}\n"
 
 	return out
@@ -415,24 +1073,56 @@ def _gen_write_element(e: UxsdElement, parent: str) -> str:
 	unions? strings? doubles?)
 	"""
 
-	assert isinstance(e.type, UxsdComplex)
 	out = ""
 	out += "\n"
-	out += _gen_write_complex_element(e, parent)
+	if isinstance(e.type, UxsdComplex):
+		out += _gen_write_complex_element(e, parent)
+	elif e.many:
+		stub = cpp._gen_stub_suffix(e, parent)
+		out += "{\n"
+		out += "\tsize_t n = in.num_%s(context);\n" % stub
+		out += "\tauto %s = root.init%s(n);\n" % (utils.pluralize(stub), utils.to_pascalcase(utils.pluralize(e.name)))
+		out += "\tfor(size_t i = 0; i < n; i++)\n"
+		out += "\t\t%s.set(i, %s);\n" % (utils.pluralize(stub), _gen_write_simple(e, parent))
+		out += "}\n"
+	elif isinstance(e.type, UxsdString) and e.optional and not e.interned:
+		stub = cpp._gen_stub_suffix(e, parent)
+		out += "{\n"
+		out += "\tauto %s = %s;\n" % (stub, _gen_write_simple(e, parent))
+		out += "\tif(%s) root.set%s(%s);\n" % (stub, utils.to_pascalcase(e.name), stub)
+		out += "}\n"
+	else:
+		out += "root.set%s(%s);\n" % (utils.to_pascalcase(e.name), _gen_write_simple(e, parent))
 
 	return out
 
 
-def write_fn_from_complex_type(t: UxsdComplex) -> str:
+def write_fn_from_complex_type(t: UxsdComplex, root_type: Optional[UxsdComplex] = None) -> str:
+	"""If root_type is the type of the root element, generate write_<t>_capnp_head,
+	which writes the head message of a chunked stream without the chunked lists."""
 	assert isinstance(t.content, (UxsdDfa, UxsdAll, UxsdLeaf))
 	out = ""
 	out += "template<class T, typename Context>\n"
-	out += "inline void write_{name}_capnp_type(T &in, ucap::{cname}::Builder &root, Context &context) {{\n".format(
+	out += "inline void write_{name}_capnp_{mode}(T &in, ucap::{cname}::Builder &root, Context &context{strings}) {{\n".format(
 			name=t.name,
-			cname=utils.to_pascalcase(t.name))
+			mode="type" if root_type is None else "head",
+			cname=utils.to_pascalcase(t.name),
+			strings=", CapnpStringTable &strings" if _uses_strings(t) else "")
 	out += "\t(void)in;\n"
 	out += "\t(void)root;\n"
-	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+	if root_type is not None:
+		out += "\t(void)context;\n"
+	if _uses_strings(t):
+		out += "\t(void)strings;\n"
+	if isinstance(t.content, (UxsdDfa, UxsdAll)) and root_type is not None:
+		for e in t.content.children:
+			if _is_chunked(e):
+				out += "\t/* {name} is written in chunks. */\n".format(name=e.name)
+			elif _is_stream_child(t, e, root_type):
+				out += utils.indent("\n" + _gen_write_complex_element(e, t.name, "head"))
+			else:
+				out += utils.indent(_gen_write_element(e, t.name))
+	elif isinstance(t.content, (UxsdDfa, UxsdAll)):
 		for e in t.content.children:
 			out += utils.indent(_gen_write_element(e, t.name))
 	elif isinstance(t.content, UxsdLeaf):
@@ -479,19 +1169,328 @@ def write_fn_from_root_element(e: UxsdElement) -> str:
 			cname=utils.to_pascalcase(e.name))
 
 	out += "\tin.start_write();\n"
+	strings = _uses_strings(e.type)
+	if strings:
+		out += "\tCapnpStringTable strings;\n"
 
 	if e.type.attrs:
 		for a in e.type.attrs:
 			out += utils.indent(_gen_write_attr(a, e.name))
-	out += "\twrite_{name}_capnp_type(in, root, context);\n".format(
-			name=e.name)
+	out += "\twrite_{name}_capnp_type(in, root, context{strings});\n".format(
+			name=e.name,
+			strings=", strings" if strings else "")
+	if strings:
+		out += "\tstrings.write(root.initStrings(strings.pending()));\n"
 
 	out += "\tin.finish_write();\n"
 
+	out += "}\n"
+	out += "\n"
+	out += "/* Write a message to a file in an encoding. See CapnpEncoding. */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void write_{name}_capnp_file(T &in, Context &context, const char * filename, CapnpEncoding encoding = CapnpEncoding::FLAT) {{\n".format(name=e.name)
+	out += "\t::capnp::MallocMessageBuilder builder;\n"
+	out += "\tauto root = builder.initRoot<ucap::{cname}>();\n".format(cname=utils.to_pascalcase(e.name))
+	out += "\twrite_{name}_capnp(in, context, root);\n".format(name=e.name)
+	out += "\tint fd = open(filename, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);\n"
+	out += "\tif(fd == -1) throw std::runtime_error(\"Unable to open Cap'n Proto file '\" + std::string(filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "\ttry {\n"
+	out += "\t\twrite_capnp_message(fd, builder, encoding);\n"
+	out += "\t} catch(...) {\n"
+	out += "\t\tclose(fd);\n"
+	out += "\t\tthrow;\n"
+	out += "\t}\n"
+	out += "\tif(close(fd) == -1) throw std::runtime_error(\"Unable to write Cap'n Proto file '\" + std::string(filename) + \"', \" + std::strerror(errno) + \".\");\n"
 	out += "}\n"
 	return out
 
 
+def _is_stream_child(t: UxsdComplex, e: UxsdElement, root_type: UxsdComplex) -> bool:
+	"""Whether e is a child of the root which is in the head message of a chunked
+	stream, with its repeated complex children in chunks."""
+	return t is root_type and not e.many and isinstance(e.type, UxsdComplex)
+
+def _is_chunked(e: UxsdElement) -> bool:
+	return e.many and isinstance(e.type, UxsdComplex)
+
+def _stream_types(root: UxsdComplex) -> List[UxsdComplex]:
+	"""The root type and the types of its single complex children, whose repeated
+	complex children are written in chunks."""
+	out = [root]
+	if isinstance(root.content, (UxsdDfa, UxsdAll)):
+		for e in root.content.children:
+			if _is_stream_child(root, e, root) and e.type not in out:
+				out.append(e.type)
+	return [t for t in out if isinstance(t.content, (UxsdDfa, UxsdAll))]
+
+def _chunked_lists(root: UxsdComplex) -> List[Tuple[UxsdComplex, UxsdElement]]:
+	out = []
+	for t in _stream_types(root):
+		for e in t.content.children:
+			if _is_chunked(e):
+				out.append((t, e))
+	return out
+
+def _chunk_field(t: UxsdComplex, e: UxsdElement) -> str:
+	"""Name of the list of e in the chunk struct, in PascalCase."""
+	return utils.pluralize(utils.to_pascalcase(cpp._gen_stub_suffix(e, t.name)))
+
+def chunk_to_capnp(schema: UxsdSchema) -> str:
+	lists = _chunked_lists(schema.root_element.type)
+	fields = []
+	for i, (t, e) in enumerate(lists):
+		name = _chunk_field(t, e)
+		fields.append("%s @%d :List(%s);" % (name[0].lower() + name[1:], i+1, to_type(e.type)))
+	out = ""
+	out += "# A message after the first one of a chunked stream. total is the length\n"
+	out += "# of the whole list which the chunk is a part of.\n"
+	out += "struct %sChunk {\n" % utils.to_pascalcase(schema.root_element.name)
+	out += "\ttotal @0 :UInt64;\n"
+	if len(lists) > 1:
+		out += "\tunion {\n"
+		out += "".join("\t\t%s\n" % f for f in fields)
+		out += "\t}\n"
+	else:
+		# A union needs two members at least.
+		out += "\t%s\n" % fields[0]
+	if _uses_strings(schema.root_element.type):
+		out += "\t# The strings interned since the message before.\n"
+		out += "\tstrings @%d :List(Text);\n" % (len(lists)+1)
+	out += "}"
+	return out
+
+# Reads the messages of a chunked stream for load_*_capnp_stream.
+capnp_stream_defn = """
+/**
+ * Internal: reads the messages of a chunked stream from a file descriptor.
+ * Only the message from the last next() is kept, and bytes() counts what was
+ * read from the file so far.
+ */
+class CapnpStreamReader : private kj::InputStream {
+public:
+	explicit CapnpStreamReader(int fd) : fd_(fd), buffered_(*this) {}
+
+	/* Copy the first message into head, so it's kept while the chunks are read. */
+	void read_head(::capnp::MessageBuilder &head){
+		::capnp::readMessageCopy(buffered_, head, options());
+	}
+	::capnp::MessageReader &next(){
+		message_ = nullptr;
+		message_ = kj::heap<::capnp::InputStreamMessageReader>(buffered_, options());
+		return *message_;
+	}
+	uint64_t bytes() const { return bytes_; }
+
+private:
+	static ::capnp::ReaderOptions options(){
+		::capnp::ReaderOptions opts;
+		opts.traversalLimitInWords = std::numeric_limits<uint64_t>::max();
+		return opts;
+	}
+	size_t tryRead(void *buffer, size_t min_bytes, size_t max_bytes) override {
+		size_t n = fd_.tryRead(buffer, min_bytes, max_bytes);
+		bytes_ += n;
+		return n;
+	}
+
+	kj::FdInputStream fd_;
+	uint64_t bytes_ = 0;
+	kj::BufferedInputStreamWrapper buffered_;
+	kj::Own<::capnp::InputStreamMessageReader> message_;
+};
+"""
+
+def _gen_load_chunks(t: UxsdComplex, e: UxsdElement, stream: UxsdElement, state: str, progress: bool) -> str:
+	"""Load a chunked list from the chunks which follow, one message at a time.
+	The chunk is freed when the next one is read, so its strings are copied."""
+	root_name = stream.name
+	check = len(_chunked_lists(stream.type)) > 1
+	strings = _uses_strings(stream.type)
+	suffix = cpp._gen_stub_suffix(e, t.name)
+	fmt = {"chunk": utils.to_pascalcase(root_name) + "Chunk",
+		"field": _chunk_field(t, e),
+		"suffix": suffix,
+		"name": e.name,
+		"pname": utils.pluralize(utils.to_pascalcase(e.name))}
+	out = ""
+	out += "{\n"
+	out += "\tauto chunk = chunks.next().getRoot<ucap::{chunk}>();\n".format(**fmt)
+	if check:
+		out += "\tif(!chunk.is{field}()) (*state->report_error)(\"Expected a chunk of {name}\");\n".format(**fmt)
+	out += "\tsize_t total = chunk.getTotal();\n"
+	out += "\tout.preallocate_{suffix}(context, total);\n".format(**fmt)
+	out += "\tstate->field[depth+1] = \"get{pname}\";\n".format(**fmt)
+	out += "\tfor(size_t offset = 0;;) {\n"
+	out += "\t\tauto data = chunk.get{field}();\n".format(**fmt)
+	if strings:
+		out += "\t\tstate->strings->add_copies(chunk.getStrings());\n"
+	out += "\t\tif(data.size() > total - offset) (*state->report_error)(\"Chunk of {name} is longer than its list\");\n".format(**fmt)
+	out += "\t\tfor(unsigned int j = 0; j < data.size(); j++) {\n"
+	out += "\t\t\tsize_t i = offset + j;\n"
+	out += utils.indent(_gen_load_list_element(e, suffix, state, "state->", "state", "context", "data[j]"), 3)
+	if progress:
+		out += "\t\t\tif(state->progress && state->progress->reporter->tick(\"{name}\", i+1))\n".format(**fmt)
+		out += "\t\t\t\tstate->progress->reporter->report(chunks.bytes());\n"
+	out += "\t\t}\n"
+	out += "\t\toffset += data.size();\n"
+	out += "\t\tif(offset == total) break;\n"
+	out += "\t\tchunk = chunks.next().getRoot<ucap::{chunk}>();\n".format(**fmt)
+	if check:
+		out += "\t\tif(!chunk.is{field}()) (*state->report_error)(\"Expected a chunk of {name}\");\n".format(**fmt)
+	out += "\t}\n"
+	out += "}\n"
+	return out
+
+def _gen_write_chunks(t: UxsdComplex, e: UxsdElement, stream: UxsdElement) -> str:
+	"""Write a list in messages of at most chunk_size children."""
+	root_name = stream.name
+	name = cpp._gen_stub_suffix(e, t.name)
+	fmt = {"chunk": utils.to_pascalcase(root_name) + "Chunk",
+		"field": _chunk_field(t, e),
+		"name": name,
+		"plural_name": utils.pluralize(name)}
+	out = ""
+	out += "{\n"
+	out += "\tWriteCursor<decltype(in.get_{name}(0, context))> cursor;\n".format(**fmt)
+	out += "\tbool more = in.begin_{name}(context, cursor);\n".format(**fmt)
+	out += "\tstd::vector<decltype(cursor.value)> children;\n"
+	out += "\tsize_t total = cursor.size;\n"
+	out += "\tif(total == SIZE_MAX){\n"
+	out += "\t\t/* The cursor doesn't know how many children there are, so collect them to count them. */\n"
+	out += "\t\tfor(; more; more = in.next_{name}(context, cursor)) children.push_back(cursor.value);\n".format(**fmt)
+	out += "\t\ttotal = children.size();\n"
+	out += "\t}\n"
+	out += "\tsize_t offset = 0;\n"
+	out += "\tdo {\n"
+	out += "\t\tsize_t count = std::min(total - offset, chunk_size);\n"
+	out += "\t\t::capnp::MallocMessageBuilder builder;\n"
+	out += "\t\tauto chunk = builder.initRoot<ucap::{chunk}>();\n".format(**fmt)
+	out += "\t\tchunk.setTotal(total);\n"
+	out += "\t\tauto {plural_name} = chunk.init{field}(count);\n".format(**fmt)
+	out += "\t\tfor(size_t i = 0; i < count; i++){\n"
+	out += "\t\t\tauto {name} = {plural_name}[i];\n".format(**fmt)
+	out += "\t\t\tif(children.empty() && !more)\n"
+	out += "\t\t\t\tthrow std::runtime_error(\"begin_{name} reported \" + std::to_string(total) + \" children, but next_{name} ended after \" + std::to_string(offset + i) + \".\");\n".format(**fmt)
+	out += "\t\t\tauto child_context = children.empty() ? cursor.value : children[offset + i];\n"
+	out += utils.indent(_gen_write_element_body(e, name), 3)
+	out += "\t\t\tif(children.empty()) more = in.next_{name}(context, cursor);\n".format(**fmt)
+	out += "\t\t}\n"
+	out += "\t\toffset += count;\n"
+	if _uses_strings(stream.type):
+		out += "\t\tstrings.write(chunk.initStrings(strings.pending()));\n"
+	out += "\t\t::capnp::writeMessageToFd(fd, builder);\n"
+	out += "\t} while(offset < total);\n"
+	out += "\tif(more)\n"
+	out += "\t\tthrow std::runtime_error(\"begin_{name} reported \" + std::to_string(total) + \" children, but next_{name} has more.\");\n".format(**fmt)
+	out += "}\n"
+	return out
+
+def write_chunks_fn_from_complex_type(t: UxsdComplex, stream: UxsdElement) -> str:
+	"""Generate write_<t>_capnp_chunks, which writes the chunked lists of t and
+	of its stream children in document order."""
+	root_type = stream.type
+	out = ""
+	out += "template<class T, typename Context>\n"
+	out += "inline void write_{name}_capnp_chunks(T &in, Context &context, int fd, size_t chunk_size{strings}) {{\n".format(
+			name=t.name,
+			strings=", CapnpStringTable &strings" if _uses_strings(root_type) else "")
+	out += "\t(void)in;\n"
+	out += "\t(void)context;\n"
+	out += "\t(void)fd;\n"
+	out += "\t(void)chunk_size;\n"
+	strings = ", strings" if _uses_strings(root_type) else ""
+	if strings:
+		out += "\t(void)strings;\n"
+	for e in t.content.children:
+		if _is_chunked(e):
+			out += utils.indent(_gen_write_chunks(t, e, stream))
+		elif _is_stream_child(t, e, root_type):
+			stub = cpp._gen_stub_suffix(e, t.name)
+			if e.optional:
+				out += "\tif(in.has_%s(context)){\n" % stub
+			else:
+				out += "\t{\n"
+			out += "\t\tauto child_context = in.get_%s(context);\n" % stub
+			out += "\t\twrite_%s_capnp_chunks(in, child_context, fd, chunk_size%s);\n" % (e.type.name, strings)
+			out += "\t}\n"
+	out += "}\n"
+	return out
+
+def stream_fns_from_root_element(e: UxsdElement) -> str:
+	assert isinstance(e.type, UxsdComplex)
+	fmt = {"name": e.name, "cname": utils.to_pascalcase(e.name)}
+	out = ""
+	out += "/**\n"
+	out += " * Write a chunked stream to fd. The first message is the document without the\n"
+	out += " * repeated complex children of the root and of its children. They follow in\n"
+	out += " * ucap::{cname}Chunk messages of at most chunk_size children, in document order.\n".format(**fmt)
+	out += " * Only one message is built at a time.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void write_{name}_capnp_stream(T &in, Context &context, int fd, size_t chunk_size = 65536) {{\n".format(**fmt)
+	fmt["strings"] = ", strings" if _uses_strings(e.type) else ""
+	out += "\tif(chunk_size == 0) throw std::runtime_error(\"write_{name}_capnp_stream: chunk_size must be at least 1.\");\n".format(**fmt)
+	out += "\tin.start_write();\n"
+	if fmt["strings"]:
+		out += "\tCapnpStringTable strings;\n"
+	out += "\t{\n"
+	out += "\t\t::capnp::MallocMessageBuilder builder;\n"
+	out += "\t\tauto root = builder.initRoot<ucap::{cname}>();\n".format(**fmt)
+	for a in e.type.attrs:
+		out += utils.indent(_gen_write_attr(a, e.name), 2)
+	out += "\t\twrite_{name}_capnp_head(in, root, context{strings});\n".format(**fmt)
+	if fmt["strings"]:
+		out += "\t\tstrings.write(root.initStrings(strings.pending()));\n"
+	out += "\t\t::capnp::writeMessageToFd(fd, builder);\n"
+	out += "\t}\n"
+	out += "\twrite_{name}_capnp_chunks(in, context, fd, chunk_size{strings});\n".format(**fmt)
+	out += "\tin.finish_write();\n"
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Load a chunked stream written by write_{name}_capnp_stream from fd. Only the\n".format(**fmt)
+	out += " * first message and the chunk being loaded are kept in memory, and progress is\n"
+	out += " * measured in bytes read from fd.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_{name}_capnp_stream(T &out, int fd, Context &context, const char * filename, ProgressReporter *progress = nullptr){{\n".format(**fmt)
+	out += "\tCapnpStreamReader chunks(fd);\n"
+	out += "\t::capnp::MallocMessageBuilder head;\n"
+	out += "\tCapnp{cname}LoadState state;\n".format(**fmt)
+	out += "\tstate.filename = filename;\n"
+	out += "\tstate.depth = 0;\n"
+	out += "\tstate.field[0] = \"root\";\n"
+	out += "\tstate.index[0] = state.NOT_LIST;\n"
+	out += "\n"
+	out += "\tstd::function<void(const char *)> report_error = [filename, &out, &state](const char *message){\n"
+	out += "\t\tout.error_encountered(filename, -1, state.message(message).c_str());\n"
+	out += "\t};\n"
+	out += "\tCapnpLoadOptions options;\n"
+	out += "\tCapnpProgress capnp_progress = {progress, nullptr};\n"
+	out += "\tstate.report_error = &report_error;\n"
+	out += "\tstate.options = &options;\n"
+	out += "\tstate.progress = progress ? &capnp_progress : nullptr;\n"
+	if fmt["strings"]:
+		out += "\tCapnpStrings strings;\n"
+		out += "\tstate.strings = &strings;\n"
+	out += "\tif(progress) progress->start();\n"
+	out += "\tout.start_load(&report_error);\n"
+	out += "\ttry {\n"
+	out += "\t\tchunks.read_head(head);\n"
+	out += "\t\tauto root = head.getRoot<ucap::{cname}>().asReader();\n".format(**fmt)
+	if fmt["strings"]:
+		out += "\t\tstrings.add(root.getStrings());\n"
+	out += "\t\tload_{name}_capnp_stream_type(root, out, context, &state, 0, chunks);\n".format(**fmt)
+	out += "\t} catch(kj::Exception &ex) {\n"
+	out += "\t\tstd::string msg = \"Unable to read Cap'n Proto stream '\" + std::string(filename) + \"', \" + ex.getDescription().cStr() + \".\";\n"
+	out += "\t\tout.error_encountered(filename, -1, msg.c_str());\n"
+	out += "\t\tthrow std::runtime_error(msg);\n"
+	out += "\t}\n"
+	out += "\tout.finish_load();\n"
+	out += "\tif(progress) progress->finish(chunks.bytes());\n"
+	out += "}\n"
+	return out
+
 def render_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: str, interface_file_name: str, input_file: str) -> str:
 	"""Render a C++ header file to a string."""
 	out = ""
@@ -500,24 +1499,67 @@ def render_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: str, i
 		"input_file": input_file,
 		"md5": utils.md5(input_file)}
 	out += cpp_templates.header_comment.substitute(x)
+	out += '#include <algorithm>\n'
+	out += '#include <cerrno>\n'
+	out += '#include <condition_variable>\n'
+	out += '#include <cstdint>\n'
+	out += '#include <cstring>\n'
+	out += '#include <deque>\n'
+	out += '#include <exception>\n'
+	out += '#include <functional>\n'
+	out += '#include <memory>\n'
+	out += '#include <mutex>\n'
 	out += '#include <stdexcept>\n'
+	out += '#include <thread>\n'
 	out += '#include <tuple>\n'
+	out += '#include <unordered_map>\n'
 	out += '#include <vector>\n'
 	out += '#include <sstream>\n'
 	out += '#include <limits>\n'
+	out += '#include <fcntl.h>\n'
+	out += '#include <sys/mman.h>\n'
+	out += '#include <sys/stat.h>\n'
+	out += '#include <unistd.h>\n'
+	out += '#include "capnp/any.h"\n'
+	out += '#include "capnp/message.h"\n'
 	out += '#include "capnp/serialize.h"\n'
+	out += '#include "capnp/serialize-packed.h"\n'
+	out += '#include "kj/io.h"\n'
+	out += '#ifdef UXSD_ZSTD\n'
+	out += '#include <zstd.h>\n'
+	out += '#endif\n'
 	out += '#include "{}.h"\n'.format(capnp_file_name)
 	out += '#include "{}"\n'.format(interface_file_name)
 	out += "\n/* All uxsdcxx functions and structs live in this namespace. */\n"
 	out += "namespace uxsd {"
 
+	out += "\n"
+	out += capnp_progress_defn
+	out += capnp_parallel_defn
+	out += capnp_file_defn
+	if _uses_strings(schema.root_element.type):
+		out += capnp_strings_defn
+	stream_types = _stream_types(schema.root_element.type) if _chunked_lists(schema.root_element.type) else []
+	if stream_types:
+		out += capnp_stream_defn
+	out += "\n"
+	out += _gen_load_state(schema)
+	state = "Capnp%sLoadState" % utils.to_pascalcase(schema.root_element.name)
+	recursive = _path_depth(schema.root_element.type) is None
 	out += "\n/* Declarations for internal load functions for the complex types. */\n"
 	load_fn_decls = []
 	for t in schema.complex_types:
 		load_fn_decls.append("template <class T, typename Context>")
-		load_fn_decls.append("void load_{name}_capnp_type(const ucap::{cname}::Reader &root, T &out, Context &context, const std::function<void(const char*)> * report_error, std::vector<std::pair<const char *, size_t>> * stack);".format(
+		load_fn_decls.append("void load_{name}_capnp_type(const ucap::{cname}::Reader &root, T &out, Context &context, {state} *state, int depth);".format(
 			name=t.name,
-			cname=utils.to_pascalcase(t.name)))
+			cname=utils.to_pascalcase(t.name),
+			state=state))
+	for t in stream_types:
+		load_fn_decls.append("template <class T, typename Context>")
+		load_fn_decls.append("void load_{name}_capnp_stream_type(const ucap::{cname}::Reader &root, T &out, Context &context, {state} *state, int depth, CapnpStreamReader &chunks);".format(
+			name=t.name,
+			cname=utils.to_pascalcase(t.name),
+			state=state))
 	out += "\n".join(load_fn_decls)
 
 	out += "\n\n/* Declarations for internal write functions for the complex types. */\n"
@@ -526,27 +1568,42 @@ def render_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: str, i
 		if t.content is None:
 			continue
 		write_fn_decls.append("template <class T, typename Context>")
-		write_fn_decls.append("inline void write_{name}_capnp_type(T &in, ucap::{cname}::Builder &root, Context &context);".format(
+		write_fn_decls.append("inline void write_{name}_capnp_type(T &in, ucap::{cname}::Builder &root, Context &context{strings});".format(
+			name=t.name,
+			cname=utils.to_pascalcase(t.name),
+			strings=", CapnpStringTable &strings" if _uses_strings(t) else ""))
+	for t in stream_types:
+		write_fn_decls.append("template <class T, typename Context>")
+		write_fn_decls.append("inline void write_{name}_capnp_head(T &in, ucap::{cname}::Builder &root, Context &context{strings});".format(
 			name=t.name,
-			cname=utils.to_pascalcase(t.name)))
+			cname=utils.to_pascalcase(t.name),
+			strings=", CapnpStringTable &strings" if _uses_strings(t) else ""))
+		write_fn_decls.append("template <class T, typename Context>")
+		write_fn_decls.append("inline void write_{name}_capnp_chunks(T &in, Context &context, int fd, size_t chunk_size{strings});".format(
+			name=t.name,
+			strings=", CapnpStringTable &strings" if _uses_strings(schema.root_element.type) else ""))
 	out += "\n".join(write_fn_decls)
 
 	if schema.enums:
-		enum_converters = [_gen_conv_enum(t) for t in schema.enums]
-		out += "\n\n/* Enum conversions from uxsd to ucap */\n"
-		out += "\n".join(enum_converters)
+		out += _gen_enum_converters(schema)
 
 	out += "\n\n/* Load function for the root element. */\n"
 	out += load_fn_from_element(schema.root_element)
 	out += "\n/* Write function for the root element. */\n"
 	out += write_fn_from_root_element(schema.root_element)
+	if stream_types:
+		out += "\n/* Chunked stream functions for the root element. */\n"
+		out += stream_fns_from_root_element(schema.root_element)
 
-	complex_type_loaders = [load_fn_from_complex_type(t) for t in schema.complex_types]
+	complex_type_loaders = [load_fn_from_complex_type(t, state, recursive, t in schema.top_level_types) for t in schema.complex_types]
+	complex_type_loaders += [load_fn_from_complex_type(t, state, recursive, True, schema.root_element) for t in stream_types]
 
 	out += "\n\n/* Internal loading functions, which validate and load a PugiXML DOM tree into memory. */\n"
 	out += "\n".join(complex_type_loaders)
 
 	complex_type_writers = [write_fn_from_complex_type(t) for t in schema.complex_types if t.content is not None]
+	complex_type_writers += [write_fn_from_complex_type(t, schema.root_element.type) for t in stream_types]
+	complex_type_writers += [write_chunks_fn_from_complex_type(t, schema.root_element) for t in stream_types]
 	out += "\n\n/* Internal writing functions, which uxsdcxx uses to write out a class. */\n"
 	out += "\n".join(complex_type_writers)
 
@@ -561,7 +1618,33 @@ def _gen_builder(e: UxsdComplex):
 	return 'ucap::{}::Builder'.format(utils.to_pascalcase(e.name))
 
 
-def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
+def _gen_finish(t: UxsdType, builder: Optional[str] = None) -> str:
+	"""Check that the lists of an element of type t were filled, and drop their
+	ListFills. A list which preallocate_* wasn't called for isn't checked: its
+	element has no children of it. If there's no builder to look at, as for
+	the root, that's taken from its empty ListFill stack."""
+	if not isinstance(t, UxsdComplex) or not isinstance(t.content, (UxsdDfa, UxsdAll)):
+		return ""
+
+	impl = ""
+	for el in t.content.children:
+		if el.many:
+			stub = cpp._gen_stub_suffix(el, t.name)
+			if builder is not None:
+				impl += "if(!{stub}_fill_.empty() && {builder}.has{pname}()){{\n".format(
+						stub=stub, builder=builder, pname=utils.to_pascalcase(utils.pluralize(el.name)))
+			else:
+				impl += "if(!{stub}_fill_.empty()){{\n".format(stub=stub)
+			impl += "\tif({stub}_fill_.back().next != {stub}_fill_.back().list.size())\n".format(stub=stub)
+			impl += "\t\tthrow std::runtime_error(\"add_{stub} was called fewer times than preallocate_{stub} allowed for.\");\n".format(stub=stub)
+			impl += "\t{stub}_fill_.pop_back();\n".format(stub=stub)
+			impl += "}\n"
+	return impl
+
+def _gen_canonical_name(t: UxsdComplex) -> str:
+	return "%s_canonical_" % t.name
+
+def _gen_capnp_impl(t: UxsdComplex, is_root : bool, hash_cons_types: List[UxsdComplex]) -> str:
 	fields = []
 
 	def _add_field(ret: str, verb: str, what: str, args: str, impl: str):
@@ -573,64 +1656,14 @@ def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
 			if cpp.pass_at_init(attr):
 				impl += 'child_builder.set{pname}({value});\n'.format(
 						pname=utils.to_pascalcase(attr.name),
-						value=_gen_set_simple(attr.type, attr.name))
-		return impl
-
-	def _gen_finish(e: UxsdElement):
-		any_many = False
-		if not isinstance(e.type, UxsdComplex):
-			return ""
-
-		if isinstance(e.type.content, (UxsdDfa, UxsdAll)):
-			for el in e.type.content.children:
-				if el.many:
-					any_many = True
-					break
-
-		if not any_many:
-			return ""
-
-		impl = ""
-		for el in e.type.content.children:
-			if el.many:
-				impl += "auto {cname} = builder.init{pname}({name}_.size());\n".format(
-						cname=cpp.checked(el.name),
-						name=utils.pluralize(el.type.name),
-						pname=utils.to_pascalcase(utils.pluralize(el.name)))
-				impl += "for(size_t i = 0; i < {name}_.size(); ++i) {{\n".format(
-						name=utils.pluralize(el.type.name))
-				impl += "\t{cname}.adoptWithCaveats(i, std::move({name}_[i]));\n".format(
-						cname=cpp.checked(el.name),
-						name=utils.pluralize(el.type.name))
-				impl += "}\n"
-				impl += "{name}_.clear();\n".format(name=utils.pluralize(el.type.name))
-		return impl
-
-		any_many = False
-		for e2 in e.content.children:
-			if isinstance(e2.type, UxsdComplex):
-				if e2.many:
-					any_many = True
-					break
-			elif isinstance(e2.type, UxsdSimple):
-				if e2.many:
-					any_many = True
-					break
-			else:
-				raise TypeError(e2)
-
-		if not any_many:
-			return ""
-
-		impl = ""
-
+						value=_gen_set_field(attr, attr.name, "string_table_."))
 		return impl
 
 	def _add_set(e: Union[UxsdElement, UxsdAttribute]):
 		impl = ""
 		impl += "builder.set{pname}({value});\n".format(
 				pname=utils.to_pascalcase(e.name),
-				value=_gen_set_simple(e.type, e.name))
+				value=_gen_set_field(e, e.name, "string_table_."))
 		_add_field("void", "set", e.name, "{}, {} &builder".format(cpp._gen_attribute_arg(e), _gen_builder(t)), impl)
 
 	def _add_init(e: UxsdElement):
@@ -639,31 +1672,72 @@ def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
 		impl += "auto child_builder = builder.init{pname}();\n".format(
 				pname=utils.to_pascalcase(e.name))
 		impl += _gen_set_required_attrs(e)
+		if e.type in hash_cons_types:
+			impl += "%s.push_back(child_builder);\n" % _gen_canonical_name(e.type)
 		impl += "return child_builder;\n"
 		_add_field(_gen_builder(e.type), "init", e.name, cpp._gen_required_attribute_arg_list(_gen_builder(t), e.type.attrs, context="builder"), impl)
 
-		_add_field("void", "finish", e.name, _gen_builder(e.type) + " &builder", _gen_finish(e))
+		_add_field("void", "finish", e.name, _gen_builder(e.type) + " &builder", _gen_finish(e.type, "builder"))
 
 	def _add_add_simple(e: UxsdElement):
+		"""As for complex children, the list is initialized by preallocate_*, and
+		add_* sets its next element."""
+		stub = cpp._gen_stub_suffix(e, t.name)
+		impl = ""
+		impl += "(void)builder;\n"
+		impl += "if({stub}_fill_.empty() || {stub}_fill_.back().next == {stub}_fill_.back().list.size())\n".format(stub=stub)
+		impl += "\tthrow std::runtime_error(\"add_{stub} was called more times than preallocate_{stub} allowed for.\");\n".format(stub=stub)
+		impl += "auto &fill = {stub}_fill_.back();\n".format(stub=stub)
+		impl += "fill.list.set(fill.next++, {value});\n".format(value=_gen_set_simple(e.type, cpp.checked(e.name)))
+		_add_field("void", "add", e.name, "{}, {} &builder".format(cpp._gen_attribute_arg(e), _gen_builder(t)), impl)
+
 		impl = ""
-		_add_field("void", "add", e.name, "{} {}, {} &builder".format(e.type.cpp, cpp.checked(e.name), _gen_builder(t)), impl)
+		impl += "{stub}_fill_.push_back({{builder.init{pname}(static_cast<unsigned int>(size)), 0}});\n".format(
+				stub=stub, pname=utils.to_pascalcase(utils.pluralize(e.name)))
+		_add_field("void", "preallocate", e.name, _gen_builder(t) + " &builder, size_t size", impl)
 
 	def _add_add_complex(e: UxsdElement):
+		"""The list of e is initialized with the count given to preallocate_*, and
+		add_* builds the next element of it in place."""
 		assert isinstance(e.type, UxsdComplex)
+		stub = cpp._gen_stub_suffix(e, t.name)
 		impl = ""
-		impl += "auto {name} = capnp::Orphanage::getForMessageContaining(builder).newOrphan<ucap::{pname}>();\n".format(
-				name=cpp.checked(e.name), pname=utils.to_pascalcase(e.type.name))
-		impl += "{pname}_.emplace_back(std::move({name}));\n".format(name=cpp.checked(e.name), pname=utils.pluralize(e.type.name))
-		impl += "auto child_builder = {pname}_.back().get();\n".format(name=e.type.name, pname=utils.pluralize(e.type.name))
+		impl += "(void)builder;\n"
+		impl += "if({stub}_fill_.empty() || {stub}_fill_.back().next == {stub}_fill_.back().list.size())\n".format(stub=stub)
+		impl += "\tthrow std::runtime_error(\"add_{stub} was called more times than preallocate_{stub} allowed for.\");\n".format(stub=stub)
+		impl += "auto &fill = {stub}_fill_.back();\n".format(stub=stub)
+		impl += "auto child_builder = fill.list[fill.next++];\n"
 		impl += _gen_set_required_attrs(e)
+		if e.type in hash_cons_types:
+			impl += "%s.push_back(child_builder);\n" % _gen_canonical_name(e.type)
 		impl += "return child_builder;\n"
 		_add_field(_gen_builder(e.type), "add", e.name, cpp._gen_required_attribute_arg_list(_gen_builder(t), e.type.attrs, context="builder"), impl)
 
 		impl = ""
-		impl = "{pname}_.reserve(size);\n".format(pname=utils.pluralize(e.type.name))
-		_add_field("void", "preallocate", e.name, _gen_builder(t) + "&, size_t size", impl)
+		impl += "{stub}_fill_.push_back({{builder.init{pname}(static_cast<unsigned int>(size)), 0}});\n".format(
+				stub=stub, pname=utils.to_pascalcase(utils.pluralize(e.name)))
+		_add_field("void", "preallocate", e.name, _gen_builder(t) + " &builder, size_t size", impl)
 
-		_add_field("void", "finish", e.name, _gen_builder(e.type)+" &builder", _gen_finish(e))
+		_add_field("void", "finish", e.name, _gen_builder(e.type)+" &builder", _gen_finish(e.type, "builder"))
+
+	def _add_ref(e: UxsdElement):
+		"""A hash-consed subtree is copied from the struct it's equal to. A
+		repeated one takes the next element of its list, as add_* does."""
+		assert isinstance(e.type, UxsdComplex)
+		impl = ""
+		if e.many:
+			stub = cpp._gen_stub_suffix(e, t.name)
+			impl += "(void)builder;\n"
+			impl += "if({stub}_fill_.empty() || {stub}_fill_.back().next == {stub}_fill_.back().list.size())\n".format(stub=stub)
+			impl += "\tthrow std::runtime_error(\"ref_{stub} was called more times than preallocate_{stub} allowed for.\");\n".format(stub=stub)
+			impl += "auto &fill = {stub}_fill_.back();\n".format(stub=stub)
+			impl += "fill.list.setWithCaveats(fill.next++, {canonical}[canonical_id].asReader());\n".format(
+					canonical=_gen_canonical_name(e.type))
+		else:
+			impl += "builder.set{pname}({canonical}[canonical_id].asReader());\n".format(
+					pname=utils.to_pascalcase(e.name),
+					canonical=_gen_canonical_name(e.type))
+		_add_field("void", "ref", e.name, _gen_builder(t) + " &builder, size_t canonical_id", impl)
 
 	def _add_add(e: UxsdElement):
 		if isinstance(e.type, UxsdSimple): _add_add_simple(e)
@@ -672,15 +1746,42 @@ def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
 
 	def _add_get_simple(e: Union[UxsdElement, UxsdAttribute]):
 		impl = ""
-		impl += "return {value};\n".format(value=_gen_load_simple(
-			e.type,
+		impl += "return {value};\n".format(value=_gen_load_field(
+			e,
 			"reader.get{pname}()".format(
-				pname=utils.to_pascalcase(e.name))))
+				pname=utils.to_pascalcase(e.name)), "report_error", "strings_."))
 
 		_add_field(e.type.cpp, "get", e.name, _gen_reader(t) + " &reader", impl)
 
 	def _add_get_simple_many(e: UxsdElement):
-		_add_field(e.type.cpp, "get", e.name, "int n, {} &reader".format(_gen_reader(t)), "")
+		impl = ""
+		impl += "return {value};\n".format(value=_gen_load_simple(
+			e.type,
+			"reader.get{pname}()[n]".format(
+				pname=utils.to_pascalcase(utils.pluralize(e.name))), "report_error"))
+		_add_field(e.type.cpp, "get", e.name, "int n, {} &reader".format(_gen_reader(t)), impl)
+
+	def _add_bulk(e: UxsdElement):
+		"""Accessors for a whole list of repeated simple children at once, which
+		aren't part of the interface. get_*_all returns the list in the message.
+		For numbers, set_*_all copies an array into a new list. The builder of a
+		list doesn't expose its bytes, so the values are set one at a time."""
+		fmt = {"name": e.name,
+			"tname": t.name,
+			"elem": _gen_list_element_type(e.type),
+			"pname": utils.to_pascalcase(utils.pluralize(e.name)),
+			"reader": _gen_reader(t),
+			"builder": _gen_builder(t)}
+		impl = "return reader.get{pname}();\n".format(**fmt)
+		fields.append("inline ::capnp::List<{elem}>::Reader get_{tname}_{name}_all({reader} &reader) {{\n{impl}}}\n".format(
+			impl=utils.indent(impl), **fmt))
+		if not isinstance(e.type, UxsdNumber) or fmt["elem"] == "bool":
+			return
+		impl = ""
+		impl += "auto list = builder.init{pname}(static_cast<unsigned int>(values.size()));\n".format(**fmt)
+		impl += "for(unsigned int i = 0; i < values.size(); i++) list.set(i, values[i]);\n"
+		fields.append("inline void set_{tname}_{name}_all(kj::ArrayPtr<const {elem}> values, {builder} &builder) {{\n{impl}}}\n".format(
+			impl=utils.indent(impl), **fmt))
 
 	def _add_get_complex(e: UxsdElement):
 		impl = ""
@@ -722,11 +1823,14 @@ def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
 					_add_init(e)
 					_add_get_complex(e)
 					if e.optional: _add_has(e)
+				if e.type in hash_cons_types:
+					_add_ref(e)
 			elif isinstance(e.type, UxsdSimple):
 				if e.many:
 					_add_add_simple(e)
 					_add_num(e)
 					_add_get_simple_many(e)
+					_add_bulk(e)
 				else:
 					_add_set(e)
 					_add_get_simple(e)
@@ -740,7 +1844,7 @@ def _gen_capnp_impl(t: UxsdComplex, is_root : bool) -> str:
 
 		impl = ""
 		impl += "return {value};\n".format(value=_gen_load_simple(
-			t.content.type, "reader.getValue()"))
+			t.content.type, "reader.getValue()", "report_error"))
 		_add_field(t.content.type.cpp, "get", "value", _gen_reader(t) + " &reader", impl)
 
 	return '\n'.join(fields)
@@ -752,8 +1856,14 @@ def render_impl_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: s
 		"input_file": input_file,
 		"md5": utils.md5(input_file)}
 	out += cpp_templates.header_comment.substitute(x)
+	out += '#include <algorithm>\n'
+	out += '#include <cstring>\n'
+	out += '#include <deque>\n'
 	out += '#include <stdexcept>\n'
+	out += '#include <unordered_map>\n'
 	out += '#include <vector>\n'
+	out += '#include "capnp/any.h"\n'
+	out += '#include "capnp/message.h"\n'
 	out += '#include "capnp/serialize.h"\n'
 	out += '#include "{}.h"\n'.format(capnp_file_name)
 	out += '#include "{}"\n'.format(interface_file_name)
@@ -761,9 +1871,10 @@ def render_impl_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: s
 	out += "namespace uxsd {\n"
 
 	if schema.enums:
-		enum_converters = [_gen_conv_enum(t) for t in schema.enums]
-		out += "\n\n/* Enum conversions from uxsd to ucap */\n"
-		out += "\n".join(enum_converters)
+		out += _gen_enum_converters(schema)
+	strings = _uses_strings(schema.root_element.type)
+	if strings:
+		out += capnp_strings_defn
 
 	pname = utils.to_pascalcase(schema.root_element.name)
 	out += "struct Capnp{pname}ContextTypes : public Default{pname}ContextTypes {{\n\t".format(pname=pname)
@@ -778,10 +1889,44 @@ def render_impl_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: s
 	out += "public:\n"
 	out += "\tCapnp{pname}() {{}}\n\n".format(pname=pname)
 
+	out += "\t/**\n"
+	out += "\t * A size for the first segment of the MallocMessageBuilder a document of\n"
+	out += "\t * input_bytes is loaded into, so that the message is built in one segment.\n"
+	out += "\t * Messages are smaller than their XML, and MallocMessageBuilder allocates\n"
+	out += "\t * segments zeroed, so the pages of the overestimate aren't touched.\n"
+	out += "\t */\n"
+	out += "\tstatic unsigned int first_segment_words(size_t input_bytes) {\n"
+	out += "\t\tsize_t words = input_bytes / sizeof(::capnp::word);\n"
+	out += "\t\treturn static_cast<unsigned int>(std::max<size_t>(::capnp::SUGGESTED_FIRST_SEGMENT_WORDS, std::min<size_t>(words, 1u << 29)));\n"
+	out += "\t}\n"
+	out += "\n"
+	if strings:
+		out += "\t/**\n"
+		out += "\t * Interned strings are collected while a document is loaded into a message,\n"
+		out += "\t * and write_strings writes them into its root afterwards. Before a message\n"
+		out += "\t * is read with the get_* callbacks, read_strings reads them from its root.\n"
+		out += "\t */\n"
+		out += "\tvoid write_strings(ucap::{pname}::Builder &root) {{\n".format(pname=pname)
+		out += "\t\tstring_table_.write(root.initStrings(string_table_.pending()));\n"
+		out += "\t}\n"
+		out += "\tvoid read_strings(const ucap::{pname}::Reader &root) {{\n".format(pname=pname)
+		out += "\t\tstrings_.clear();\n"
+		out += "\t\tstrings_.add(root.getStrings());\n"
+		out += "\t}\n"
+		out += "\n"
 	out += "\tvoid start_load(const std::function<void(const char *)> *report_error_in) override {\n"
 	out += "\t\treport_error = report_error_in;\n"
+	if strings:
+		out += "\t\tstring_table_.clear();\n"
+	for t in schema.complex_types:
+		if isinstance(t.content, (UxsdDfa, UxsdAll)):
+			for el in t.content.children:
+				if el.many:
+					out += "\t\t%s_fill_.clear();\n" % cpp._gen_stub_suffix(el, t.name)
+	out += "\t}\n"
+	out += "\tvoid finish_load() override {\n"
+	out += utils.indent(_gen_finish(schema.root_element.type), 2)
 	out += "\t}\n"
-	out += "\tvoid finish_load() override {}\n"
 	out += "\tvoid start_write() override {}\n"
 	out += "\tvoid finish_write() override {}\n"
 	out += "\tvoid error_encountered(const char * file, int line, const char *message) override {\n"
@@ -790,18 +1935,38 @@ def render_impl_header_file(schema: UxsdSchema, cmdline: str, capnp_file_name: s
 	out += "\t\tthrow std::runtime_error(msg.str());\n"
 	out += "\t}\n"
 
+	# load_*_xml hash-conses subtrees with IDs too if it's generated without --ids.
+	hash_cons_types = cpp._collect_subtree_types(schema)
 	for t in schema.complex_types:
-		out += utils.indent(_gen_capnp_impl(t, t.name == schema.root_element.name))
+		out += utils.indent(_gen_capnp_impl(t, t.name == schema.root_element.name, hash_cons_types))
 	out += "private:\n"
 	out += "\tconst std::function<void(const char *)> *report_error;\n"
-
+	if strings:
+		out += "\tCapnpStringTable string_table_;\n"
+		out += "\tCapnpStrings strings_;\n"
+	out += "\n"
+	out += "\t/* A list which is being filled by add_* calls, and the index of its next element. */\n"
+	out += "\ttemplate<typename T>\n"
+	out += "\tstruct ListFill {\n"
+	out += "\t\ttypename ::capnp::List<T>::Builder list;\n"
+	out += "\t\tunsigned int next;\n"
+	out += "\t};\n"
+	out += "\t/* The lists of repeated children of the open elements, innermost last. */\n"
 	for t in schema.complex_types:
 		if isinstance(t.content, (UxsdDfa, UxsdAll)):
 			for el in t.content.children:
-				if el.many:
-					out += "\tstd::vector<capnp::Orphan<ucap::{pname}>> {name}_;\n".format(
+				if el.many and isinstance(el.type, UxsdComplex):
+					out += "\tstd::vector<ListFill<ucap::{pname}>> {stub}_fill_;\n".format(
 							pname=utils.to_pascalcase(el.type.name),
-							name=utils.pluralize(el.type.name))
+							stub=cpp._gen_stub_suffix(el, t.name))
+				elif el.many:
+					out += "\tstd::vector<ListFill<{elem}>> {stub}_fill_;\n".format(
+							elem=_gen_list_element_type(el.type),
+							stub=cpp._gen_stub_suffix(el, t.name))
+	if hash_cons_types:
+		out += "\t/* The structs made by init_* or add_* during a load, by type. ref_* copies them. */\n"
+	for t in hash_cons_types:
+		out += "\tstd::vector<ucap::%s::Builder> %s;\n" % (utils.to_pascalcase(t.name), _gen_canonical_name(t))
 	out += "};\n"
 
 
@@ -1,4 +1,6 @@
-from typing import Union, List
+import re
+
+from typing import AbstractSet, Union, List, Optional, Set, Tuple
 
 from . import cpp_templates, utils
 from .utils import checked
@@ -14,10 +16,30 @@ from .schema import (
 	UxsdEnum,
 	UxsdSimple,
 	UxsdString,
+	UxsdUnion,
+	UxsdId,
+	UxsdIdRef,
 	UxsdAtomic,
 	UxsdAttribute,
 )
 
+# Optional parts of foo_uxsdcxx.h, each generated only with uxsdcxx.py --<feature>,
+# so that the header includes and defines only what is used. The values are the
+# help texts of the flags.
+FEATURES = {
+	"arena": "generate XmlArena, a reusable allocator for the PugiXML DOM of load_*_xml",
+	"dom": "generate DomFoo, an implementation of the interface over a PugiXML DOM",
+	"hash-cons": "load_*_xml can pass repeated identical subtrees to the ref_* callbacks",
+	"ids": "index xs:IDs and resolve xs:IDREFs to the resolve_* callbacks on load",
+	"cache": "generate load_*_cached, which keeps a binary snapshot next to the XML file",
+	"batch": "generate load_*_xml_batch, which loads many files on a thread pool (implies --arena)",
+	"progress": "load_*_xml and write_*_xml can report their progress to a ProgressReporter",
+	"decompress": "load_*_xml reads gzip and zstd compressed XML, with -DUXSD_ZLIB and -DUXSD_ZSTD",
+	"simd-escape": "XmlWriter scans string values for bytes to escape with SSE2 or AVX2",
+	"parallel-write": "write_*_xml can write large documents on several threads",
+	"push": "generate PushFoo, a writer driven by begin_*, set_* and end_* calls",
+}
+
 def pass_at_init(attr: UxsdAttribute):
 	if attr.optional:
 		return False
@@ -49,8 +71,12 @@ def _gen_context_type(t: UxsdComplex, direction : str) -> str:
 	return "typename ContextTypes::{}{}Context".format(utils.to_pascalcase(t.name), direction)
 
 
-def _gen_virtual_fns(t: UxsdComplex) -> str:
-	"""Generate virtual functions to interface with an element with a complex type."""
+def _gen_virtual_fns(t: UxsdComplex, id_types: List[UxsdComplex], top_level: bool = False) -> str:
+	"""Generate virtual functions to interface with an element with a complex type.
+
+	If top_level is set, repeated complex children also get the range callbacks
+	of parallel capnp loads.
+	"""
 	fields = []
 	def _add_field(ret: str, verb: str, what: str, args: str):
 		fields.append("virtual inline %s %s_%s_%s(%s) = 0;" % (ret, verb, t.name, what, args))
@@ -62,12 +88,32 @@ def _gen_virtual_fns(t: UxsdComplex) -> str:
 		_add_field(_gen_context_type(e.type, "Write"), "init", e.name, _gen_required_attribute_arg_list(_gen_context_type(t, "Write"), e.type.attrs))
 		_add_field("void", "finish", e.name, _gen_context_type(e.type, "Write") + " &ctx")
 	def _add_add_simple(e: UxsdElement):
-		_add_field("void", "add", e.name, "{} {}, {} &ctx" % (e.type.cpp, checked(e.name), _gen_context_type(t, "Write")))
+		_add_field("void", "preallocate", e.name, _gen_context_type(t, "Write") + " &ctx, size_t size")
+		_add_field("void", "add", e.name, "{}, {} &ctx".format(_gen_attribute_arg(e), _gen_context_type(t, "Write")))
 	def _add_add_complex(e: UxsdElement):
 		assert isinstance(e.type, UxsdComplex)
 		_add_field("void", "preallocate", e.name, _gen_context_type(t, "Write") + " &ctx, size_t size")
 		_add_field(_gen_context_type(e.type, "Write"), "add", e.name, _gen_required_attribute_arg_list(_gen_context_type(t, "Write"), e.type.attrs))
 		_add_field("void", "finish", e.name, _gen_context_type(e.type, "Write") + " &ctx")
+	def _add_ref(e: UxsdElement):
+		assert isinstance(e.type, UxsdComplex)
+		# Not pure, so that implementations which don't support hash-consing needn't change.
+		fields.append("virtual inline void ref_{stub}({ctx} &ctx, size_t canonical_id){{\n"
+			"\t(void)ctx;\n"
+			"\t(void)canonical_id;\n"
+			"\tthrow std::runtime_error(\"ref_{stub} is not implemented.\");\n"
+			"}}".format(stub=_gen_stub_suffix(e, t.name), ctx=_gen_context_type(t, "Write")))
+	def _add_resolve(a: UxsdAttribute):
+		# IDREFs aren't typed, so there's a callback for every type with an ID.
+		# They do nothing by default, since the IDREF was already passed to set_*.
+		for x in id_types:
+			fields.append("virtual inline void resolve_{stub}_to_{target}({ctx} &ctx, {target_ctx} &target){{\n"
+				"\t(void)ctx;\n"
+				"\t(void)target;\n"
+				"}}".format(stub=_gen_stub_suffix(a, t.name),
+					target=x.name,
+					ctx=_gen_context_type(t, "Write"),
+					target_ctx=_gen_context_type(x, "Write")))
 	def _add_add(e: UxsdElement):
 		if isinstance(e.type, UxsdSimple): _add_add_simple(e)
 		elif isinstance(e.type, UxsdComplex): _add_add_complex(e)
@@ -76,20 +122,61 @@ def _gen_virtual_fns(t: UxsdComplex) -> str:
 	def _add_get_simple(e: Union[UxsdElement, UxsdAttribute]):
 		_add_field(e.type.cpp, "get", e.name, _gen_context_type(t, "Read") + " &ctx")
 	def _add_get_simple_many(e: UxsdElement):
-		_add_field(e.type.cpp, "get", e.name, _gen_context_type(t, "Read") + " &ctx")
+		_add_field(e.type.cpp, "get", e.name, "int n, {}".format(_gen_context_type(t, "Read") + " &ctx"))
 	def _add_get_complex(e: UxsdElement):
 		_add_field(_gen_context_type(e.type, "Read"), "get", e.name, _gen_context_type(t, "Read") + " &ctx")
 	def _add_get_complex_many(e: UxsdElement):
 		_add_field(_gen_context_type(e.type, "Read"), "get", e.name, "int n, {}".format(_gen_context_type(t, "Read") + " &ctx"))
 	def _add_num(e: UxsdElement):
 		_add_field("size_t", "num", e.name, _gen_context_type(t, "Read") + " &ctx")
+	def _add_cursor(e: UxsdElement):
+		# The writers iterate over repeated children with begin_* and next_*. By default,
+		# they index with num_* and get_*, and implementations over linked or generated
+		# data can override them to walk the children instead.
+		assert isinstance(e.type, UxsdComplex)
+		fmt = {"stub": _gen_stub_suffix(e, t.name),
+			"ctx": _gen_context_type(t, "Read"),
+			"child_ctx": _gen_context_type(e.type, "Read")}
+		fields.append("virtual inline bool begin_{stub}({ctx} &ctx, WriteCursor<{child_ctx}> &cursor){{\n"
+			"\tcursor.index = 0;\n"
+			"\tcursor.size = num_{stub}(ctx);\n"
+			"\tif(cursor.size == 0) return false;\n"
+			"\tcursor.value = get_{stub}(0, ctx);\n"
+			"\treturn true;\n"
+			"}}".format(**fmt))
+		fields.append("virtual inline bool next_{stub}({ctx} &ctx, WriteCursor<{child_ctx}> &cursor){{\n"
+			"\tif(++cursor.index >= cursor.size) return false;\n"
+			"\tcursor.value = get_{stub}((int)cursor.index, ctx);\n"
+			"\treturn true;\n"
+			"}}".format(**fmt))
 	def _add_has(e: UxsdElement):
 		_add_field("bool", "has", e.name, _gen_context_type(t, "Read") + " &ctx")
+	def _add_range(e: UxsdElement):
+		# A parallel capnp load gives every range of the children a context of its own,
+		# which add_* is called with, and merges them in order. Not pure, so that
+		# implementations which only load serially needn't change.
+		fmt = {"stub": _gen_stub_suffix(e, t.name),
+			"ctx": _gen_context_type(t, "Write")}
+		fields.append("virtual inline {ctx} start_range_{stub}({ctx} &ctx, size_t begin, size_t end){{\n"
+			"\t(void)ctx;\n"
+			"\t(void)begin;\n"
+			"\t(void)end;\n"
+			"\tthrow std::runtime_error(\"start_range_{stub} is not implemented.\");\n"
+			"}}".format(**fmt))
+		fields.append("virtual inline void merge_range_{stub}({ctx} &ctx, {ctx} &range_ctx, size_t begin, size_t end){{\n"
+			"\t(void)ctx;\n"
+			"\t(void)range_ctx;\n"
+			"\t(void)begin;\n"
+			"\t(void)end;\n"
+			"\tthrow std::runtime_error(\"merge_range_{stub} is not implemented.\");\n"
+			"}}".format(**fmt))
 
 	for attr in t.attrs:
 		_add_get_simple(attr)
 		if not pass_at_init(attr):
 			_add_set(attr)
+		if isinstance(attr.type, UxsdIdRef):
+			_add_resolve(attr)
 
 	if isinstance(t.content, (UxsdDfa, UxsdAll)):
 		for e in t.content.children:
@@ -98,10 +185,13 @@ def _gen_virtual_fns(t: UxsdComplex) -> str:
 					_add_add_complex(e)
 					_add_num(e)
 					_add_get_complex_many(e)
+					_add_cursor(e)
+					if top_level: _add_range(e)
 				else:
 					_add_init(e)
 					_add_get_complex(e)
 					if e.optional: _add_has(e)
+				_add_ref(e)
 			elif isinstance(e.type, UxsdSimple):
 				if e.many:
 					_add_add_simple(e)
@@ -145,7 +235,7 @@ def gen_base_class(schema: UxsdSchema) -> str:
 	out += "\tvirtual void finish_write() = 0;\n"
 	out += "\tvirtual void error_encountered(const char * file, int line, const char *message) = 0;\n"
 
-	virtual_fns = [_gen_virtual_fns(x) for x in schema.complex_types]
+	virtual_fns = [_gen_virtual_fns(x, schema.id_types, x in schema.top_level_types) for x in schema.complex_types]
 	out += utils.indent("\n\n".join(virtual_fns))
 	out += "\n};\n"
 	return out
@@ -157,7 +247,11 @@ def tokens_from_enum(t: UxsdEnum) -> str:
 	out = "\n"
 	enum_tokens = ["UXSD_INVALID = 0"]
 	enum_tokens += [utils.to_token(x) for x in t.enumeration]
-	out += "enum class %s {%s};" % (t.cpp, ", ".join(enum_tokens))
+	# Keep enums to a byte where possible, so that they pack well in structs.
+	if len(enum_tokens) <= 256:
+		out += "enum class %s : uint8_t {%s};" % (t.cpp, ", ".join(enum_tokens))
+	else:
+		out += "enum class %s {%s};" % (t.cpp, ", ".join(enum_tokens))
 	return out
 
 def lookup_from_enum(t: UxsdEnum) -> str:
@@ -168,7 +262,20 @@ def lookup_from_enum(t: UxsdEnum) -> str:
 	out += "constexpr const char *lookup_%s[] = {%s};" % (t.name, ", ".join(lookup_tokens))
 	return out
 
-def lexer_from_enum(t: UxsdEnum) -> str:
+def _gen_instrument_scope(name: str) -> str:
+	"""Generate the start of an instrumented function body. See cpp_templates.instrument_defn."""
+	out = ""
+	out += "static thread_local InstrumentCounter instrument_counter(\"%s\");\n" % name
+	out += "InstrumentScope instrument_scope(instrument_counter);\n"
+	return out
+
+def _gen_callback(call: str, name: str, instrument: bool) -> str:
+	"""Wrap a call to the implementation in an instrumented lambda if instrumenting."""
+	if not instrument:
+		return call
+	return "[&]{ static thread_local InstrumentCounter instrument_counter(\"%s\"); InstrumentScope instrument_scope(instrument_counter); return %s; }()" % (name, call)
+
+def lexer_from_enum(t: UxsdEnum, instrument: bool = False) -> str:
 	"""Generate a C++ function to convert const char *s to enum values generated
 	from an UxsdEnum.
 
@@ -181,6 +288,8 @@ def lexer_from_enum(t: UxsdEnum) -> str:
 	"""
 	out = ""
 	out += "inline %s lex_%s(const char *in, bool throw_on_invalid, const std::function<void(const char *)> * report_error){\n" % (t.cpp, t.cpp)
+	if instrument:
+		out += utils.indent(_gen_instrument_scope("lex_%s" % t.cpp))
 	triehash_alph = [(x, "%s::%s" % (t.cpp, utils.to_token(x))) for x in t.enumeration]
 	out += utils.indent(triehash.gen_lexer_body(triehash_alph))
 	out += "\tif(throw_on_invalid)\n"
@@ -206,7 +315,7 @@ def tokens_from_complex_type(t: UxsdComplex) -> str:
 		out += "constexpr const char *atok_lookup_%s[] = {%s};\n" % (t.cpp, ", ".join(lookup_tokens))
 	return out
 
-def lexer_from_complex_type(t: UxsdComplex) -> str:
+def lexer_from_complex_type(t: UxsdComplex, instrument: bool = False) -> str:
 	"""Generate one or two C++ functions to convert const char *s to enum values
 	generated from an UxsdComplex.
 
@@ -217,12 +326,16 @@ def lexer_from_complex_type(t: UxsdComplex) -> str:
 	out = ""
 	if isinstance(t.content, (UxsdDfa, UxsdAll)):
 		out += "inline gtok_%s lex_node_%s(const char *in, const std::function<void(const char *)> *report_error){\n" % (t.cpp, t.cpp)
+		if instrument:
+			out += utils.indent(_gen_instrument_scope("lex_node_%s" % t.cpp))
 		triehash_alph = [(e.name, "gtok_%s::%s" % (t.cpp, utils.to_token(e.name))) for e in t.content.children]
 		out += utils.indent(triehash.gen_lexer_body(triehash_alph))
 		out += "\tnoreturn_report(report_error, (\"Found unrecognized child \" + std::string(in) + \" of <%s>.\").c_str());\n" % t.name
 		out += "}\n"
 	if t.attrs:
 		out += "inline atok_%s lex_attr_%s(const char *in, const std::function<void(const char *)> * report_error){\n" % (t.cpp, t.cpp)
+		if instrument:
+			out += utils.indent(_gen_instrument_scope("lex_attr_%s" % t.cpp))
 		triehash_alph = [(x.name, "atok_%s::%s" % (t.cpp, utils.to_token(x.name))) for x in t.attrs]
 		out += utils.indent(triehash.gen_lexer_body(triehash_alph))
 		out += "\tnoreturn_report(report_error, (\"Found unrecognized attribute \" + std::string(in) + \" of <%s>.\").c_str());\n" % t.name
@@ -242,6 +355,10 @@ def _gen_dfa_table(t: UxsdComplex) -> str:
 	out = ""
 	out += "constexpr int NUM_%s_STATES = %d;\n" % (t.cpp.upper(), len(dfa.states))
 	out += "constexpr const int NUM_%s_INPUTS = %d;\n" % (t.cpp.upper(), len(dfa.alphabet))
+	# The states are numbered differently on every run, so code generated
+	# separately from this table refers to them with these.
+	out += "constexpr int START_%s_STATE = %d;\n" % (t.cpp.upper(), dfa.start)
+	out += "constexpr bool gstate_accepts_%s(int state){ return %s; }\n" % (t.cpp, " || ".join(["state == %d" % x for x in dfa.accepts]))
 	out += "constexpr int gstate_%s[NUM_%s_STATES][NUM_%s_INPUTS] = {\n" % (t.cpp, t.cpp.upper(), t.cpp.upper())
 	for i in range(0, max(dfa.states)+1):
 		state = dfa.transitions[i]
@@ -261,9 +378,9 @@ def _gen_load_simple(t: UxsdSimple, input: str) -> str:
 	else:
 		return "load_%s(%s, report_error)" % (utils.to_snakecase(t.cpp), input)
 
-def _gen_load_element_complex(t: UxsdElement, parent: str) -> str:
+def _gen_load_element_complex(t: UxsdElement, parent: str, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	assert isinstance(t.type, UxsdComplex)
-	out = "{\n"
+	out = ""
 
 	args = ["context"]
 	load_args = []
@@ -273,44 +390,83 @@ def _gen_load_element_complex(t: UxsdElement, parent: str) -> str:
 			continue
 
 		arg = "%s_%s" % (t.type.name, checked(attr.name))
-		out += "\t%s %s;\n" % (attr.type.cpp, arg)
-		out += "\tmemset(&{name}, 0, sizeof({name}));\n".format(name=arg)
+		out += "%s %s;\n" % (attr.type.cpp, arg)
+		out += "memset(&{name}, 0, sizeof({name}));\n".format(name=arg)
 		args.append(arg)
 		load_args.append('&' + arg)
 
 	if len(load_args) > 0:
-		out += "\tload_%s_required_attributes(node, %s, report_error);\n" % (t.type.name, ', '.join(load_args))
-	if t.many:
-		out += "\tauto child_context = out.add_%s(%s);\n" % (_gen_stub_suffix(t, parent), ', '.join(args))
-	else:
-		out += "\tauto child_context = out.init_%s(%s);\n" % (_gen_stub_suffix(t, parent), ', '.join(args))
-	out += "\tload_%s(node, out, child_context, report_error, offset_debug);\n" % t.type.name
-	out += "\tout.finish_%s(child_context);\n" % _gen_stub_suffix(t, parent)
+		out += "load_%s_required_attributes(node, %s, report_error);\n" % (t.type.name, ', '.join(load_args))
+	verb = "add" if t.many else "init"
+	call = "out.%s_%s(%s)" % (verb, _gen_stub_suffix(t, parent), ', '.join(args))
+	out += "auto child_context = %s;\n" % _gen_callback(call, "%s_%s" % (verb, _gen_stub_suffix(t, parent)), instrument)
+	out += "load_%s(node, out, child_context, report_error, offset_debug, load_state);\n" % t.type.name
+	call = "out.finish_%s(child_context)" % _gen_stub_suffix(t, parent)
+	out += "%s;\n" % _gen_callback(call, "finish_%s" % _gen_stub_suffix(t, parent), instrument)
+	load = out
+
+	# Subtrees with IDs or IDREFs are always loaded, so that all of them are
+	# indexed and resolved.
+	if "hash-cons" not in features or ("ids" in features and _subtree_has_ids(t.type)):
+		return "{\n%s}\n" % utils.indent(load)
+
+	# If hash-consing, pass subtrees equal to an already loaded one to ref_*.
+	table = "load_state->%s_subtrees" % t.type.name
+	out = "{\n"
+	out += "\tptrdiff_t canonical_id = -1;\n"
+	out += "\tif(load_state->hash_cons) canonical_id = %s.find(*load_state->hash_cons, node);\n" % table
+	out += "\tif(canonical_id >= 0){\n"
+	call = "out.ref_%s(context, canonical_id)" % _gen_stub_suffix(t, parent)
+	out += "\t\t%s;\n" % _gen_callback(call, "ref_%s" % _gen_stub_suffix(t, parent), instrument)
+	out += "\t}else{\n"
+	out += "\t\tif(load_state->hash_cons) %s.insert(*load_state->hash_cons, node);\n" % table
+	out += utils.indent(load, 2)
+	out += "\t}\n"
 	out += "}\n"
 	return out
 
-def _gen_load_element_simple(t: UxsdElement, parent: str) -> str:
+def _gen_load_element_simple(t: UxsdElement, parent: str, instrument: bool = False) -> str:
 	assert isinstance(t.type, UxsdSimple)
-	out = ""
-	if t.many:
-		out += "out.add_%s(%s, context);\n" % (_gen_stub_suffix(t, parent), _gen_load_simple(t.type, "node.child_value()"))
-	else:
-		out += "out.set_%s(%s, context);\n" % (_gen_stub_suffix(t, parent), _gen_load_simple(t.type, "node.child_value()"))
-	return out
+	verb = "add" if t.many else "set"
+	call = "out.%s_%s(%s, context)" % (verb, _gen_stub_suffix(t, parent), _gen_load_simple(t.type, "node.child_value()"))
+	return "%s;\n" % _gen_callback(call, "%s_%s" % (verb, _gen_stub_suffix(t, parent)), instrument)
 
-def _gen_load_element(t: UxsdElement, parent: str) -> str:
+def _gen_load_element(t: UxsdElement, parent: str, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	if isinstance(t.type, UxsdComplex):
-		return _gen_load_element_complex(t, parent)
+		return _gen_load_element_complex(t, parent, instrument, features)
 	else:
-		return _gen_load_element_simple(t, parent)
+		return _gen_load_element_simple(t, parent, instrument)
 
-def _gen_load_attr(t: UxsdAttribute, parent: str) -> str:
+def _gen_index_attr(t: UxsdAttribute, parent: str, value: str) -> str:
+	"""Generate the code adding an ID or IDREF attribute with the given value to the load state."""
+	out = ""
+	if isinstance(t.type, UxsdId):
+		out += "if(!load_state->ids.insert(%s, (int)id_type::%s, load_state->%s_ids.size()) && load_state->strict_ids)\n" % (value, utils.to_token(parent), parent)
+		out += "\tnoreturn_report(report_error, (\"Duplicate ID `\" + std::string(%s) + \"`.\").c_str());\n" % value
+		out += "load_state->%s_ids.push_back(context);\n" % parent
+	elif isinstance(t.type, UxsdIdRef):
+		out += "load_state->ids.add_ref(%s, (int)idref_attr::%s, load_state->%s_referrers.size(), *offset_debug);\n" % (value, utils.to_token(_gen_stub_suffix(t, parent)), parent)
+		out += "load_state->%s_referrers.push_back(context);\n" % parent
+	return out
+
+def _gen_load_attr(t: UxsdAttribute, parent: str, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	if not pass_at_init(t):
-		return "out.set_%s(%s, context);\n" % (_gen_stub_suffix(t, parent), _gen_load_simple(t.type, "attr.value()"))
+		call = "out.set_%s(%s, context)" % (_gen_stub_suffix(t, parent), _gen_load_simple(t.type, "attr.value()"))
+		out = "%s;\n" % _gen_callback(call, "set_%s" % _gen_stub_suffix(t, parent), instrument)
+		if "ids" in features:
+			out += _gen_index_attr(t, parent, "attr.value()")
+		return out
 	else:
 		return "/* Attribute %s is already set */\n" % t.name
 
-def _gen_load_dfa(t: UxsdComplex) -> str:
+def _gen_progress_tick(e: UxsdElement, records: str, bytes: str, reporter: str = "progress") -> str:
+	"""Generate a call counting a record of a top-level repeated element to a ProgressReporter."""
+	out = ""
+	out += "if(%s && %s->tick(\"%s\", %s))\n" % (reporter, reporter, e.name, records)
+	out += "\t%s->report(%s);\n" % (reporter, bytes)
+	return out
+
+def _gen_load_dfa(t: UxsdComplex, progress: bool = False, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Partial function to generate the child element validation&loading portion
 	of a C++ function load_foo, if the model group is an xs:sequence or xs:choice.
 
@@ -321,6 +477,8 @@ def _gen_load_dfa(t: UxsdComplex) -> str:
 	The C++ table has -1s in place of invalid state transitions. If we step into a -1,
 	we call dfa_error. We check again at the end of input. If we aren't in an accepted
 	state, we again call dfa_error.
+
+	If progress is set, repeated children are counted to load_state->progress.
 	"""
 	assert isinstance(t.content, UxsdDfa)
 	dfa = t.content.dfa
@@ -359,13 +517,19 @@ def _gen_load_dfa(t: UxsdComplex) -> str:
 
 		for el in t.content.children:
 			if el.many:
-				out += "\tout.preallocate_{stub}(context, {tag}_count);\n".format(
+				call = "out.preallocate_{stub}(context, {tag}_count)".format(
 						stub=_gen_stub_suffix(el, t.name),
 						tag=el.name
 						)
+				out += "\t%s;\n" % _gen_callback(call, "preallocate_%s" % _gen_stub_suffix(el, t.name), instrument)
 
 		out += "}\n"
 
+	if progress:
+		for el in t.content.children:
+			if el.many:
+				out += "size_t {tag}_records = 0;\n".format(tag=el.name)
+
 	out += "int next, state=%d;\n" % dfa.start
 	out += "for(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
 	out += "\t*offset_debug = node.offset_debug();\n"
@@ -379,7 +543,9 @@ def _gen_load_dfa(t: UxsdComplex) -> str:
 	out += "\tswitch(in){\n";
 	for el in t.content.children:
 		out += "\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(el.name))
-		out += utils.indent(_gen_load_element(el, t.name), 2)
+		out += utils.indent(_gen_load_element(el, t.name, instrument, features), 2)
+		if progress and el.many:
+			out += utils.indent(_gen_progress_tick(el, "++%s_records" % el.name, "*offset_debug", "load_state->progress"), 2)
 		out += "\t\tbreak;\n"
 	out += "\tdefault: break; /* Not possible. */\n"
 	out += "\t}\n";
@@ -391,7 +557,7 @@ def _gen_load_dfa(t: UxsdComplex) -> str:
 
 	return out
 
-def _gen_load_all(t: UxsdComplex) -> str:
+def _gen_load_all(t: UxsdComplex, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Partial function to generate the child element validation&loading portion
 	of a C++ function load_foo, if the model group is an xs:all.
 
@@ -415,7 +581,7 @@ def _gen_load_all(t: UxsdComplex) -> str:
 	out += "\tswitch(in){\n";
 	for el in t.content.children:
 		out += "\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(el.name))
-		out += utils.indent(_gen_load_element(el, t.name), 2)
+		out += utils.indent(_gen_load_element(el, t.name, instrument, features), 2)
 		out += "\t\tbreak;\n"
 	out += "\tdefault: break; /* Not possible. */\n"
 	out += "\t}\n";
@@ -459,7 +625,7 @@ def _gen_load_required_attrs(t: UxsdComplex) -> str:
 	return out
 
 
-def _gen_load_attrs(t: UxsdComplex) -> str:
+def _gen_load_attrs(t: UxsdComplex, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Partial function to generate the attribute loading portion of a C++
 	function load_foo. See _gen_load_all to see how attributes are validated.
 	"""
@@ -481,7 +647,7 @@ def _gen_load_attrs(t: UxsdComplex) -> str:
 	out += "\tswitch(in){\n";
 	for attr in t.attrs:
 		out += "\tcase atok_%s::%s:\n" % (t.cpp, utils.to_token(attr.name))
-		out += utils.indent(_gen_load_attr(attr, t.name), 2)
+		out += utils.indent(_gen_load_attr(attr, t.name, instrument, features), 2)
 		out += "\t\tbreak;\n"
 	out += "\tdefault: break; /* Not possible. */\n"
 	out += "\t}\n";
@@ -489,36 +655,47 @@ def _gen_load_attrs(t: UxsdComplex) -> str:
 
 	return out
 
-def load_required_attrs_fn_from_complex_type(t: UxsdComplex) -> str:
+def load_required_attrs_fn_from_complex_type(t: UxsdComplex, instrument: bool = False) -> str:
 	"""Generate a full C++ function load_foo(&root, &out)
 	which can load an XSD complex type from DOM &root into C++ object out.
 	"""
 	out = ""
 	out += "inline void load_%s_required_attributes(const pugi::xml_node &root, %s, const std::function<void(const char *)> * report_error){\n" % (
 			t.name, _gen_required_attribute_arg_list("", t.attrs, out=True))
+	if instrument:
+		out += utils.indent(_gen_instrument_scope("load_%s_required_attributes" % t.name))
 
 	out += utils.indent(_gen_load_required_attrs(t))
 
 	out += "}\n"
 	return out
 
-def load_fn_from_complex_type(t: UxsdComplex) -> str:
+def load_fn_from_complex_type(t: UxsdComplex, progress: bool = False, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Generate a full C++ function load_foo(&root, &out)
 	which can load an XSD complex type from DOM &root into C++ object out.
+
+	If instrument is set, the bytes of an element are counted from its start
+	to the start of its next sibling, or to the last node loaded if it's the
+	last child.
 	"""
 	out = ""
-	out += "template<class T, typename Context>\n"
-	out += "inline void load_%s(const pugi::xml_node &root, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug){\n" % t.name
+	out += "template<class T, typename Context, typename LoadState>\n"
+	out += "inline void load_%s(const pugi::xml_node &root, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug, LoadState *load_state){\n" % t.name
 
 	out += "\t(void)root;\n"
 	out += "\t(void)out;\n"
 	out += "\t(void)context;\n"
 	out += "\t(void)report_error;\n"
+	out += "\t(void)load_state;\n"
+	if instrument:
+		out += utils.indent(_gen_instrument_scope("load_%s" % t.name))
 	out += "\t// Update current file offset in case an error is encountered.\n"
 	out += "\t*offset_debug = root.offset_debug();\n"
+	if instrument:
+		out += "\tptrdiff_t instrument_offset = *offset_debug;\n"
 	out += "\n"
 	if t.attrs:
-		out += utils.indent(_gen_load_attrs(t))
+		out += utils.indent(_gen_load_attrs(t, instrument, features))
 	else:
 		out += "\tif(root.first_attribute())\n"
 		out += "\t\tnoreturn_report(report_error, \"Unexpected attribute in <%s>.\");\n" % t.name
@@ -526,16 +703,20 @@ def load_fn_from_complex_type(t: UxsdComplex) -> str:
 
 	if isinstance(t.content, UxsdDfa):
 		out = _gen_dfa_table(t) + out
-		out += utils.indent(_gen_load_dfa(t))
+		out += utils.indent(_gen_load_dfa(t, progress, instrument, features))
 	elif isinstance(t.content, UxsdAll):
-		out += utils.indent(_gen_load_all(t))
+		out += utils.indent(_gen_load_all(t, instrument, features))
 	elif isinstance(t.content, UxsdLeaf):
-		out += "\tout.set_%s_value(%s, context);\n" % (t.name, _gen_load_simple(t.content.type, "root.child_value()"))
+		call = "out.set_%s_value(%s, context)" % (t.name, _gen_load_simple(t.content.type, "root.child_value()"))
+		out += "\t%s;\n" % _gen_callback(call, "set_%s_value" % t.name, instrument)
 
 	if not isinstance(t.content, (UxsdDfa, UxsdAll)):
 		out += "\tif(root.first_child().type() == pugi::node_element)\n"
 		out += "\t\tnoreturn_report(report_error, \"Unexpected child element in <%s>.\");\n" % t.name
 	out += "\n"
+	if instrument:
+		out += "\tpugi::xml_node instrument_next = root.next_sibling();\n"
+		out += "\tinstrument_scope.add_bytes((instrument_next ? instrument_next.offset_debug() : *offset_debug) - instrument_offset);\n"
 
 	out += "}\n"
 	return out
@@ -545,12 +726,14 @@ def load_fn_from_complex_type(t: UxsdComplex) -> str:
 # See https://stackoverflow.com/questions/26080829/detecting-strtol-failure
 # Since detecting additional characters require some other hoops which would
 # hurt performance, we only check errno.
-def load_fn_from_simple_type(t: UxsdSimple) -> str:
+def load_fn_from_simple_type(t: UxsdSimple, instrument: bool = False) -> str:
 	"""Generate a full C++ function load_foo(str)
 	which can load an XSD simple type from str and return it.
 	"""
 	out = ""
 	out += "inline %s load_%s(const char *in, const std::function<void(const char *)> * report_error){\n" % (t.cpp, utils.to_snakecase(t.cpp))
+	if instrument:
+		out += utils.indent(_gen_instrument_scope("load_%s" % utils.to_snakecase(t.cpp)))
 	out += "\t%s out;\n" % t.cpp
 	if isinstance(t, UxsdAtomic):
 		out += "\tout = %s;\n" % (t.cpp_load_format % "in")
@@ -566,29 +749,519 @@ def load_fn_from_simple_type(t: UxsdSimple) -> str:
 
 #
 
-def load_fn_from_root_element(e: UxsdElement) -> str:
+def _collect_subtree_types(schema: UxsdSchema) -> List[UxsdComplex]:
+	"""Find the complex types which occur as child elements, in schema order."""
+	out: List[UxsdComplex] = []
+	for t in schema.complex_types:
+		if isinstance(t.content, (UxsdDfa, UxsdAll)):
+			for e in t.content.children:
+				if isinstance(e.type, UxsdComplex) and e.type not in out:
+					out.append(e.type)
+	return out
+
+def _subtree_has_ids(t: UxsdComplex, visiting: Optional[Set[UxsdComplex]] = None) -> bool:
+	"""Whether an element of type t or its descendants can have xs:ID or
+	xs:IDREF attributes."""
+	if visiting is None: visiting = set()
+	if t in visiting: return False
+	visiting.add(t)
+	if any(isinstance(a.type, (UxsdId, UxsdIdRef)) for a in t.attrs): return True
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		return any(isinstance(e.type, UxsdComplex) and _subtree_has_ids(e.type, visiting) for e in t.content.children)
+	return False
+
+def _collect_hash_cons_types(schema: UxsdSchema, features: AbstractSet[str]) -> List[UxsdComplex]:
+	"""Find the complex types of child elements whose subtrees can be hash-consed."""
+	return [t for t in _collect_subtree_types(schema) if not ("ids" in features and _subtree_has_ids(t))]
+
+def _gen_load_state_type(e: UxsdElement) -> str:
+	return "%sLoadState" % utils.to_pascalcase(e.name)
+
+def gen_load_options(features: AbstractSet[str]) -> str:
+	"""Generate XmlLoadOptions, with the fields of the generated features."""
+	fields = []
+	if "arena" in features:
+		fields.append(("arena: Allocate the PugiXML DOM from this arena. See XmlArena.",
+			"XmlArena *arena = nullptr;"))
+	if "hash-cons" in features:
+		fields.append(("hash_cons: Load only the first copy of structurally identical subtrees of the\n"
+			"    same complex type. Later copies are passed to the ref_* callbacks with the\n"
+			"    canonical id of the first copy, which counts the subtrees of that type\n"
+			"    passed to init_* or add_* during this load, starting from 0.",
+			"bool hash_cons = false;"))
+	if "progress" in features:
+		fields.append(("progress: Report the progress of the load to this reporter. See ProgressReporter.",
+			"ProgressReporter *progress = nullptr;"))
+	if "ids" in features:
+		fields.append(("strict_ids: Report duplicate xs:IDs and dangling xs:IDREFs as errors. Otherwise,\n"
+			"    an IDREF resolves to the first element with its ID, and the resolve_*\n"
+			"    callbacks aren't called for dangling ones.",
+			"bool strict_ids = false;"))
+	out = ""
+	out += "/**\n"
+	out += " * Options for load_*_xml.\n"
+	if fields:
+		out += " *\n"
+	for doc, _ in fields:
+		out += "".join(" * %s\n" % line for line in doc.split("\n"))
+	out += " */\n"
+	out += "struct XmlLoadOptions {\n"
+	for _, field in fields:
+		out += "\t%s\n" % field
+	out += "};\n"
+	return out
+
+def gen_write_options(features: AbstractSet[str]) -> str:
+	"""Generate XmlWriteOptions, with the fields of the generated features."""
+	fields = []
+	fields.append(("profile: Layout of the output. See XmlWriteProfile.",
+		"XmlWriteProfile profile = XmlWriteProfile::PRETTY;"))
+	if "parallel-write" in features:
+		fields.append(("num_threads: Write the repeated children of the root and of its children on\n"
+			"    this many threads, or one per core if 0. The default of 1 writes serially.\n"
+			"    The read callbacks of the implementation are then called concurrently.",
+			"size_t num_threads = 1;"))
+		fields.append(("range_size: Number of such children written by a thread at a time.",
+			"size_t range_size = 4096;"))
+	if "progress" in features:
+		fields.append(("progress: Report the progress of the write to this reporter. See ProgressReporter.",
+			"ProgressReporter *progress = nullptr;"))
+	out = ""
+	out += "/**\n"
+	out += " * Options for write_*_xml.\n"
+	out += " *\n"
+	for doc, _ in fields:
+		out += "".join(" * %s\n" % line for line in doc.split("\n"))
+	out += " */\n"
+	out += "struct XmlWriteOptions {\n"
+	for _, field in fields:
+		out += "\t%s\n" % field
+	out += "};\n"
+	return out
+
+def gen_load_state(schema: UxsdSchema, features: AbstractSet[str] = frozenset()) -> str:
+	"""Generate a struct which holds the state of a single load_foo_xml call.
+
+	It's passed down to every load_* function, so that loads don't share any
+	mutable state.
+	"""
+	root = schema.root_element
+	out = ""
+	out += "/* Deduces the ContextTypes of an implementation of %sBase. */\n" % utils.to_pascalcase(root.name)
+	out += "template<typename ContextTypes>\n"
+	out += "ContextTypes %s_context_types(const %sBase<ContextTypes> &);\n" % (root.name, utils.to_pascalcase(root.name))
+	out += "\n"
+	out += "template<typename ContextTypes>\n"
+	out += "struct %s {\n" % _gen_load_state_type(root)
+	if "progress" in features:
+		out += "\t/* Non-null if reporting progress. */\n"
+		out += "\tProgressReporter *progress = nullptr;\n"
+	if "hash-cons" in features:
+		out += "\t/* Non-null if hash-consing subtrees. */\n"
+		out += "\tSubtreeHashCons *hash_cons = nullptr;\n"
+		for t in _collect_hash_cons_types(schema, features):
+			out += "\tSubtreeHashCons::Table %s_subtrees;\n" % t.name
+	if "ids" in features:
+		out += "\n"
+		out += "\t/* Contexts of the elements with IDs and IDREFs, which are resolved after loading. */\n"
+		out += "\tIdIndex ids;\n"
+		out += "\t/* If set, duplicate IDs and dangling IDREFs are errors. See XmlLoadOptions. */\n"
+		out += "\tbool strict_ids = false;\n"
+		for t in schema.id_types:
+			out += "\tstd::vector<%s> %s_ids;\n" % (_gen_context_type(t, "Write"), t.name)
+		for t in dict.fromkeys(t for t, _ in schema.idref_attrs):
+			out += "\tstd::vector<%s> %s_referrers;\n" % (_gen_context_type(t, "Write"), t.name)
+	out += "};\n"
+	return out
+
+def gen_id_enums(schema: UxsdSchema) -> str:
+	"""Generate the tags of the IdIndex. Both foo_uxsdcxx.h and the transcoder
+	use them, so they are guarded to let a file include both."""
+	guard = "UXSD_%s_ID_ENUMS" % schema.root_element.name.upper()
+	out = ""
+	out += "#ifndef %s\n" % guard
+	out += "#define %s\n" % guard
+	out += "/* Types with an ID attribute and IDREF attributes, as tagged in the IdIndex. */\n"
+	out += "enum class id_type {%s};\n" % ", ".join(utils.to_token(t.name) for t in schema.id_types)
+	out += "enum class idref_attr {%s};\n" % ", ".join(utils.to_token(_gen_stub_suffix(a, t.name)) for t, a in schema.idref_attrs)
+	out += "#endif\n"
+	return out
+
+def resolve_fn_from_schema(schema: UxsdSchema) -> str:
+	"""Generate a function which resolves the IDREFs found during a load
+	to the elements with these IDs. Dangling IDREFs are skipped, or reported
+	if the load is strict."""
+	out = ""
+	out += "template<class T, typename LoadState>\n"
+	out += "inline void resolve_%s_ids(T &out, LoadState *load_state, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug){\n" % schema.root_element.name
+	out += "\t(void)out;\n"
+	out += "\tfor(const IdIndex::Ref &ref : load_state->ids.refs()){\n"
+	out += "\t\tconst IdIndex::Entry *target = load_state->ids.find(ref.id);\n"
+	out += "\t\tif(target == nullptr){\n"
+	out += "\t\t\tif(!load_state->strict_ids) continue;\n"
+	out += "\t\t\t*offset_debug = ref.offset;\n"
+	out += "\t\t\tnoreturn_report(report_error, (\"Dangling IDREF `\" + std::string(ref.id) + \"`.\").c_str());\n"
+	out += "\t\t}\n"
+	out += "\t\tswitch((idref_attr)ref.attr){\n"
+	for t, a in schema.idref_attrs:
+		stub = _gen_stub_suffix(a, t.name)
+		out += "\t\tcase idref_attr::%s:\n" % utils.to_token(stub)
+		out += "\t\t\tswitch((id_type)target->type){\n"
+		for x in schema.id_types:
+			out += "\t\t\tcase id_type::%s:\n" % utils.to_token(x.name)
+			out += "\t\t\t\tout.resolve_%s_to_%s(load_state->%s_referrers[ref.index], load_state->%s_ids[target->index]);\n" % (stub, x.name, t.name, x.name)
+			out += "\t\t\t\tbreak;\n"
+		out += "\t\t\t}\n"
+		out += "\t\t\tbreak;\n"
+	out += "\t\t}\n"
+	out += "\t}\n"
+	out += "}\n"
+	return out
+
+def _gen_snapshot_simple(t: UxsdSimple, input: str) -> str:
+	"""Generate the code writing the value of a simple type to a snapshot.
+	Values are stored parsed, except for unions, which may point to strings."""
+	if isinstance(t, (UxsdString, UxsdUnion)):
+		return "w.write_str(%s);\n" % input
+	return "w.write(%s);\n" % _gen_load_simple(t, input)
+
+def _gen_replay_simple(t: UxsdSimple) -> str:
+	"""Generate an expression reading the value of a simple type from a snapshot."""
+	if isinstance(t, UxsdString):
+		return "r.read_str()"
+	elif isinstance(t, UxsdUnion):
+		return _gen_load_simple(t, "r.read_str()")
+	return "r.read<%s>()" % t.cpp
+
+def _gen_required_attr_locals(t: UxsdComplex) -> List[UxsdAttribute]:
+	return [attr for attr in t.attrs if pass_at_init(attr)]
+
+def snapshot_fn_from_complex_type(t: UxsdComplex) -> str:
+	"""Generate a C++ function snapshot_foo(&root, &w), which writes a DOM
+	validated by load_foo to a snapshot in the order replay_foo reads it:
+
+	- the attributes which aren't passed at init, as (token, value) pairs,
+	- the number of each repeated child, if load_foo preallocates them,
+	- the children as (token, required attributes, snapshot of the child) tuples,
+	  or the value of a simple content.
+	"""
+	out = ""
+	out += "inline void snapshot_%s(const pugi::xml_node &root, SnapshotWriter &w, const std::function<void(const char*)> *report_error){\n" % t.name
+	out += "\t(void)root;\n"
+	out += "\t(void)w;\n"
+	out += "\t(void)report_error;\n"
+	if any(not pass_at_init(attr) for attr in t.attrs):
+		out += "\tsize_t num_attrs = w.reserve_count();\n"
+		out += "\tuint32_t n = 0;\n"
+		out += "\tfor(pugi::xml_attribute attr = root.first_attribute(); attr; attr = attr.next_attribute()){\n"
+		out += "\t\tatok_%s in = lex_attr_%s(attr.name(), report_error);\n" % (t.cpp, t.cpp)
+		out += "\t\tswitch(in){\n"
+		for attr in t.attrs:
+			if pass_at_init(attr):
+				continue
+			out += "\t\tcase atok_%s::%s:\n" % (t.cpp, utils.to_token(attr.name))
+			out += "\t\t\tw.write((uint32_t)in);\n"
+			out += utils.indent(_gen_snapshot_simple(attr.type, "attr.value()"), 3)
+			out += "\t\t\tn++;\n"
+			out += "\t\t\tbreak;\n"
+		out += "\t\tdefault: break; /* Written by the parent. */\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+		out += "\tw.set_count(num_attrs, n);\n"
+
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		many = [el for el in t.content.children if el.many]
+		if isinstance(t.content, UxsdDfa) and many:
+			out += "\t{\n"
+			for el in many:
+				out += "\t\tuint32_t {tag}_count = 0;\n".format(tag=el.name)
+			out += "\t\tfor(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
+			out += "\t\t\tswitch(lex_node_%s(node.name(), report_error)){\n" % t.cpp
+			for el in many:
+				out += "\t\t\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(el.name))
+				out += "\t\t\t\t{tag}_count += 1;\n".format(tag=el.name)
+				out += "\t\t\t\tbreak;\n"
+			out += "\t\t\tdefault: break;\n"
+			out += "\t\t\t}\n"
+			out += "\t\t}\n"
+			for el in many:
+				out += "\t\tw.write({tag}_count);\n".format(tag=el.name)
+			out += "\t}\n"
+
+		out += "\tsize_t num_children = w.reserve_count();\n"
+		out += "\tuint32_t num = 0;\n"
+		out += "\tfor(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
+		out += "\t\tgtok_%s in = lex_node_%s(node.name(), report_error);\n" % (t.cpp, t.cpp)
+		out += "\t\tw.write((uint32_t)in);\n"
+		out += "\t\tnum++;\n"
+		out += "\t\tswitch(in){\n"
+		for el in t.content.children:
+			out += "\t\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(el.name))
+			if isinstance(el.type, UxsdComplex):
+				required = _gen_required_attr_locals(el.type)
+				if required:
+					out += "\t\t\t{\n"
+					args = []
+					for attr in required:
+						arg = "%s_%s" % (el.type.name, checked(attr.name))
+						out += "\t\t\t\t%s %s;\n" % (attr.type.cpp, arg)
+						out += "\t\t\t\tmemset(&{name}, 0, sizeof({name}));\n".format(name=arg)
+						args.append(arg)
+					out += "\t\t\t\tload_%s_required_attributes(node, %s, report_error);\n" % (el.type.name, ", ".join("&" + x for x in args))
+					for arg in args:
+						out += "\t\t\t\tw.write(%s);\n" % arg
+					out += "\t\t\t}\n"
+				out += "\t\t\tsnapshot_%s(node, w, report_error);\n" % el.type.name
+			else:
+				out += utils.indent(_gen_snapshot_simple(el.type, "node.child_value()"), 3)
+			out += "\t\t\tbreak;\n"
+		out += "\t\tdefault: break; /* Not possible. */\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+		out += "\tw.set_count(num_children, num);\n"
+	elif isinstance(t.content, UxsdLeaf):
+		out += utils.indent(_gen_snapshot_simple(t.content.type, "root.child_value()"))
+	out += "}\n"
+	return out
+
+def replay_fn_from_complex_type(t: UxsdComplex, features: AbstractSet[str] = frozenset()) -> str:
+	"""Generate a C++ function replay_foo(&r, &out), which makes the same calls
+	to out as load_foo did for the DOM recorded by snapshot_foo. The snapshot was
+	validated when it was written, so nothing is checked here.
+	"""
 	out = ""
+	out += "template<class T, typename Context, typename LoadState>\n"
+	out += "inline void replay_%s(SnapshotReader &r, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug, LoadState *load_state){\n" % t.name
+	out += "\t(void)r;\n"
+	out += "\t(void)out;\n"
+	out += "\t(void)context;\n"
+	out += "\t(void)report_error;\n"
+	out += "\t(void)offset_debug;\n"
+	out += "\t(void)load_state;\n"
+	if any(not pass_at_init(attr) for attr in t.attrs):
+		out += "\tfor(uint32_t i = 0, n = r.read<uint32_t>(); i < n; i++){\n"
+		out += "\t\tswitch((atok_%s)r.read<uint32_t>()){\n" % t.cpp
+		for attr in t.attrs:
+			if pass_at_init(attr):
+				continue
+			out += "\t\tcase atok_%s::%s:\n" % (t.cpp, utils.to_token(attr.name))
+			if "ids" in features and isinstance(attr.type, (UxsdId, UxsdIdRef)):
+				out += "\t\t\t{\n"
+				out += "\t\t\t\tconst char *value = r.read_str();\n"
+				out += "\t\t\t\tout.set_%s(value, context);\n" % _gen_stub_suffix(attr, t.name)
+				out += utils.indent(_gen_index_attr(attr, t.name, "value"), 4)
+				out += "\t\t\t}\n"
+			else:
+				out += "\t\t\tout.set_%s(%s, context);\n" % (_gen_stub_suffix(attr, t.name), _gen_replay_simple(attr.type))
+			out += "\t\t\tbreak;\n"
+		out += "\t\tdefault: break; /* Not possible. */\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		many = [el for el in t.content.children if el.many]
+		if isinstance(t.content, UxsdDfa) and many:
+			for el in many:
+				out += "\tout.preallocate_%s(context, r.read<uint32_t>());\n" % _gen_stub_suffix(el, t.name)
+		out += "\tfor(uint32_t i = 0, n = r.read<uint32_t>(); i < n; i++){\n"
+		out += "\t\tswitch((gtok_%s)r.read<uint32_t>()){\n" % t.cpp
+		for el in t.content.children:
+			stub = _gen_stub_suffix(el, t.name)
+			out += "\t\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(el.name))
+			if isinstance(el.type, UxsdComplex):
+				out += "\t\t\t{\n"
+				args = ["context"]
+				for attr in _gen_required_attr_locals(el.type):
+					arg = "%s_%s" % (el.type.name, checked(attr.name))
+					out += "\t\t\t\t%s %s = r.read<%s>();\n" % (attr.type.cpp, arg, attr.type.cpp)
+					args.append(arg)
+				out += "\t\t\t\tauto child_context = out.%s_%s(%s);\n" % ("add" if el.many else "init", stub, ", ".join(args))
+				out += "\t\t\t\treplay_%s(r, out, child_context, report_error, offset_debug, load_state);\n" % el.type.name
+				out += "\t\t\t\tout.finish_%s(child_context);\n" % stub
+				out += "\t\t\t}\n"
+			else:
+				out += "\t\t\tout.%s_%s(%s, context);\n" % ("add" if el.many else "set", stub, _gen_replay_simple(el.type))
+			out += "\t\t\tbreak;\n"
+		out += "\t\tdefault: break; /* Not possible. */\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+	elif isinstance(t.content, UxsdLeaf):
+		out += "\tout.set_%s_value(%s, context);\n" % (t.name, _gen_replay_simple(t.content.type))
+	out += "}\n"
+	return out
+
+def cached_load_fn_from_root_element(e: UxsdElement, has_ids: bool, schema_key: str) -> str:
+	out = ""
+	out += "/**\n"
+	out += " * Load the XML file at filename through a snapshot at filename.uxsdcache.\n"
+	out += " *\n"
+	out += " * The snapshot is keyed on the size, the modification time and a hash of the\n"
+	out += " * contents of the XML file. If it matches, the calls load_%s_xml would make\n" % e.name
+	out += " * are replayed from it without parsing XML. Otherwise the XML file is loaded\n"
+	out += " * as usual, and the snapshot is rewritten after the load succeeds.\n"
+	out += " * Returns true if the snapshot was used.\n"
+	if has_ids:
+		out += " * If strict_ids is set, duplicate IDs and dangling IDREFs are errors.\n"
+	out += " */\n"
 	out += "template <class T, typename Context>\n"
-	out += "inline void load_%s_xml(T &out, Context &context, const char * filename, std::istream &is){\n" % e.name
+	if has_ids:
+		out += "inline bool load_%s_cached(T &out, Context &context, const char * filename, bool strict_ids = false){\n" % e.name
+	else:
+		out += "inline bool load_%s_cached(T &out, Context &context, const char * filename){\n" % e.name
+	out += "\tstd::string xml;\n"
+	out += "\tif(!snapshot_read_file(filename, xml)){\n"
+	out += "\t\tstd::string msg = \"Unable to read XML file '\" + std::string(filename) + \"'.\";\n"
+	out += "\t\tout.error_encountered(filename, 0, msg.c_str());\n"
+	out += "\t\tthrow std::runtime_error(msg);\n"
+	out += "\t}\n"
+	out += "\tSnapshotHeader key = snapshot_key(\"%s\", filename, xml);\n" % schema_key
+	out += "\tstd::string snapshot_filename = std::string(filename) + \".uxsdcache\";\n"
+	out += "\n"
+	out += "\tstd::string snapshot;\n"
+	out += "\tif(snapshot_read_file(snapshot_filename.c_str(), snapshot) && snapshot_matches(key, snapshot)){\n"
+	out += "\t\tptrdiff_t offset_debug = 0;\n"
+	out += "\t\tstd::function<void(const char *)> report_error = [filename, &out](const char * message) {\n"
+	out += "\t\t\tout.error_encountered(filename, 0, message);\n"
+	out += "\t\t\tthrow std::runtime_error(message);\n"
+	out += "\t\t};\n"
+	out += "\t\t%s<decltype(%s_context_types(out))> load_state;\n" % (_gen_load_state_type(e), e.name)
+	if has_ids:
+		out += "\t\tload_state.strict_ids = strict_ids;\n"
+	out += "\t\tout.start_load(&report_error);\n"
+	out += "\t\tSnapshotReader r(snapshot.data() + sizeof(SnapshotHeader));\n"
+	out += "\t\tfor(uint32_t i = 0, n = r.read<uint32_t>(); i < n; i++){\n"
+	out += "\t\t\treplay_%s(r, out, context, &report_error, &offset_debug, &load_state);\n" % e.type.name
+	out += "\t\t}\n"
+	if has_ids:
+		out += "\t\tresolve_%s_ids(out, &load_state, &report_error, &offset_debug);\n" % e.name
+	out += "\t\tout.finish_load();\n"
+	out += "\t\treturn true;\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* Parse in place: xml isn't needed for anything else. */\n"
 	out += "\tpugi::xml_document doc;\n"
-	out += "\tpugi::xml_parse_result result = doc.load(is);\n"
-	out += "\tif(!result) {\n"
-	out += "\t\tint line, col;\n"
-	out += "\t\tget_line_number(filename, result.offset, &line, &col);\n"
-	out += "\t\tstd::stringstream msg;\n"
-	out += "\t\tmsg << \"Unable to load XML file '\" << filename << \"', \";\n"
-	out += "\t\tmsg << result.description() << \" (line: \" << line;\n"
-	out += "\t\tmsg << \" col: \" << col << \")\";"
-	out += "\t\tout.error_encountered(filename, line, msg.str().c_str());\n"
+	out += "\tpugi::xml_parse_result result = doc.load_buffer_inplace(&xml[0], xml.size());\n"
+	out += utils.indent(_gen_report_parse_error())
+	if has_ids:
+		out += "\tXmlLoadOptions options;\n"
+		out += "\toptions.strict_ids = strict_ids;\n"
+		out += "\tload_%s_document(out, context, filename, doc, options);\n" % e.name
+	else:
+		out += "\tload_%s_document(out, context, filename, doc, XmlLoadOptions());\n" % e.name
+	out += "\tif(!result) return false;\n"
+	out += "\n"
+	out += "\t/* The document is valid, since the load didn't throw. */\n"
+	out += "\tstd::function<void(const char *)> report_error = [](const char * message) {\n"
+	out += "\t\tthrow std::runtime_error(message);\n"
+	out += "\t};\n"
+	out += "\tSnapshotWriter w;\n"
+	out += "\tsize_t num_roots = w.reserve_count();\n"
+	out += "\tuint32_t n = 0;\n"
+	out += "\tfor(pugi::xml_node node = doc.child(\"%s\"); node; node = node.next_sibling(\"%s\")){\n" % (e.name, e.name)
+	out += "\t\terrno = 0;\n"
+	out += "\t\tsnapshot_%s(node, w, &report_error);\n" % e.type.name
+	out += "\t\tn++;\n"
 	out += "\t}\n"
+	out += "\tw.set_count(num_roots, n);\n"
+	out += "\tsnapshot_write_file(snapshot_filename, key, w.data());\n"
+	out += "\treturn false;\n"
+	out += "}\n"
+	return out
+
+def batch_load_fn_from_root_element(e: UxsdElement, features: AbstractSet[str] = frozenset()) -> str:
+	out = ""
+	out += "/**\n"
+	out += " * Load many XML files concurrently on a fixed pool of num_threads threads,\n"
+	out += " * or one per core if num_threads is 0.\n"
+	out += " *\n"
+	out += " * make_impl(i) returns a std::pair of the implementation and the write context\n"
+	out += " * to load filenames[i] into. It's never called concurrently, and the implementations\n"
+	out += " * it returns must not share mutable state. The generated code doesn't keep any:\n"
+	out += " * the state of a load lives on its stack, errno is thread-local and every thread\n"
+	out += " * reuses an XmlArena of its own, so options.arena is ignored.\n"
+	if "progress" in features:
+		out += " * So is options.progress, since a ProgressReporter can't be shared between\n"
+		out += " * concurrent loads.\n"
+	out += " *\n"
+	out += " * An error doesn't stop the other loads. Results are in the order of filenames.\n"
+	out += " */\n"
+	out += "template <class Factory>\n"
+	out += "inline std::vector<XmlBatchResult> load_%s_xml_batch(const std::vector<std::string> &filenames, Factory make_impl, size_t num_threads = 0, const XmlLoadOptions &options = XmlLoadOptions()){\n" % e.name
+	out += "\tstd::vector<XmlBatchResult> results(filenames.size());\n"
+	out += "\tstd::mutex factory_lock;\n"
+	out += "\trun_batch(filenames.size(), num_threads, [&](size_t i, XmlArena &arena){\n"
+	out += "\t\tXmlBatchResult &result = results[i];\n"
+	out += "\t\tresult.filename = filenames[i];\n"
+	out += "\t\ttry {\n"
+	out += "\t\t\tstd::unique_lock<std::mutex> lock(factory_lock);\n"
+	out += "\t\t\tauto impl = make_impl(i);\n"
+	out += "\t\t\tlock.unlock();\n"
+	out += "\t\t\tstd::ifstream is(filenames[i]);\n"
+	out += "\t\t\tif(!is) throw std::runtime_error(\"Unable to open XML file '\" + filenames[i] + \"'.\");\n"
+	out += "\t\t\tXmlLoadOptions thread_options = options;\n"
+	out += "\t\t\tthread_options.arena = &arena;\n"
+	if "progress" in features:
+		out += "\t\t\tthread_options.progress = nullptr;\n"
+	out += "\t\t\tload_%s_xml(*impl.first, impl.second, filenames[i].c_str(), is, thread_options);\n" % e.name
+	out += "\t\t\tresult.ok = true;\n"
+	out += "\t\t} catch(const std::exception &ex) {\n"
+	out += "\t\t\tresult.error = ex.what();\n"
+	out += "\t\t}\n"
+	out += "\t});\n"
+	out += "\treturn results;\n"
+	out += "}\n"
+	return out
+
+def _gen_report_parse_error(source: Optional[str] = None) -> str:
+	"""Generate the code reporting a PugiXML parse error in result.
+
+	source is the data and size of the text in memory to find the line of the
+	error in, if it's not the file itself.
+	"""
+	out = ""
+	out += "if(!result) {\n"
+	out += "\tint line, col;\n"
+	if source is not None:
+		out += "\tget_line_number(%s, result.offset, &line, &col);\n" % source
+	else:
+		out += "\tget_line_number(filename, result.offset, &line, &col);\n"
+	out += "\tstd::stringstream msg;\n"
+	out += "\tmsg << \"Unable to load XML file '\" << filename << \"', \";\n"
+	out += "\tmsg << result.description() << \" (line: \" << line;\n"
+	out += "\tmsg << \" col: \" << col << \")\";\n"
+	out += "\tout.error_encountered(filename, line, msg.str().c_str());\n"
+	out += "}\n"
+	return out
+
+def load_fn_from_root_element(e: UxsdElement, has_ids: bool, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
+	out = ""
+	out += "/**\n"
+	out += " * Validate and load an already parsed document. filename is only used for\n"
+	out += " * error messages. If the document wasn't parsed from filename as is, source\n"
+	out += " * is the text it was parsed from, where the lines of errors are found.\n"
+	if "arena" in features:
+		out += " * options.arena is ignored.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_document(T &out, Context &context, const char * filename, const pugi::xml_document &doc, const XmlLoadOptions &options, const char *source = nullptr, size_t source_size = 0){\n" % e.name
+	out += "\t(void)options;\n"
 	out += "\tptrdiff_t offset_debug = 0;\n"
-	out += "\tstd::function<void(const char *)> report_error = [filename, &out, &offset_debug](const char * message) {\n"
+	out += "\tstd::function<void(const char *)> report_error = [filename, source, source_size, &out, &offset_debug](const char * message) {\n"
 	out += "\t\tint line, col;\n"
-	out += "\t\tget_line_number(filename, offset_debug, &line, &col);\n"
+	out += "\t\tif(source != nullptr) get_line_number(source, source_size, offset_debug, &line, &col);\n"
+	out += "\t\telse get_line_number(filename, offset_debug, &line, &col);\n"
 	out += "\t\tout.error_encountered(filename, line, message);\n"
 	out += "\t\t// If error_encountered didn't throw, throw now to unwind.\n"
 	out += "\t\tthrow std::runtime_error(message);\n"
 	out += "\t};\n"
+	out += "\t%s<decltype(%s_context_types(out))> load_state;\n" % (_gen_load_state_type(e), e.name)
+	if "hash-cons" in features:
+		out += "\tSubtreeHashCons hash_cons;\n"
+		out += "\tif(options.hash_cons) load_state.hash_cons = &hash_cons;\n"
+	if "progress" in features:
+		out += "\tload_state.progress = options.progress;\n"
+	if has_ids:
+		out += "\tload_state.strict_ids = options.strict_ids;\n"
 	out += "\tout.start_load(&report_error);\n"
 	out += "\t\n"
 
@@ -596,15 +1269,104 @@ def load_fn_from_root_element(e: UxsdElement) -> str:
 	out += "\t\tif(std::strcmp(node.name(), \"%s\") == 0){\n" % e.name
 	out += "\t\t\t/* If errno is set up to this point, it messes with strtol errno checking. */\n"
 	out += "\t\t\terrno = 0;\n"
-	out += "\t\t\tload_%s(node, out, context, &report_error, &offset_debug);\n" % e.type.name
+	out += "\t\t\tload_%s(node, out, context, &report_error, &offset_debug, &load_state);\n" % e.type.name
 
 	out += "\t\t} else {\n"
 	out += "\t\t\toffset_debug = node.offset_debug();\n"
 	out += "\t\t\treport_error((\"Invalid root-level element \" + std::string(node.name())).c_str());\n"
 	out += "\t\t}\n"
 	out += "\t}\n"
-	out += "\tout.finish_load();\n"
+	if has_ids:
+		out += "\tresolve_%s_ids(out, &load_state, &report_error, &offset_debug);\n" % e.name
+	out += "\t%s;\n" % _gen_callback("out.finish_load()", "finish_load", instrument)
+	if instrument:
+		out += "\tinstrument_report(std::cerr);\n"
+	if "progress" in features:
+		out += "\tif(options.progress) options.progress->finish(offset_debug);\n"
 	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	if "decompress" in features:
+		out += " * Load from is, which may be compressed with gzip or zstd. See XmlDecompressor.\n"
+	else:
+		out += " * Load from is.\n"
+	out += " */\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_xml(T &out, Context &context, const char * filename, std::istream &is, const XmlLoadOptions &options){\n" % e.name
+	if "arena" in features:
+		out += "\tif(options.arena != nullptr){\n"
+		out += "\t\toptions.arena->reset();\n"
+		out += "\t\tXmlArenaScope scope(*options.arena);\n"
+		out += "\t\tXmlLoadOptions inner = options;\n"
+		out += "\t\tinner.arena = nullptr;\n"
+		out += "\t\tload_%s_xml(out, context, filename, is, inner);\n" % e.name
+		out += "\t\treturn;\n"
+		out += "\t}\n"
+		out += "\n"
+	if "progress" in features:
+		out += "\tif(options.progress) options.progress->start();\n"
+	out += "\tpugi::xml_document doc;\n"
+	if "decompress" in features:
+		out += "\tXmlCompression compression = detect_xml_compression(is);\n"
+		out += "\tif(compression != XmlCompression::NONE){\n"
+		out += "\t\tXmlDecompressor decompressor(is, compression);\n"
+		out += "\t\ttry {\n"
+		if instrument:
+			out += utils.indent(_gen_instrument_scope("decompress"), 3)
+			out += "\t\t\tdecompressor.run();\n"
+			out += "\t\t\tinstrument_scope.add_bytes(decompressor.size());\n"
+		else:
+			out += "\t\t\tdecompressor.run();\n"
+		out += "\t\t} catch(const std::exception &ex) {\n"
+		out += "\t\t\tstd::string msg = \"Unable to decompress XML file '\" + std::string(filename) + \"', \" + ex.what();\n"
+		out += "\t\t\tout.error_encountered(filename, -1, msg.c_str());\n"
+		out += "\t\t\tthrow std::runtime_error(msg);\n"
+		out += "\t\t}\n"
+		if instrument:
+			out += "\t\tpugi::xml_parse_result result;\n"
+			out += "\t\t{\n"
+			out += utils.indent(_gen_instrument_scope("pugixml parse"), 3)
+			out += "\t\t\tresult = doc.load_buffer_inplace(decompressor.data(), decompressor.size());\n"
+			out += "\t\t\tinstrument_scope.add_bytes(decompressor.size());\n"
+			out += "\t\t}\n"
+		else:
+			out += "\t\tpugi::xml_parse_result result = doc.load_buffer_inplace(decompressor.data(), decompressor.size());\n"
+		out += utils.indent(_gen_report_parse_error("decompressor.data(), decompressor.size()"), 2)
+		out += "\t\tload_%s_document(out, context, filename, doc, options, decompressor.data(), decompressor.size());\n" % e.name
+		out += "\t\treturn;\n"
+		out += "\t}\n"
+		out += "\n"
+	if instrument:
+		out += "\tpugi::xml_parse_result result;\n"
+		out += "\t{\n"
+		out += utils.indent(_gen_instrument_scope("pugixml parse"), 2)
+		out += "\t\tstd::streamoff instrument_start = is.tellg();\n"
+		out += "\t\tresult = doc.load(is);\n"
+		out += "\t\tif(instrument_start >= 0 && is.tellg() >= 0) instrument_scope.add_bytes(is.tellg() - instrument_start);\n"
+		out += "\t}\n"
+	else:
+		out += "\tpugi::xml_parse_result result = doc.load(is);\n"
+	out += utils.indent(_gen_report_parse_error())
+	out += "\tload_%s_document(out, context, filename, doc, options);\n" % e.name
+	out += "}\n"
+	out += "\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void load_%s_xml(T &out, Context &context, const char * filename, std::istream &is){\n" % e.name
+	out += "\tload_%s_xml(out, context, filename, is, XmlLoadOptions());\n" % e.name
+	out += "}\n"
+	if "arena" in features:
+		out += "\n"
+		out += "/**\n"
+		out += " * Same as above, but the PugiXML DOM is allocated from the given arena.\n"
+		out += " * The arena is reset at the start of every load, so it can be reused across\n"
+		out += " * many documents without returning memory to the OS.\n"
+		out += " */\n"
+		out += "template <class T, typename Context>\n"
+		out += "inline void load_%s_xml(T &out, Context &context, const char * filename, std::istream &is, XmlArena &arena){\n" % e.name
+		out += "\tXmlLoadOptions options;\n"
+		out += "\toptions.arena = &arena;\n"
+		out += "\tload_%s_xml(out, context, filename, is, options);\n" % e.name
+		out += "}\n"
 	return out
 
 #
@@ -629,17 +1391,147 @@ def _gen_write_simple(t: Union[UxsdElement, UxsdAttribute], parent: str, context
 	else:
 		raise NotImplementedError(t)
 
+def _gen_write_value(t: Union[UxsdElement, UxsdAttribute], parent: str, context: str = "context") -> str:
+	"""Generate a statement writing a simple value. Strings are escaped by the
+	XmlWriter, enum tokens are known to be clean and copied as they are."""
+	if isinstance(t.type, UxsdEnum):
+		return "w.token(%s);\n" % _gen_write_simple(t, parent, context)
+	elif isinstance(t, UxsdAttribute):
+		return "w.attribute(%s);\n" % _gen_write_simple(t, parent, context)
+	else:
+		return "w.value(%s);\n" % _gen_write_simple(t, parent, context)
+
+def _gen_put(text: str) -> str:
+	"""Generate a statement writing constant text. Adjacent ones are merged by _merge_puts."""
+	return "w.put(\"%s\");\n" % text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Constant text which differs between the output profiles is marked up in the
+# text of a w.put as \x01pretty\x02compact\x02canonical\x03, so that it's merged
+# with its neighbours like any other text. _expand_profiles turns the merged
+# statements into branches on the profile.
+_profile_text_re = re.compile("\x01([^\x02]*)\x02([^\x02]*)\x02([^\x03]*)\x03")
+
+def _profile_text(pretty: str, compact: str, canonical: str) -> str:
+	return "\x01%s\x02%s\x02%s\x03" % (pretty, compact, canonical)
+
+# The pretty profile ends every element with a newline.
+_nl = _profile_text("\n", "", "")
+
+_put_re = re.compile(r'^(\t*)w\.put\("(.*)"\);$')
+
+def _merge_puts(code: str) -> str:
+	"""Merge adjacent writes of constant text at the same indentation, so that
+	they become one copy into the XmlWriter's buffer.
+
+	Statements at the same indentation next to each other always run together,
+	since the writers don't use labels or unbraced multi-statement bodies.
+	"""
+	out: List[str] = []
+	last = None
+	for line in code.split("\n"):
+		m = _put_re.match(line)
+		if m and last and last.group(1) == m.group(1):
+			line = '%sw.put("%s%s");' % (m.group(1), last.group(2), m.group(2))
+			out[-1] = line
+			m = _put_re.match(line)
+		else:
+			out.append(line)
+		last = m
+	return "\n".join(out)
+
+def _expand_profiles(code: str) -> str:
+	"""Replace writes of text marked up by _profile_text with a write for each
+	profile. P is a template parameter, so the compiler keeps only one of them."""
+	out: List[str] = []
+	for line in code.split("\n"):
+		m = _put_re.match(line)
+		if not m or "\x01" not in line:
+			out.append(line)
+			continue
+		texts = [_profile_text_re.sub(lambda x: x.group(i), m.group(2)) for i in (1, 2, 3)]
+		groups: List[Tuple[str, List[str]]] = []
+		for profile, text in zip(_write_profiles, texts):
+			for group in groups:
+				if group[0] == text:
+					group[1].append(profile)
+					break
+			else:
+				groups.append((text, [profile]))
+		branches = [group for group in groups if group[0]]
+		for i, (text, profiles) in enumerate(branches):
+			if i > 0 and i == len(groups) - 1:
+				out.append('%selse w.put("%s");' % (m.group(1), text))
+				continue
+			cond = " || ".join("P == XmlWriteProfile::%s" % profile.upper() for profile in profiles)
+			if len(groups) == 1:
+				out.append('%sw.put("%s");' % (m.group(1), text))
+			else:
+				out.append('%s%sif(%s) w.put("%s");' % (m.group(1), "else " if i > 0 else "", cond, text))
+	return "\n".join(out)
+
+def _gen_default_literal(a: UxsdAttribute) -> str:
+	"""Generate a C++ expression for the declared default value of an attribute."""
+	assert a.default_value is not None
+	if isinstance(a.type, UxsdString):
+		return utils.to_c_string(a.default_value)
+	elif isinstance(a.type, UxsdEnum):
+		return "%s::%s" % (a.type.cpp, utils.to_token(a.default_value))
+	else:
+		return a.default_value
+
+def _gen_differs_from_default(a: UxsdAttribute, value: str) -> str:
+	if isinstance(a.type, UxsdString):
+		return "%s != nullptr && std::strcmp(%s, %s) != 0" % (value, value, _gen_default_literal(a))
+	return "%s != %s" % (value, _gen_default_literal(a))
+
+_write_profiles = ["pretty", "compact", "canonical"]
+
+def _gen_write_attrs(t: UxsdComplex, parent: str, context: str) -> str:
+	"""Write the attributes of an element. The canonical profile sorts them by name."""
+	out = "".join(_gen_write_attr(a, parent, context) for a in t.attrs)
+	attrs = sorted(t.attrs, key=lambda a: a.name)
+	if attrs == t.attrs:
+		return out
+	ouv = ""
+	ouv += "if(P == XmlWriteProfile::CANONICAL){\n"
+	ouv += utils.indent("".join(_gen_write_attr(a, parent, context) for a in attrs))
+	ouv += "}else{\n"
+	ouv += utils.indent(out)
+	ouv += "}\n"
+	return ouv
+
 def _gen_write_attr(a: UxsdAttribute, parent: str, context: str = "context") -> str:
-	"""Function to generate partial code which writes out a single XML attribute."""
+	"""Function to generate partial code which writes out a single XML attribute.
+
+	The pretty profile writes attributes with default values even if they're
+	equal to it. The others leave them out.
+	"""
 	out = ""
-	if not a.optional or a.default_value:
-		out += "os << \" %s=\\\"\" << %s << \"\\\"\";\n" % (a.name, _gen_write_simple(a, parent, context))
+	write = _gen_put(" %s=\"" % a.name)
+	write += _gen_write_value(a, parent, context)
+	write += _gen_put("\"")
+	if a.default_value is not None:
+		if isinstance(a.type, UxsdEnum):
+			value = "w.token(lookup_%s[(int)value]);\n" % a.type.name
+		else:
+			value = "w.attribute(value);\n"
+		out += "if(P == XmlWriteProfile::PRETTY){\n"
+		out += utils.indent(write)
+		out += "}else{\n"
+		out += "\tauto value = %s;\n" % _gen_check_simple(a, parent, context)
+		out += "\tif(%s){\n" % _gen_differs_from_default(a, "value")
+		out += utils.indent(_gen_put(" %s=\"" % a.name) + value + _gen_put("\""), 2)
+		out += "\t}\n"
+		out += "}\n"
+	elif not a.optional:
+		out += write
 	else:
-		out += "if((bool)%s)\n" % _gen_check_simple(a, parent, context)
-		out += "\tos << \" %s=\\\"\" << %s << \"\\\"\";\n" % (a.name, _gen_write_simple(a, parent, context))
+		out += "if((bool)%s){\n" % _gen_check_simple(a, parent, context)
+		out += utils.indent(write)
+		out += "}\n"
 	return out
 
-def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
+def _gen_write_complex_element(e: UxsdElement, parent: str, top_level: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Function to generate partial code which writes out an element with a complex type."""
 	assert isinstance(e.type, UxsdComplex)
 	out = ""
@@ -648,27 +1540,61 @@ def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
 		assert isinstance(e.type, UxsdComplex)
 		ouv = ""
 		if e.type.attrs:
-			ouv += "os << \"<%s\";\n" % e.name
-			for a in e.type.attrs:
-				ouv += _gen_write_attr(a, e.type.name, "child_context")
+			ouv += _gen_put("<%s" % e.name)
+			ouv += _gen_write_attrs(e.type, e.type.name, "child_context")
 			if e.type.content:
-				ouv += "os << \">\";\n"
-				ouv += "write_%s(in, os, child_context);\n" % e.type.name
-				ouv += "os << \"</%s>\\n\";\n" % e.name
+				ouv += _gen_put(">")
+				ouv += "write_%s<P>(in, w, child_context, options);\n" % e.type.name
+				ouv += _gen_put("</%s>%s" % (e.name, _nl))
 			else:
-				ouv += "os << \"/>\\n\";\n"
+				ouv += _gen_put(_profile_text("/>\n", "/>", "></%s>" % e.name))
 		else:
 			if e.type.content:
-				ouv += "os << \"<%s>\\n\";\n" % e.name
-				ouv += "write_%s(in, os, child_context);\n" % e.type.name
-				ouv += "os << \"</%s>\\n\";\n" % e.name
+				ouv += _gen_put("<%s>%s" % (e.name, _nl))
+				ouv += "write_%s<P>(in, w, child_context, options);\n" % e.type.name
+				ouv += _gen_put("</%s>%s" % (e.name, _nl))
 			else:
-				ouv += "os << \"<%s/>\\n\";\n" % e.name
+				ouv += _gen_put(_profile_text("<%s/>\n" % e.name, "<%s/>" % e.name, "<%s></%s>" % (e.name, e.name)))
 		return ouv
 
-	if e.many:
-		out += "for(size_t i=0, n=in.num_%s(context); i<n; i++){\n" % _gen_stub_suffix(e, parent)
-		out += "\tauto child_context = in.get_%s(i, context);\n" % _gen_stub_suffix(e, parent)
+	if e.many and top_level:
+		stub = _gen_stub_suffix(e, parent)
+		out += "WriteCursor<decltype(in.get_%s(0, context))> cursor;\n" % stub
+		if "parallel-write" in features:
+			# Repeated children of top-level types can be large sections, so they
+			# can be written on the thread pool of write_xml_parallel.
+			out += "auto write_child = [&](XmlWriter &w, decltype(cursor.value) &child_context, const XmlWriteOptions &options){\n"
+			out += "\t(void)child_context;\n"
+			out += "\t(void)options;\n"
+			out += utils.indent(_gen_write_element_body())
+			out += "};\n"
+			out += "bool more = in.begin_%s(context, cursor);\n" % stub
+			out += "if(options.num_threads != 1 && more){\n"
+			out += "\tstd::vector<decltype(cursor.value)> children;\n"
+			out += "\tif(cursor.size != SIZE_MAX) children.reserve(cursor.size);\n"
+			out += "\tfor(; more; more = in.next_%s(context, cursor)) children.push_back(cursor.value);\n" % stub
+			out += "\twrite_xml_parallel(w, children, options, %s, \"%s\", write_child);\n" % ("options.progress" if "progress" in features else "nullptr", e.name)
+			out += "}\n"
+			out += "for(size_t i = 0; more; more = in.next_%s(context, cursor), i++){\n" % stub
+			out += "\twrite_child(w, cursor.value, options);\n"
+		else:
+			# Without a thread pool, this is the loop of any repeated child,
+			# counted for the progress report.
+			if "progress" in features:
+				out += "size_t i = 0;\n"
+				out += "for(bool more = in.begin_%s(context, cursor); more; more = in.next_%s(context, cursor), i++){\n" % (stub, stub)
+			else:
+				out += "for(bool more = in.begin_%s(context, cursor); more; more = in.next_%s(context, cursor)){\n" % (stub, stub)
+			out += "\tauto child_context = cursor.value;\n"
+			out += utils.indent(_gen_write_element_body())
+		if "progress" in features:
+			out += utils.indent(_gen_progress_tick(e, "i+1", "w.bytes()", "options.progress"))
+		out += "}\n"
+	elif e.many:
+		stub = _gen_stub_suffix(e, parent)
+		out += "WriteCursor<decltype(in.get_%s(0, context))> cursor;\n" % stub
+		out += "for(bool more = in.begin_%s(context, cursor); more; more = in.next_%s(context, cursor)){\n" % (stub, stub)
+		out += "\tauto child_context = cursor.value;\n"
 		out += utils.indent(_gen_write_element_body())
 		out += "}\n"
 	elif e.optional:
@@ -682,7 +1608,7 @@ def _gen_write_complex_element(e: UxsdElement, parent: str) -> str:
 
 	return out
 
-def _gen_write_element(e: UxsdElement, parent: str) -> str:
+def _gen_write_element(e: UxsdElement, parent: str, top_level: bool = False, features: AbstractSet[str] = frozenset()) -> str:
 	"""Function to generate partial C++ code for writing out a struct generated
 	from an UxsdElement.
 
@@ -690,67 +1616,693 @@ def _gen_write_element(e: UxsdElement, parent: str) -> str:
 	Otherwise, we would have to check against the nonzero value, and the
 	check would create a case split for all simple types again.(how to compare
 	unions? strings? doubles?)
+
+	If top_level is set, the element is a child of a top-level type. Repeated
+	ones are counted to options.progress with --progress, and with
+	--parallel-write they're written in parallel if options.num_threads isn't 1.
+
+	The pretty profile ends every element with a newline. The compact and
+	canonical ones don't write any whitespace.
 	"""
 	out = ""
 	if isinstance(e.type, UxsdSimple):
+		write = _gen_put("<%s>" % e.name)
+		write += _gen_write_value(e, parent)
+		write += _gen_put("</%s>%s" % (e.name, _nl))
 		if e.many:
 			out += "for(size_t i=0, n=in.num_%s(context); i<n; i++){\n" % _gen_stub_suffix(e, parent)
-			out += "\tos << \"<%s>\" << %s << \"</%s>\\n\";\n" % (e.name, _gen_write_simple(e, parent), e.name)
+			out += utils.indent(write)
+			if top_level and "progress" in features:
+				out += utils.indent(_gen_progress_tick(e, "i+1", "w.bytes()", "options.progress"))
 			out += "}\n"
 		elif e.optional:
-			out += "if((bool)%s)\n" % _gen_write_simple(e, parent)
-			out += "\tos << \"<%s>\" << %s << \"</%s>\\n\";\n" % (e.name, _gen_write_simple(e, parent), e.name)
+			out += "if((bool)%s){\n" % _gen_write_simple(e, parent)
+			out += utils.indent(write)
+			out += "}\n"
 		else:
-			out += "os << \"<%s>\" << %s << \"</%s>\\n\";\n" % (e.name, _gen_write_simple(e, parent), e.name)
+			out += write
 	elif isinstance(e.type, UxsdComplex):
 		out += "{\n"
-		out += utils.indent(_gen_write_complex_element(e, parent))
+		out += utils.indent(_gen_write_complex_element(e, parent, top_level, features))
 		out += "}\n"
 	else:
 		raise TypeError("Unknown type %s." % e.type)
 	return out
 
 
-def write_fn_from_complex_type(t: UxsdComplex) -> str:
+def write_fn_from_complex_type(t: UxsdComplex, top_level: bool = False, features: AbstractSet[str] = frozenset()) -> str:
+	"""Generate the internal write function of a complex type. The output
+	profile is its template parameter P, which the branches between the
+	profiles test, so that each profile is compiled without them."""
 	assert isinstance(t.content, (UxsdDfa, UxsdAll, UxsdLeaf))
 	out = ""
-	out += "template<class T, typename Context>\n"
-	out += "inline void write_%s(T &in, std::ostream &os, Context &context){\n" % t.name
+	out += "template<XmlWriteProfile P, class T, typename Context>\n"
+	out += "inline void write_%s(T &in, XmlWriter &w, Context &context, const XmlWriteOptions &options){\n" % t.name
 	out += "\t(void)in;\n"
-	out += "\t(void)os;\n"
+	out += "\t(void)w;\n"
 	out += "\t(void)context;\n"
+	out += "\t(void)options;\n"
 	if isinstance(t.content, (UxsdDfa, UxsdAll)):
 		for e in t.content.children:
-			out += utils.indent(_gen_write_element(e, t.name))
+			out += utils.indent(_gen_write_element(e, t.name, top_level, features))
 	elif isinstance(t.content, UxsdLeaf):
-		out += "\tos << in.get_%s_value(context);\n" % t.name
+		out += "\tw.value(in.get_%s_value(context));\n" % t.name
 	else:
 		out += "\treturn;\n"
 
 	out += "}\n"
-	return out
+	return _expand_profiles(_merge_puts(out))
 
-def write_fn_from_root_element(e: UxsdElement) -> str:
+def write_fn_from_root_element(e: UxsdElement, features: AbstractSet[str] = frozenset()) -> str:
 	assert isinstance(e.type, UxsdComplex)
 	out = ""
+	out += "/* Internal function to write the root element in the profile P. */\n"
+	out += "template <XmlWriteProfile P, class T, typename Context>\n"
+	out += "inline void write_%s_element(T &in, XmlWriter &w, Context &context, const XmlWriteOptions &options){\n" % e.name
+	body = ""
+	body += _gen_put("<%s" % e.name)
+	body += _gen_write_attrs(e.type, e.name, "context")
+	body += _gen_put(">%s" % _nl)
+	body += "write_%s<P>(in, w, context, options);\n" % e.type.name
+	body += _gen_put("</%s>%s" % (e.name, _nl))
+	out += utils.indent(body)
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Write the document to w and flush it. See XmlWriteOptions for the options.\n"
+	if "parallel-write" in features:
+		out += " * The output is the same for any options.num_threads.\n"
+	out += " */\n"
 	out += "template <class T, typename Context>\n"
-	out += "inline void write_%s_xml(T &in, Context &context, std::ostream &os){\n" % e.name
+	out += "inline void write_%s_xml(T &in, Context &context, XmlWriter &w, const XmlWriteOptions &options){\n" % e.name
+	if "progress" in features:
+		out += "\tif(options.progress) options.progress->start();\n"
 	out += "\tin.start_write();\n"
+	out += "\tswitch(options.profile){\n"
+	for profile in _write_profiles:
+		out += "\tcase XmlWriteProfile::%s:\n" % profile.upper()
+		out += "\t\twrite_%s_element<XmlWriteProfile::%s>(in, w, context, options);\n" % (e.name, profile.upper())
+		out += "\t\tbreak;\n"
+	out += "\t}\n"
+	out += "\tin.finish_write();\n"
+	out += "\tw.flush();\n"
+	if "progress" in features:
+		out += "\tif(options.progress) options.progress->finish(w.bytes());\n"
+	out += "}\n"
+	out += "\n"
+	out += "template <class T, typename Context>\n"
+	out += "inline void write_%s_xml(T &in, Context &context, std::ostream &os, const XmlWriteOptions &options){\n" % e.name
+	out += "\tXmlWriter w(os);\n"
+	out += "\twrite_%s_xml(in, context, w, options);\n" % e.name
+	out += "}\n"
+	out += "\n"
+	if "progress" in features:
+		out += "/* Write the document serially. If progress is non-null, the progress of the write is reported to it. */\n"
+		out += "template <class T, typename Context>\n"
+		out += "inline void write_%s_xml(T &in, Context &context, XmlWriter &w, ProgressReporter *progress = nullptr){\n" % e.name
+		out += "\tXmlWriteOptions options;\n"
+		out += "\toptions.progress = progress;\n"
+		out += "\twrite_%s_xml(in, context, w, options);\n" % e.name
+		out += "}\n"
+		out += "\n"
+		out += "template <class T, typename Context>\n"
+		out += "inline void write_%s_xml(T &in, Context &context, std::ostream &os, ProgressReporter *progress = nullptr){\n" % e.name
+		out += "\tXmlWriter w(os);\n"
+		out += "\twrite_%s_xml(in, context, w, progress);\n" % e.name
+		out += "}\n"
+	else:
+		out += "/* Write the document serially. */\n"
+		out += "template <class T, typename Context>\n"
+		out += "inline void write_%s_xml(T &in, Context &context, XmlWriter &w){\n" % e.name
+		out += "\twrite_%s_xml(in, context, w, XmlWriteOptions());\n" % e.name
+		out += "}\n"
+		out += "\n"
+		out += "template <class T, typename Context>\n"
+		out += "inline void write_%s_xml(T &in, Context &context, std::ostream &os){\n" % e.name
+		out += "\tXmlWriter w(os);\n"
+		out += "\twrite_%s_xml(in, context, w);\n" % e.name
+		out += "}\n"
+	return _expand_profiles(_merge_puts(out))
+
+#
+
+def _gen_dom_value(t: UxsdSimple, input: str, getter: str, default: Optional[str] = None) -> str:
+	"""Parse a value from a PugiXML attribute or text in a DOM getter.
 
-	if e.type.attrs:
-		out += "\tos << \"<%s\";\n" % e.name
-		for a in e.type.attrs:
-			out += utils.indent(_gen_write_attr(a, e.name))
+	Absent values give the declared default value if any, otherwise NULL for
+	strings and zero for everything else.
+	"""
+	value = "%s.%s()" % (input, getter)
+	if isinstance(t, UxsdString):
+		if default is not None:
+			return "{input} ? {value} : {default}".format(input=input, value=value, default=utils.to_c_string(default))
+		return "{input} ? {value} : nullptr".format(input=input, value=value)
+	if default is not None:
+		fallback = _gen_load_simple(t, utils.to_c_string(default))
 	else:
-		out += "\tos << \"<%s\";\n" % e.name
-	out += "\tos << \">\\n\";\n"
-	out += "\twrite_%s(in, os, context);\n" % e.type.name
-	out += "\tos << \"</%s>\\n\";\n" % e.name
-	out += "\tin.finish_write();\n"
+		fallback = "(%s)0" % t.cpp
+	return "{input} ? {value} : {fallback}".format(
+			input=input,
+			value=_gen_load_simple(t, value),
+			fallback=fallback)
+
+def _gen_dom_get(t: UxsdSimple, input: str, getter: str, default: Optional[str] = None) -> str:
+	out = ""
+	if not isinstance(t, UxsdString):
+		out += "errno = 0;\n"
+	out += "return %s;\n" % _gen_dom_value(t, input, getter, default)
+	return out
+
+def _gen_dom_set_value(t: UxsdSimple, value: str) -> str:
+	if isinstance(t, UxsdEnum):
+		return "lookup_%s[(int)%s]" % (t.name, value)
+	# PugiXML writes bools as true/false, but load_bool only reads 0/1 like write_*_xml emits.
+	if t.cpp == "bool":
+		return "(int)%s" % value
+	return value
+
+def _gen_dom_canonical_name(t: UxsdComplex) -> str:
+	return "%s_canonical_" % t.name
+
+def _gen_dom_impl(t: UxsdComplex) -> str:
+	"""Generate the interface functions of Dom<Root> for a complex type."""
+	fields = []
+
+	def _add_field(ret: str, verb: str, what: str, args: str, impl: str):
+		fields.append("inline %s %s_%s_%s(%s) override {\n%s}\n" % (ret, verb, t.name, what, args, utils.indent(impl)))
+
+	def _gen_set_required_attrs(e: UxsdElement) -> str:
+		impl = ""
+		for attr in sorted(e.type.attrs, key=lambda attr: attr.name):
+			if pass_at_init(attr):
+				impl += "child.append_attribute(\"{name}\").set_value({value});\n".format(
+						name=attr.name,
+						value=_gen_dom_set_value(attr.type, checked(attr.name)))
+		return impl
+
+	def _add_get_attr(a: UxsdAttribute):
+		impl = ""
+		impl += "pugi::xml_attribute attr = node.attribute(\"%s\");\n" % a.name
+		impl += _gen_dom_get(a.type, "attr", "value", a.default_value)
+		_add_field(a.type.cpp, "get", a.name, "pugi::xml_node &node", impl)
+
+	def _add_set_attr(a: UxsdAttribute):
+		impl = "node.append_attribute(\"{name}\").set_value({value});\n".format(
+				name=a.name,
+				value=_gen_dom_set_value(a.type, checked(a.name)))
+		_add_field("void", "set", a.name, "{}, pugi::xml_node &node".format(_gen_attribute_arg(a)), impl)
+
+	def _add_get_simple(e: UxsdElement):
+		impl = ""
+		impl += "pugi::xml_text text = node.child(\"%s\").text();\n" % e.name
+		impl += _gen_dom_get(e.type, "text", "get")
+		_add_field(e.type.cpp, "get", e.name, "pugi::xml_node &node", impl)
+
+	def _add_get_simple_many(e: UxsdElement):
+		impl = ""
+		impl += "pugi::xml_text text = nth_child(%s_cursor_, node, \"%s\", n).text();\n" % (_gen_stub_suffix(e, t.name), e.name)
+		impl += _gen_dom_get(e.type, "text", "get")
+		_add_field(e.type.cpp, "get", e.name, "int n, pugi::xml_node &node", impl)
+
+	def _add_set_simple(e: UxsdElement, verb: str):
+		impl = "node.append_child(\"{name}\").text().set({value});\n".format(
+				name=e.name,
+				value=_gen_dom_set_value(e.type, checked(e.name)))
+		_add_field("void", verb, e.name, "{}, pugi::xml_node &node".format(_gen_attribute_arg(e)), impl)
+
+	def _add_init(e: UxsdElement, verb: str):
+		assert isinstance(e.type, UxsdComplex)
+		impl = ""
+		impl += "pugi::xml_node child = node.append_child(\"%s\");\n" % e.name
+		impl += _gen_set_required_attrs(e)
+		impl += "%s.push_back(child);\n" % _gen_dom_canonical_name(e.type)
+		impl += "return child;\n"
+		_add_field("pugi::xml_node", verb, e.name, _gen_required_attribute_arg_list("pugi::xml_node", e.type.attrs, context="node"), impl)
+		_add_field("void", "finish", e.name, "pugi::xml_node &node", "(void)node;\n")
+
+	def _add_ref(e: UxsdElement):
+		impl = ""
+		impl += "node.append_copy({canonical}[canonical_id]).set_name(\"{name}\");\n".format(
+				canonical=_gen_dom_canonical_name(e.type),
+				name=e.name)
+		_add_field("void", "ref", e.name, "pugi::xml_node &node, size_t canonical_id", impl)
+
+	def _add_preallocate(e: UxsdElement):
+		_add_field("void", "preallocate", e.name, "pugi::xml_node &node, size_t size", "(void)node;\n(void)size;\n")
+
+	def _add_get_complex(e: UxsdElement):
+		_add_field("pugi::xml_node", "get", e.name, "pugi::xml_node &node", "return node.child(\"%s\");\n" % e.name)
+
+	def _add_get_complex_many(e: UxsdElement):
+		impl = "return nth_child(%s_cursor_, node, \"%s\", n);\n" % (_gen_stub_suffix(e, t.name), e.name)
+		_add_field("pugi::xml_node", "get", e.name, "int n, pugi::xml_node &node", impl)
+
+	def _add_cursor(e: UxsdElement):
+		# Walk the siblings directly, instead of counting them for num_* first.
+		impl = ""
+		impl += "cursor.value = node.child(\"%s\");\n" % e.name
+		impl += "return !cursor.value.empty();\n"
+		_add_field("bool", "begin", e.name, "pugi::xml_node &node, WriteCursor<pugi::xml_node> &cursor", impl)
+		impl = ""
+		impl += "(void)node;\n"
+		impl += "cursor.value = cursor.value.next_sibling(\"%s\");\n" % e.name
+		impl += "return !cursor.value.empty();\n"
+		_add_field("bool", "next", e.name, "pugi::xml_node &node, WriteCursor<pugi::xml_node> &cursor", impl)
+
+	def _add_num(e: UxsdElement):
+		impl = ""
+		impl += "size_t n = 0;\n"
+		impl += "for(pugi::xml_node child = node.child(\"{name}\"); child; child = child.next_sibling(\"{name}\")) n++;\n".format(name=e.name)
+		impl += "return n;\n"
+		_add_field("size_t", "num", e.name, "pugi::xml_node &node", impl)
+
+	def _add_has(e: UxsdElement):
+		_add_field("bool", "has", e.name, "pugi::xml_node &node", "return !node.child(\"%s\").empty();\n" % e.name)
+
+	for attr in t.attrs:
+		_add_get_attr(attr)
+		if not pass_at_init(attr):
+			_add_set_attr(attr)
 
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		for e in t.content.children:
+			if isinstance(e.type, UxsdComplex):
+				if e.many:
+					_add_preallocate(e)
+					_add_init(e, "add")
+					_add_num(e)
+					_add_get_complex_many(e)
+					_add_cursor(e)
+				else:
+					_add_init(e, "init")
+					_add_get_complex(e)
+					if e.optional: _add_has(e)
+				_add_ref(e)
+			elif isinstance(e.type, UxsdSimple):
+				if e.many:
+					_add_preallocate(e)
+					_add_set_simple(e, "add")
+					_add_num(e)
+					_add_get_simple_many(e)
+				else:
+					_add_set_simple(e, "set")
+					_add_get_simple(e)
+			else:
+				raise TypeError(e)
+	elif isinstance(t.content, UxsdLeaf):
+		impl = "node.text().set(%s);\n" % _gen_dom_set_value(t.content.type, "value")
+		_add_field("void", "set", "value", "{} value, pugi::xml_node &node".format(t.content.type.cpp), impl)
+		impl = ""
+		impl += "pugi::xml_text text = node.text();\n"
+		impl += _gen_dom_get(t.content.type, "text", "get")
+		_add_field(t.content.type.cpp, "get", "value", "pugi::xml_node &node", impl)
+
+	return "\n".join(fields)
+
+def gen_dom_class(schema: UxsdSchema) -> str:
+	"""Generate Dom<Root>, an implementation of <Root>Base over a PugiXML DOM.
+
+	Its read and write contexts are pugi::xml_nodes. Getters parse attribute and
+	element values on demand and don't validate the tree, so a DOM which wasn't
+	produced by load_<root>_xml should be validated by other means.
+	"""
+	pname = utils.to_pascalcase(schema.root_element.name)
+	subtree_types = _collect_subtree_types(schema)
+	out = ""
+	out += "struct Dom{pname}ContextTypes : public Default{pname}ContextTypes {{\n\t".format(pname=pname)
+	out += "\n\t".join("using {}ReadContext = pugi::xml_node;".format(utils.to_pascalcase(t.name)) for t in schema.complex_types)
+	out += "\n\t"
+	out += "\n\t".join("using {}WriteContext = pugi::xml_node;".format(utils.to_pascalcase(t.name)) for t in schema.complex_types)
+	out += "\n};\n"
+	out += "\n"
+
+	out += "/**\n"
+	out += " * Implementation of {pname}Base which reads from and writes to a PugiXML DOM.\n".format(pname=pname)
+	out += " * Values are parsed from the DOM when their getters are called, so a document\n"
+	out += " * can be streamed into write_{name}_xml or another backend without an intermediate model.\n".format(name=schema.root_element.name)
+	out += " * Loading into it appends elements under the given write context.\n"
+	out += " */\n"
+	out += "class Dom{pname} : public {pname}Base<Dom{pname}ContextTypes> {{\n".format(pname=pname)
+	out += "public:\n"
+	out += "\tDom{pname}() : report_error(&throw_error_) {{}}\n\n".format(pname=pname)
+
+	out += "\tvoid start_load(const std::function<void(const char *)> *report_error_in) override {\n"
+	out += "\t\treport_error = report_error_in;\n"
+	out += "\t}\n"
+	out += "\tvoid finish_load() override {\n"
+	out += "\t\treport_error = &throw_error_;\n"
+	for t in subtree_types:
+		out += "\t\t%s.clear();\n" % _gen_dom_canonical_name(t)
+	out += "\t}\n"
+	out += "\tvoid start_write() override {}\n"
+	out += "\tvoid finish_write() override {}\n"
+	out += "\tvoid error_encountered(const char * file, int line, const char *message) override {\n"
+	out += "\t\tstd::stringstream msg;\n"
+	out += "\t\tmsg << message << \" occured at file: \" << file << \" line: \" << line;\n"
+	out += "\t\tthrow std::runtime_error(msg.str());\n"
+	out += "\t}\n"
+
+	for t in schema.complex_types:
+		out += utils.indent(_gen_dom_impl(t))
+	out += "private:\n"
+	out += "\t/* Caches the last accessed child, so that sequential get_*(n) calls don't rescan siblings. */\n"
+	out += "\tstruct Cursor {\n"
+	out += "\t\tpugi::xml_node parent;\n"
+	out += "\t\tpugi::xml_node node;\n"
+	out += "\t\tint index = -1;\n"
+	out += "\t};\n"
+	out += "\tinline pugi::xml_node nth_child(Cursor &cursor, const pugi::xml_node &parent, const char *name, int n) {\n"
+	out += "\t\tif(cursor.parent != parent || cursor.index < 0 || n < cursor.index) {\n"
+	out += "\t\t\tcursor.parent = parent;\n"
+	out += "\t\t\tcursor.node = parent.child(name);\n"
+	out += "\t\t\tcursor.index = 0;\n"
+	out += "\t\t}\n"
+	out += "\t\tfor(; cursor.index < n && cursor.node; cursor.index++) cursor.node = cursor.node.next_sibling(name);\n"
+	out += "\t\treturn cursor.node;\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tstd::function<void(const char *)> throw_error_ = [](const char *message) {\n"
+	out += "\t\tthrow std::runtime_error(message);\n"
+	out += "\t};\n"
+	out += "\tconst std::function<void(const char *)> *report_error;\n"
+	for t in schema.complex_types:
+		if isinstance(t.content, (UxsdDfa, UxsdAll)):
+			for e in t.content.children:
+				if e.many:
+					out += "\tCursor %s_cursor_;\n" % _gen_stub_suffix(e, t.name)
+	out += "\t/* Subtrees passed to init_* or add_* during a load, by type. ref_* copies them. */\n"
+	for t in subtree_types:
+		out += "\tstd::vector<pugi::xml_node> %s;\n" % _gen_dom_canonical_name(t)
+	out += "};\n"
+	return out
+
+#
+
+def _gen_push_arg(a: UxsdAttribute) -> str:
+	"""Name of the parameter for a required attribute in Push<Root>.begin_*.
+	It's renamed if it would hide the writer member."""
+	name = checked(a.name)
+	if name == "w":
+		name += "_"
+	return name
+
+def _gen_push_value(t: UxsdSimple, value: str, attribute: bool) -> str:
+	"""Generate a statement writing a value given to Push<Root>."""
+	if isinstance(t, UxsdEnum):
+		return "w.token(lookup_%s[(int)%s]);\n" % (t.name, value)
+	elif attribute:
+		return "w.attribute(%s);\n" % value
+	else:
+		return "w.value(%s);\n" % value
+
+def _gen_push_newline(t: UxsdComplex, root: bool = False) -> str:
+	"""Whether the pretty layout has a newline after the start tag of an element
+	of type t. This follows write_fn_from_root_element and _gen_write_complex_element."""
+	return "true" if root or (not t.attrs and isinstance(t.content, (UxsdDfa, UxsdAll))) else "false"
+
+def _gen_push_start_state(t: UxsdComplex) -> int:
+	if isinstance(t.content, UxsdDfa):
+		return t.content.dfa.start
+	return 0
+
+def _gen_push_begin(t: UxsdComplex, fn: str, name: str, parent: Optional[UxsdComplex], root: bool = False) -> str:
+	"""Generate begin_<fn>, which writes the start tag of an element named name
+	of type t and its required attributes, and checks it against the content of parent."""
+	init_attrs = sorted([a for a in t.attrs if pass_at_init(a)], key=lambda a: a.name)
+	args = ", ".join("%s %s" % (a.type.cpp, _gen_push_arg(a)) for a in init_attrs)
+	out = ""
+	out += "void begin_%s(%s){\n" % (fn, args)
+	if parent is None:
+		token = "-1"
+		out += "\tif(started_) noreturn_report(report_error, \"begin_%s called twice.\");\n" % fn
+		out += "\tstarted_ = true;\n"
+		out += "\tenter(Type::%s, Type::%s, %s, \"%s\", %d, %s);\n" % (utils.to_token(t.name), utils.to_token(t.name), token, name,
+				_gen_push_start_state(t), _gen_push_newline(t, root))
+	else:
+		token = "(int)gtok_%s::%s" % (parent.cpp, utils.to_token(name))
+		out += "\tchild(Type::%s, %s, \"begin_%s\");\n" % (utils.to_token(parent.name), token, fn)
+		out += "\tenter(Type::%s, Type::%s, %s, \"%s\", %d, %s);\n" % (utils.to_token(t.name), utils.to_token(parent.name), token, name,
+				_gen_push_start_state(t), _gen_push_newline(t, root))
+	body = _gen_put("<%s" % name)
+	for a in init_attrs:
+		body += "stack_.back().attrs[(int)atok_%s::%s] = 1;\n" % (t.cpp, utils.to_token(a.name))
+		body += _gen_put(" %s=\"" % a.name)
+		body += _gen_push_value(a.type, _gen_push_arg(a), True)
+		body += _gen_put("\"")
+	out += utils.indent(body)
 	out += "}\n"
 	return out
 
+def _gen_push_end(t: UxsdComplex, fn: str, name: str, parent: Optional[UxsdComplex]) -> str:
+	out = ""
+	out += "void end_%s(){\n" % fn
+	if parent is None:
+		out += "\tleave(Type::%s, Type::%s, -1, \"end_%s\");\n" % (utils.to_token(t.name), utils.to_token(t.name), fn)
+		out += "\tw.flush();\n"
+	else:
+		out += "\tleave(Type::%s, Type::%s, (int)gtok_%s::%s, \"end_%s\");\n" % (utils.to_token(t.name), utils.to_token(parent.name),
+				parent.cpp, utils.to_token(name), fn)
+	out += "}\n"
+	return out
+
+def _gen_push_fns(t: UxsdComplex) -> str:
+	"""Generate the public methods of Push<Root> for the attributes and content of t."""
+	out = ""
+	for a in t.attrs:
+		if pass_at_init(a):
+			continue
+		stub = _gen_stub_suffix(a, t.name)
+		out += "void set_%s(%s value){\n" % (stub, a.type.cpp)
+		out += "\tattribute(Type::%s, (int)atok_%s::%s, \"set_%s\");\n" % (utils.to_token(t.name), t.cpp, utils.to_token(a.name), stub)
+		if a.default_value is not None:
+			out += "\tif(compact_ && !(%s)) return;\n" % _gen_differs_from_default(a, "value")
+		body = _gen_put(" %s=\"" % a.name)
+		body += _gen_push_value(a.type, "value", True)
+		body += _gen_put("\"")
+		out += utils.indent(body)
+		out += "}\n"
+
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		for e in t.content.children:
+			stub = _gen_stub_suffix(e, t.name)
+			if isinstance(e.type, UxsdComplex):
+				out += _gen_push_begin(e.type, stub, e.name, t)
+				out += _gen_push_end(e.type, stub, e.name, t)
+			else:
+				verb = "add" if e.many else "set"
+				out += "void %s_%s(%s value){\n" % (verb, stub, e.type.cpp)
+				out += "\tchild(Type::%s, (int)gtok_%s::%s, \"%s_%s\");\n" % (utils.to_token(t.name), t.cpp, utils.to_token(e.name), verb, stub)
+				body = _gen_put("<%s>" % e.name)
+				body += _gen_push_value(e.type, "value", False)
+				body += _gen_put("</%s>" % e.name)
+				out += utils.indent(body)
+				out += "\tif(pretty_) w.put(\"\\n\");\n"
+				out += "}\n"
+	elif isinstance(t.content, UxsdLeaf):
+		out += "void set_%s_value(%s value){\n" % (t.name, t.content.type.cpp)
+		out += "\texpect(Type::%s, \"set_%s_value\");\n" % (utils.to_token(t.name), t.name)
+		out += "\tif(stack_.back().state != 0) noreturn_report(report_error, \"set_%s_value called twice.\");\n" % t.name
+		out += "\tclose_start_tag(false);\n"
+		out += "\tstack_.back().state = 1;\n"
+		out += utils.indent(_gen_push_value(t.content.type, "value", False))
+		out += "}\n"
+	return _merge_puts(out)
+
+def gen_push_class(schema: UxsdSchema) -> str:
+	"""Generate Push<Root>, a writer which is driven by begin_*, set_* and end_*
+	calls instead of reading from a <Root>Base implementation.
+
+	Every call is checked against the schema with the same tables and error
+	functions as the loaders, and its output is written to the XmlWriter at once.
+	Only the open elements are kept, so its memory is proportional to the depth
+	of the document.
+	"""
+	root = schema.root_element
+	assert isinstance(root.type, UxsdComplex)
+	pname = utils.to_pascalcase(root.name)
+	max_attrs = max([len(t.attrs) for t in schema.complex_types] + [1])
+	max_all = max([len(t.content.children) for t in schema.complex_types if isinstance(t.content, UxsdAll)] + [1])
+
+	out = ""
+	out += "/**\n"
+	out += " * Writes a %s document from calls to begin_*, set_*, add_* and end_*, without\n" % root.name
+	out += " * an implementation of {pname}Base. Elements are written as soon as they are begun,\n".format(pname=pname)
+	out += " * and only the open ones are kept, so a document of any size takes memory\n"
+	out += " * proportional to its depth. The calls are checked against the schema as\n"
+	out += " * load_%s_xml checks a document, and errors throw std::runtime_error.\n" % root.name
+	out += " *\n"
+	out += " * Required non-string attributes are arguments of begin_*. The other attributes\n"
+	out += " * are set with set_* before the first child or value of their element.\n"
+	out += " * Strings must not be null.\n"
+	out += " */\n"
+	out += "class Push{pname} {{\n".format(pname=pname)
+	out += "public:\n"
+	out += "\t/* Only the PRETTY and COMPACT profiles can be written, since CANONICAL needs attributes sorted. */\n"
+	out += "\texplicit Push{pname}(XmlWriter &w_in, XmlWriteProfile profile = XmlWriteProfile::PRETTY)\n".format(pname=pname)
+	out += "\t\t\t: w(w_in), pretty_(profile == XmlWriteProfile::PRETTY), compact_(profile == XmlWriteProfile::COMPACT) {\n"
+	out += "\t\tif(profile == XmlWriteProfile::CANONICAL)\n"
+	out += "\t\t\tthrow std::invalid_argument(\"Push{pname} can't write the CANONICAL profile.\");\n".format(pname=pname)
+	out += "\t}\n"
+	out += "\tPush{pname}(const Push{pname} &) = delete;\n".format(pname=pname)
+	out += "\tPush{pname} &operator=(const Push{pname} &) = delete;\n".format(pname=pname)
+	out += "\n"
+	out += "\t/* Number of elements which are begun and not yet ended. */\n"
+	out += "\tsize_t depth() const { return stack_.size(); }\n"
+	out += "\n"
+	out += utils.indent(_gen_push_begin(root.type, root.name, root.name, None, True))
+	out += utils.indent(_gen_push_end(root.type, root.name, root.name, None))
+	for t in schema.complex_types:
+		out += utils.indent(_gen_push_fns(t))
+
+	out += "private:\n"
+	out += "\tenum class Type {%s};\n" % ", ".join(utils.to_token(t.name) for t in schema.complex_types)
+	out += "\tstatic const char *type_name(Type type){\n"
+	out += "\t\tstatic const char *lookup[] = {%s};\n" % ", ".join("\"%s\"" % t.name for t in schema.complex_types)
+	out += "\t\treturn lookup[(int)type];\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* An open element. */\n"
+	out += "\tstruct Frame {\n"
+	out += "\t\tType type;\n"
+	out += "\t\tType parent;\n"
+	out += "\t\tint token; /* gtok_* value of the element in its parent, or -1 for the root. */\n"
+	out += "\t\tconst char *name;\n"
+	out += "\t\tbool open; /* The start tag isn't closed yet, so attributes can be set. */\n"
+	out += "\t\tbool newline;\n"
+	out += "\t\tint state; /* DFA state for xs:sequence and xs:choice, 1 if a leaf's value is written. */\n"
+	out += "\t\tstd::bitset<%d> attrs;\n" % max_attrs
+	out += "\t\tstd::bitset<%d> children; /* For xs:all. */\n" % max_all
+	out += "\t};\n"
+	out += "\n"
+	out += "\t/* The first N bits of x, for the error functions of a type with N attributes or children. */\n"
+	out += "\ttemplate<std::size_t N, std::size_t M>\n"
+	out += "\tstatic std::bitset<N> prefix(const std::bitset<M> &x){\n"
+	out += "\t\tstd::bitset<N> out;\n"
+	out += "\t\tfor(std::size_t i=0; i<N; i++) out[i] = x[i];\n"
+	out += "\t\treturn out;\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tvoid expect(Type type, const char *fn){\n"
+	out += "\t\tif(stack_.empty() || stack_.back().type != type)\n"
+	out += "\t\t\tnoreturn_report(report_error, (std::string(fn) + \" called outside of an element of type \" + type_name(type) + \".\").c_str());\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tvoid enter(Type type, Type parent, int token, const char *name, int state, bool newline){\n"
+	out += "\t\tFrame f;\n"
+	out += "\t\tf.type = type;\n"
+	out += "\t\tf.parent = parent;\n"
+	out += "\t\tf.token = token;\n"
+	out += "\t\tf.name = name;\n"
+	out += "\t\tf.open = true;\n"
+	out += "\t\tf.newline = newline;\n"
+	out += "\t\tf.state = state;\n"
+	out += "\t\tstack_.push_back(f);\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* Check and advance the content of the open element of type parent for a child. */\n"
+	out += "\tvoid child(Type parent, int token, const char *fn){\n"
+	out += "\t\texpect(parent, fn);\n"
+	out += "\t\tclose_start_tag(false);\n"
+	out += "\t\tFrame &f = stack_.back();\n"
+	out += "\t\t(void)f;\n"
+	out += "\t\tswitch(parent){\n"
+	for t in schema.complex_types:
+		if isinstance(t.content, UxsdDfa):
+			n = len(t.content.dfa.alphabet)
+			out += "\t\tcase Type::%s: {\n" % utils.to_token(t.name)
+			out += "\t\t\tint next = gstate_%s[f.state][token];\n" % t.cpp
+			out += "\t\t\tif(next == -1)\n"
+			out += "\t\t\t\tdfa_error(gtok_lookup_%s[token], gstate_%s[f.state], gtok_lookup_%s, %d, report_error);\n" % (t.cpp, t.cpp, t.cpp, n)
+			out += "\t\t\tf.state = next;\n"
+			out += "\t\t\tbreak;\n"
+			out += "\t\t}\n"
+		elif isinstance(t.content, UxsdAll):
+			out += "\t\tcase Type::%s:\n" % utils.to_token(t.name)
+			out += "\t\t\tif(f.children[token] == 0) f.children[token] = 1;\n"
+			out += "\t\t\telse noreturn_report(report_error, (\"Duplicate element \" + std::string(gtok_lookup_%s[token]) + \" in <\" + f.name + \">.\").c_str());\n" % t.cpp
+			out += "\t\t\tbreak;\n"
+	out += "\t\tdefault: break; /* Not possible. */\n"
+	out += "\t\t}\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tvoid attribute(Type type, int token, const char *fn){\n"
+	out += "\t\texpect(type, fn);\n"
+	out += "\t\tFrame &f = stack_.back();\n"
+	out += "\t\tif(!f.open)\n"
+	out += "\t\t\tnoreturn_report(report_error, (std::string(fn) + \" called after the content of <\" + f.name + \"> was begun.\").c_str());\n"
+	out += "\t\tif(f.attrs[token] == 0) f.attrs[token] = 1;\n"
+	out += "\t\telse noreturn_report(report_error, (std::string(fn) + \" called twice in <\" + f.name + \">.\").c_str());\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tvoid close_start_tag(bool empty){\n"
+	out += "\t\tFrame &f = stack_.back();\n"
+	out += "\t\tif(!f.open) return;\n"
+	out += "\t\tswitch(f.type){\n"
+	for t in schema.complex_types:
+		if not any(not a.optional for a in t.attrs):
+			continue
+		n = len(t.attrs)
+		mask = "".join(["1" if x.optional else "0" for x in t.attrs][::-1])
+		out += "\t\tcase Type::%s: {\n" % utils.to_token(t.name)
+		out += "\t\t\tstd::bitset<%d> test_astate = prefix<%d>(f.attrs) | std::bitset<%d>(0b%s);\n" % (n, n, n, mask)
+		out += "\t\t\tif(!test_astate.all()) attr_error(test_astate, atok_lookup_%s, report_error);\n" % t.cpp
+		out += "\t\t\tbreak;\n"
+		out += "\t\t}\n"
+	out += "\t\tdefault: break;\n"
+	out += "\t\t}\n"
+	out += "\t\tf.open = false;\n"
+	out += "\t\tif(empty) w.put(\"/>\");\n"
+	out += "\t\telse w.put(\">\");\n"
+	out += "\t\tif(pretty_ && (empty || f.newline)) w.put(\"\\n\");\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tvoid leave(Type type, Type parent, int token, const char *fn){\n"
+	out += "\t\texpect(type, fn);\n"
+	out += "\t\tFrame &f = stack_.back();\n"
+	out += "\t\tif(f.parent != parent || f.token != token)\n"
+	out += "\t\t\tnoreturn_report(report_error, (std::string(fn) + \" called in <\" + f.name + \">.\").c_str());\n"
+	out += "\t\tswitch(f.type){\n"
+	for t in schema.complex_types:
+		if isinstance(t.content, UxsdDfa):
+			dfa = t.content.dfa
+			reject_cond = " && ".join(["f.state != %d" % x for x in dfa.accepts])
+			out += "\t\tcase Type::%s:\n" % utils.to_token(t.name)
+			out += "\t\t\tif(%s)\n" % reject_cond
+			out += "\t\t\t\tdfa_error((\"</\" + std::string(f.name) + \">\").c_str(), gstate_%s[f.state], gtok_lookup_%s, %d, report_error);\n" % (t.cpp, t.cpp, len(dfa.alphabet))
+			out += "\t\t\tbreak;\n"
+		elif isinstance(t.content, UxsdAll):
+			n = len(t.content.children)
+			mask = "".join(["1" if x.optional else "0" for x in t.content.children][::-1])
+			out += "\t\tcase Type::%s: {\n" % utils.to_token(t.name)
+			out += "\t\t\tstd::bitset<%d> test_gstate = prefix<%d>(f.children) | std::bitset<%d>(0b%s);\n" % (n, n, n, mask)
+			out += "\t\t\tif(!test_gstate.all()) all_error(test_gstate, gtok_lookup_%s, report_error);\n" % t.cpp
+			out += "\t\t\tbreak;\n"
+			out += "\t\t}\n"
+	out += "\t\tdefault: break;\n"
+	out += "\t\t}\n"
+	out += "\t\tif(f.open){\n"
+	out += "\t\t\tclose_start_tag(true);\n"
+	out += "\t\t}else{\n"
+	out += "\t\t\tw.put(\"</\");\n"
+	out += "\t\t\tw.put(f.name, std::strlen(f.name));\n"
+	out += "\t\t\tw.put(\">\");\n"
+	out += "\t\t\tif(pretty_) w.put(\"\\n\");\n"
+	out += "\t\t}\n"
+	out += "\t\tstack_.pop_back();\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\tXmlWriter &w;\n"
+	out += "\tbool pretty_;\n"
+	out += "\tbool compact_;\n"
+	out += "\tbool started_ = false;\n"
+	out += "\tstd::vector<Frame> stack_;\n"
+	out += "\tstd::function<void(const char *)> throw_error_ = [](const char *message) {\n"
+	out += "\t\tthrow std::runtime_error(message);\n"
+	out += "\t};\n"
+	out += "\tconst std::function<void(const char *)> *report_error = &throw_error_;\n"
+	out += "};\n"
+	return out
+
 #
 
 def render_interface_header_file(schema: UxsdSchema, cmdline: str, input_file: str) -> str:
@@ -763,10 +2315,18 @@ def render_interface_header_file(schema: UxsdSchema, cmdline: str, input_file: s
 	out += cpp_templates.header_comment.substitute(x)
 	out += "\n/* All uxsdcxx functions and structs live in this namespace. */\n"
 	out += "\n"
+	out += "#include <chrono>\n"
+	out += "#include <cstdint>\n"
 	out += "#include <cstdlib>\n"
+	out += "#include <functional>\n"
+	out += "#include <stdexcept>\n"
 	out += "#include <tuple>\n"
+	out += "#include <utility>\n"
 	out += "\n"
 	out += "namespace uxsd {"
+	out += "\n"
+	out += cpp_templates.progress_defn
+	out += cpp_templates.write_cursor_defn
 
 	if schema.enums:
 		out += "\n\n/* Enum tokens generated from XSD enumerations. */\n"
@@ -779,8 +2339,18 @@ def render_interface_header_file(schema: UxsdSchema, cmdline: str, input_file: s
 
 	return out
 
-def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interface_header_file_name: str) -> str:
-	"""Render a C++ header file to a string."""
+def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interface_header_file_name: str, instrument: bool = False, features: AbstractSet[str] = frozenset()) -> str:
+	"""Render a C++ header file to a string.
+
+	If instrument is set, the loaders count the calls and cycles of every
+	load_*, lex_* and callback, and print a report to std::cerr after finish_load.
+
+	features are the optional parts of the header to generate. See FEATURES.
+	"""
+	if not schema.has_ids:
+		features = features - {"ids"}
+	if "batch" in features:
+		features = features | {"arena"}
 	out = ""
 	x = {"version": __version__,
 		"cmdline": cmdline,
@@ -788,20 +2358,75 @@ def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interf
 		"md5": utils.md5(input_file)}
 	out += cpp_templates.header_comment.substitute(x)
 	out += cpp_templates.includes
+	if instrument:
+		out += cpp_templates.instrument_includes
+	if "arena" in features:
+		out += cpp_templates.arena_includes
+	if "hash-cons" in features:
+		out += cpp_templates.hash_cons_includes
+	if "ids" in features:
+		out += cpp_templates.id_index_includes
+	if "cache" in features:
+		out += cpp_templates.snapshot_includes
+	if "batch" in features:
+		out += cpp_templates.xml_batch_includes
+	if "decompress" in features:
+		out += cpp_templates.xml_decompressor_includes
+	if "simd-escape" in features:
+		out += cpp_templates.xml_escape_simd_includes
+	if "parallel-write" in features:
+		out += cpp_templates.xml_write_parallel_includes
 	out += '#include "{}"'.format(interface_header_file_name)
 	out += "\n/* All uxsdcxx functions and structs live in this namespace. */\n"
 	out += "namespace uxsd {\n"
 
 	out += cpp_templates.get_line_number_decl
 	out += cpp_templates.report_error_decl
+	if "arena" in features:
+		out += cpp_templates.xml_arena_defn
+	out += "\n"
+	out += gen_load_options(features)
+	if "batch" in features:
+		out += cpp_templates.xml_batch_defn
+	if "hash-cons" in features:
+		out += cpp_templates.hash_cons_defn
+	if "ids" in features:
+		out += cpp_templates.id_index_defn
+	if "cache" in features:
+		out += cpp_templates.snapshot_defn
+	if "decompress" in features:
+		out += cpp_templates.xml_decompressor_defn
+	out += cpp_templates.xml_escape_defn
+	if "simd-escape" in features:
+		out += cpp_templates.xml_escape_simd_defn
+		out += cpp_templates.xml_writer_defn.substitute(simd_escape=cpp_templates.xml_writer_simd_escape)
+	else:
+		out += cpp_templates.xml_writer_defn.substitute(simd_escape="")
+	out += cpp_templates.xml_write_profile_defn
+	out += "\n"
+	out += gen_write_options(features)
+	if "parallel-write" in features:
+		out += cpp_templates.xml_write_parallel_defn
+	if instrument:
+		out += cpp_templates.instrument_defn
+
+	out += "\n/* State of a single load. */\n"
+	if "ids" in features:
+		out += gen_id_enums(schema)
+		out += "\n"
+	out += gen_load_state(schema, features)
 
 	out += "\n/* Declarations for internal load functions for the complex types. */\n"
 	load_fn_decls = []
 	for t in schema.complex_types:
-		load_fn_decls.append("template <class T, typename Context>")
-		load_fn_decls.append("inline void load_%s(const pugi::xml_node &root, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug);" % (t.name))
+		load_fn_decls.append("template <class T, typename Context, typename LoadState>")
+		load_fn_decls.append("inline void load_%s(const pugi::xml_node &root, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug, LoadState *load_state);" % t.name)
 		if sum(pass_at_init(attr) for attr in t.attrs) > 0:
 			load_fn_decls.append("inline void load_%s_required_attributes(const pugi::xml_node &root, %s, const std::function<void(const char*)> * report_error);" % (t.name, _gen_required_attribute_arg_list("", t.attrs, out=True)))
+		if "cache" in features:
+			load_fn_decls.append("inline void snapshot_%s(const pugi::xml_node &root, SnapshotWriter &w, const std::function<void(const char*)> *report_error);" % t.name)
+			load_fn_decls.append("template <class T, typename Context, typename LoadState>")
+			load_fn_decls.append("inline void replay_%s(SnapshotReader &r, T &out, Context &context, const std::function<void(const char*)> *report_error, ptrdiff_t *offset_debug, LoadState *load_state);" % t.name)
 	out += "\n".join(load_fn_decls)
 
 	out += "\n\n/* Declarations for internal write functions for the complex types. */\n"
@@ -809,14 +2434,17 @@ def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interf
 	for t in schema.complex_types:
 		if t.content is None:
 			continue
-		write_fn_decls.append("template <class T>")
-		write_fn_decls.append("inline void write_%s(T &in, std::ostream &os, const void *data, void *iter);" % (t.name))
+		write_fn_decls.append("template <XmlWriteProfile P, class T, typename Context>")
+		write_fn_decls.append("inline void write_%s(T &in, XmlWriter &w, Context &context, const XmlWriteOptions &options);" % t.name)
 	out += "\n".join(write_fn_decls)
 
 	out += "\n\n/* Load function for the root element. */\n"
-	out += load_fn_from_root_element(schema.root_element)
+	out += load_fn_from_root_element(schema.root_element, "ids" in features, instrument, features)
+	if "batch" in features:
+		out += "\n"
+		out += batch_load_fn_from_root_element(schema.root_element, features)
 	out += "\n/* Write function for the root element. */\n"
-	out += write_fn_from_root_element(schema.root_element)
+	out += write_fn_from_root_element(schema.root_element, features)
 
 	out += "\n\n"
 	out += triehash.gen_prelude()
@@ -824,7 +2452,7 @@ def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interf
 	complex_type_tokens = [tokens_from_complex_type(t) for t in schema.complex_types]
 	out += "\n/* Tokens for attribute and node names. */\n"
 	out += "\n".join(complex_type_tokens)
-	complex_type_lexers = [lexer_from_complex_type(t) for t in schema.complex_types]
+	complex_type_lexers = [lexer_from_complex_type(t, instrument) for t in schema.complex_types]
 	out += "\n\n/* Internal lexers. These convert the PugiXML node names to input tokens. */\n"
 	out += "\n".join(complex_type_lexers)
 
@@ -837,26 +2465,45 @@ def render_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interf
 
 	if schema.enums:
 		enum_lookups = [lookup_from_enum(t) for t in schema.enums]
-		enum_lexers = [lexer_from_enum(t) for t in schema.enums]
+		enum_lexers = [lexer_from_enum(t, instrument) for t in schema.enums]
 		out += "\n\n/* Lookup tables for enums. */\n"
 		out += "\n".join(enum_lookups)
 		out += "\n\n/* Lexers(string->token functions) for enums. */\n"
 		out += "\n".join(enum_lexers)
 
 	# No need to generate a loader for const char * or enums.
-	simple_type_loaders = [load_fn_from_simple_type(t) for t in schema.simple_types if not isinstance(t, (UxsdString, UxsdEnum))]
-	complex_type_attr_loaders = [load_required_attrs_fn_from_complex_type(t) for t in schema.complex_types if sum(pass_at_init(attr) for attr in t.attrs) > 0]
-	complex_type_loaders = [load_fn_from_complex_type(t) for t in schema.complex_types]
+	simple_type_loaders = [load_fn_from_simple_type(t, instrument) for t in schema.simple_types if not isinstance(t, (UxsdString, UxsdEnum))]
+	complex_type_attr_loaders = [load_required_attrs_fn_from_complex_type(t, instrument) for t in schema.complex_types if sum(pass_at_init(attr) for attr in t.attrs) > 0]
+	complex_type_loaders = [load_fn_from_complex_type(t, "progress" in features and t in schema.top_level_types, instrument, features) for t in schema.complex_types]
 	out += "\n\n/* Internal loading functions, which validate and load a PugiXML DOM tree into memory. */\n"
 	out += "\n".join(simple_type_loaders)
 	out += "\n".join(complex_type_attr_loaders)
 	out += "\n".join(complex_type_loaders)
+	if "ids" in features:
+		out += "\n" + resolve_fn_from_schema(schema)
+
+	if "cache" in features:
+		snapshot_fns = [snapshot_fn_from_complex_type(t) for t in schema.complex_types]
+		replay_fns = [replay_fn_from_complex_type(t, features) for t in schema.complex_types]
+		out += "\n\n/* Internal functions to write and replay snapshots for load_%s_cached. */\n" % schema.root_element.name
+		out += "\n".join(snapshot_fns)
+		out += "\n".join(replay_fns)
+		out += "\n/* Cached load function for the root element. */\n"
+		out += cached_load_fn_from_root_element(schema.root_element, "ids" in features, "%s %s" % (utils.md5(input_file), __version__))
 
 	# No need to generate a writer for elements without content.
-	complex_type_writers = [write_fn_from_complex_type(t) for t in schema.complex_types if t.content is not None]
+	complex_type_writers = [write_fn_from_complex_type(t, t in schema.top_level_types, features) for t in schema.complex_types if t.content is not None]
 	out += "\n\n/* Internal writing functions, which uxsdcxx uses to write out a class. */\n"
 	out += "\n".join(complex_type_writers)
 
+	if "dom" in features:
+		out += "\n\n/* Implementation of the interface over a PugiXML DOM. */\n"
+		out += gen_dom_class(schema)
+
+	if "push" in features:
+		out += "\n\n/* Push-mode writer, which checks the calls against the schema. */\n"
+		out += gen_push_class(schema)
+
 	if schema.has_dfa:
 		out += cpp_templates.dfa_error_defn
 	if schema.has_all:
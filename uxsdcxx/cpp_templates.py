@@ -87,9 +87,14 @@ impl_comment = Template("""/*
 """)
 
 includes = """
+#include <algorithm>
 #include <bitset>
 #include <cassert>
+#include <cerrno>
+#include <cstddef>
+#include <cstdio>
 #include <cstring>
+#include <exception>
 #include <iostream>
 #include <sstream>
 #include <memory>
@@ -99,8 +104,16 @@ includes = """
 #include <error.h>
 #include <stddef.h>
 #include <stdint.h>
+#include <unistd.h>
 #include "pugixml.hpp"
 
+#if __cplusplus >= 201703L && defined(__has_include)
+#if __has_include(<charconv>)
+#include <charconv>
+#endif
+#endif
+#include <type_traits>
+
 """
 
 dfa_error_decl = """
@@ -132,6 +145,9 @@ get_line_number_decl = """
  * byte offset.
  */
 inline void get_line_number(const char *filename, std::ptrdiff_t offset, int * line, int * col);
+
+/* Same as above, but from the text of the file in memory. */
+inline void get_line_number(const char *data, std::size_t size, std::ptrdiff_t offset, int * line, int * col);
 """
 
 dfa_error_defn = """
@@ -141,6 +157,7 @@ inline void dfa_error(const char *wrong, const int *states, const char * const *
 		if(states[i] != -1) expected.push_back(lookup[i]);
 	}
 
+	if(expected.empty()) noreturn_report(report_error, ("Expected no more elements, found " + std::string(wrong)).c_str());
 	std::string expected_or = expected[0];
 	for(unsigned int i=1; i<expected.size(); i++)
 		expected_or += std::string(" or ") + expected[i];
@@ -223,6 +240,19 @@ inline void get_line_number(const char *filename, std::ptrdiff_t target_offset,
 	*col = target_offset - current_line_offset;
 	fclose(f);
 }
+
+inline void get_line_number(const char *data, std::size_t size, std::ptrdiff_t target_offset, int * line, int * col) {
+	int current_line = 1;
+	std::ptrdiff_t current_line_offset = 0;
+	for (std::size_t i = 0; i < size && (std::ptrdiff_t)i < target_offset; ++i) {
+		if (data[i] == '\\n') {
+			current_line += 1;
+			current_line_offset = i;
+		}
+	}
+	*line = current_line;
+	*col = target_offset - current_line_offset;
+}
 """
 
 report_error_decl = """
@@ -231,3 +261,1535 @@ report_error_decl = """
     throw std::runtime_error("Unreachable!");
 }
 """
+
+arena_includes = """#include <new>
+#include <sys/mman.h>
+"""
+
+xml_arena_defn = """
+/**
+ * A growing memory region which can back the PugiXML DOM across repeated loads.
+ *
+ * PugiXML only has global allocation hooks, so the arena is installed for the
+ * current thread by an XmlArenaScope. Allocations made while no arena is
+ * installed go to the previously installed PugiXML allocator. Deallocation of
+ * arena memory is a no-op: the whole region is recycled by reset().
+ *
+ * If use_huge_pages is set, blocks are mapped with MAP_HUGETLB, falling back to
+ * madvise(MADV_HUGEPAGE) when no huge pages are reserved.
+ */
+class XmlArena {
+public:
+	explicit XmlArena(size_t initial_size = 16 << 20, bool use_huge_pages = false) :
+		initial_size_(initial_size), use_huge_pages_(use_huge_pages), current_(0), offset_(0) {}
+	~XmlArena() {
+		for(auto &block : blocks_) munmap(block.data, block.size);
+	}
+	XmlArena(const XmlArena &) = delete;
+	XmlArena &operator=(const XmlArena &) = delete;
+
+	inline void *allocate(size_t size){
+		size = (size + ALIGNMENT - 1) & ~(ALIGNMENT - 1);
+		while(current_ < blocks_.size()){
+			Block &block = blocks_[current_];
+			if(offset_ + size <= block.size){
+				void *out = block.data + offset_;
+				offset_ += size;
+				return out;
+			}
+			current_++;
+			offset_ = 0;
+		}
+		size_t block_size = blocks_.empty() ? initial_size_ : blocks_.back().size * 2;
+		while(block_size < size) block_size *= 2;
+		blocks_.push_back(map_block(block_size));
+		current_ = blocks_.size() - 1;
+		offset_ = size;
+		return blocks_.back().data;
+	}
+
+	inline bool owns(const void *ptr) const {
+		for(const auto &block : blocks_){
+			if(ptr >= block.data && ptr < block.data + block.size) return true;
+		}
+		return false;
+	}
+
+	/**
+	 * Forget all allocations. If the last load needed more than one block, they are
+	 * replaced with a single block large enough for all of them, so that the next
+	 * load of a similar document is served from one contiguous region.
+	 */
+	inline void reset(){
+		if(blocks_.size() > 1){
+			size_t total = 0;
+			for(auto &block : blocks_){
+				total += block.size;
+				munmap(block.data, block.size);
+			}
+			blocks_.clear();
+			blocks_.push_back(map_block(total));
+		}
+		current_ = 0;
+		offset_ = 0;
+	}
+
+	inline size_t capacity() const {
+		size_t total = 0;
+		for(const auto &block : blocks_) total += block.size;
+		return total;
+	}
+
+private:
+	static constexpr size_t ALIGNMENT = alignof(std::max_align_t);
+	struct Block {
+		char *data;
+		size_t size;
+	};
+
+	inline Block map_block(size_t size){
+		void *data = MAP_FAILED;
+#ifdef MAP_HUGETLB
+		if(use_huge_pages_)
+			data = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_HUGETLB, -1, 0);
+#endif
+		if(data == MAP_FAILED){
+			data = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+			if(data == MAP_FAILED) throw std::bad_alloc();
+#ifdef MADV_HUGEPAGE
+			if(use_huge_pages_) madvise(data, size, MADV_HUGEPAGE);
+#endif
+		}
+		return Block{static_cast<char *>(data), size};
+	}
+
+	size_t initial_size_;
+	bool use_huge_pages_;
+	std::vector<Block> blocks_;
+	size_t current_;
+	size_t offset_;
+};
+
+/**
+ * Internal state for routing PugiXML allocations to the current thread's arena.
+ */
+struct xml_arena_hooks {
+	static XmlArena *&current(){
+		static thread_local XmlArena *arena = nullptr;
+		return arena;
+	}
+	static pugi::allocation_function &fallback_allocate(){
+		static pugi::allocation_function fn = nullptr;
+		return fn;
+	}
+	static pugi::deallocation_function &fallback_deallocate(){
+		static pugi::deallocation_function fn = nullptr;
+		return fn;
+	}
+	static void *allocate(size_t size){
+		XmlArena *arena = current();
+		if(arena) return arena->allocate(size);
+		return fallback_allocate()(size);
+	}
+	static void deallocate(void *ptr){
+		XmlArena *arena = current();
+		if(arena && arena->owns(ptr)) return;
+		fallback_deallocate()(ptr);
+	}
+	/* Install the hooks once. Earlier allocations are still freed by the previous deallocator. */
+	static void install(){
+		static bool installed = [](){
+			fallback_allocate() = pugi::get_memory_allocation_function();
+			fallback_deallocate() = pugi::get_memory_deallocation_function();
+			pugi::set_memory_management_functions(allocate, deallocate);
+			return true;
+		}();
+		(void)installed;
+	}
+};
+
+/**
+ * Installs an XmlArena for the current thread while in scope.
+ * Documents allocated in the scope must be destroyed before it ends.
+ */
+class XmlArenaScope {
+public:
+	explicit XmlArenaScope(XmlArena &arena) : previous_(xml_arena_hooks::current()) {
+		xml_arena_hooks::install();
+		xml_arena_hooks::current() = &arena;
+	}
+	~XmlArenaScope() {
+		xml_arena_hooks::current() = previous_;
+	}
+	XmlArenaScope(const XmlArenaScope &) = delete;
+	XmlArenaScope &operator=(const XmlArenaScope &) = delete;
+
+private:
+	XmlArena *previous_;
+};
+"""
+
+model_pools_defn = """
+#ifndef UXSD_MODEL_POOLS
+#define UXSD_MODEL_POOLS
+/**
+ * A size and an offset pointing into a pool, and the number of elements
+ * reserved for the range there.
+ */
+struct collapsed_vec {
+	uint32_t offset = 0;
+	uint32_t size = 0;
+	uint32_t capacity = 0;
+};
+
+/**
+ * An arena of Ts, allocated in fixed-size chunks. Elements never move, and
+ * they are addressed by 32-bit indices.
+ */
+template<typename T>
+class typed_pool {
+public:
+	static constexpr uint32_t CHUNK_BITS = 12;
+	static constexpr uint32_t CHUNK_SIZE = 1u << CHUNK_BITS;
+
+	inline T &operator[](uint32_t i){
+		return chunks_[i >> CHUNK_BITS][i & (CHUNK_SIZE - 1)];
+	}
+	inline const T &operator[](uint32_t i) const {
+		return chunks_[i >> CHUNK_BITS][i & (CHUNK_SIZE - 1)];
+	}
+	inline uint32_t size() const {
+		return size_;
+	}
+	inline void reserve(size_t n){
+		while(chunks_.size() * CHUNK_SIZE < n) chunks_.emplace_back(new T[CHUNK_SIZE]);
+	}
+	inline uint32_t emplace_back(){
+		reserve(size_ + 1);
+		(*this)[size_] = T();
+		return size_++;
+	}
+	inline uint32_t push_back(const T &x){
+		reserve(size_ + 1);
+		(*this)[size_] = x;
+		return size_++;
+	}
+	/* Append n default elements and return the index of the first one. */
+	inline uint32_t grow(size_t n){
+		uint32_t first = size_;
+		reserve(size_ + n);
+		for(size_t i = 0; i < n; i++) (*this)[size_++] = T();
+		return first;
+	}
+	inline void clear(){
+		chunks_.clear();
+		size_ = 0;
+	}
+	inline size_t memory_usage() const {
+		return chunks_.size() * CHUNK_SIZE * sizeof(T) + chunks_.capacity() * sizeof(chunks_[0]);
+	}
+
+private:
+	std::vector<std::unique_ptr<T[]>> chunks_;
+	uint32_t size_ = 0;
+};
+
+/**
+ * Make room for n elements in the range vec. preallocate_* reserves the
+ * children of an element this way, so adding them never moves the range.
+ *
+ * A range which ends at the end of its pool grows in place. Otherwise it's
+ * copied to the end of the pool, leaving a hole behind.
+ */
+template<typename T>
+inline void reserve_range(typed_pool<T> &pool, collapsed_vec &vec, size_t n){
+	if(vec.capacity >= n) return;
+	if(vec.offset + vec.capacity == pool.size()){
+		pool.grow(n - vec.capacity);
+	}else{
+		uint32_t offset = pool.grow(n);
+		for(uint32_t i = 0; i < vec.size; i++) pool[offset + i] = pool[vec.offset + i];
+		vec.offset = offset;
+	}
+	vec.capacity = static_cast<uint32_t>(n);
+}
+
+/**
+ * Append an element to the range vec in pool and return its index.
+ *
+ * The element goes into the capacity reserved for the range if there's any
+ * left. Otherwise a range at the end of the pool grows by one, and any other
+ * range is moved with twice its capacity, so that interleaved appends don't
+ * copy it every time. Moving a range leaves the structs at its old indices
+ * behind, so pointers to them go stale.
+ */
+template<typename T>
+inline uint32_t append_to_range(typed_pool<T> &pool, collapsed_vec &vec){
+	if(vec.size == vec.capacity){
+		bool at_end = vec.offset + vec.capacity == pool.size();
+		reserve_range(pool, vec, at_end ? vec.capacity + 1 : (vec.capacity > 0 ? 2 * size_t(vec.capacity) : 1));
+	}
+	return vec.offset + vec.size++;
+}
+
+/**
+ * Interned string storage. Equal strings are stored once and get the same pointer,
+ * which stays valid until clear().
+ */
+class string_pool {
+public:
+	inline const char *intern(const char *str){
+		if(str == nullptr) return nullptr;
+		auto it = index_.find(str);
+		if(it != index_.end()) return *it;
+		size_t len = std::strlen(str) + 1;
+		if(chunks_.empty() || used_ + len > chunk_size_){
+			chunk_size_ = len > CHUNK_SIZE ? len : CHUNK_SIZE;
+			chunks_.emplace_back(new char[chunk_size_]);
+			allocated_ += chunk_size_;
+			used_ = 0;
+		}
+		char *out = chunks_.back().get() + used_;
+		std::memcpy(out, str, len);
+		used_ += len;
+		index_.insert(out);
+		return out;
+	}
+	inline size_t size() const {
+		return index_.size();
+	}
+	inline void clear(){
+		index_.clear();
+		chunks_.clear();
+		allocated_ = 0;
+		used_ = 0;
+	}
+	/* The chunks, the buckets and the nodes of the index, which hold a next pointer, the string and its hash. */
+	inline size_t memory_usage() const {
+		return allocated_ + chunks_.capacity() * sizeof(chunks_[0]) + index_.bucket_count() * sizeof(void *) + index_.size() * 3 * sizeof(void *);
+	}
+
+private:
+	static constexpr size_t CHUNK_SIZE = 64 * 1024;
+	struct Hash {
+		/* FNV-1a */
+		inline size_t operator()(const char *str) const {
+			uint64_t h = 14695981039346656037ull;
+			for(; *str; str++){
+				h ^= (unsigned char)*str;
+				h *= 1099511628211ull;
+			}
+			return h;
+		}
+	};
+	struct Equal {
+		inline bool operator()(const char *a, const char *b) const {
+			return std::strcmp(a, b) == 0;
+		}
+	};
+	std::unordered_set<const char *, Hash, Equal> index_;
+	std::vector<std::unique_ptr<char[]>> chunks_;
+	size_t chunk_size_ = 0;
+	size_t allocated_ = 0;
+	size_t used_ = 0;
+};
+#endif
+"""
+
+hash_cons_includes = """#include <unordered_map>
+"""
+
+hash_cons_defn = """
+/**
+ * Internal helper for hash-consing subtrees during a load.
+ *
+ * Subtrees are hashed structurally: attribute names and values, text and child
+ * elements, in document order. The name of the subtree's root is left out, so that
+ * equal subtrees of the same type under different element names are shared.
+ * Hashes of all visited elements are memoized, so every node is hashed once.
+ */
+class SubtreeHashCons {
+public:
+	/* Canonical subtrees of a single complex type. */
+	class Table {
+	public:
+		/* Return the canonical id of a subtree equal to node, or -1. */
+		inline ptrdiff_t find(SubtreeHashCons &hash_cons, const pugi::xml_node &node){
+			auto range = subtrees_.equal_range(hash_cons.hash(node));
+			for(auto it = range.first; it != range.second; ++it){
+				if(equal(it->second.first, node)) return it->second.second;
+			}
+			return -1;
+		}
+		/* Register node as the next canonical subtree. */
+		inline void insert(SubtreeHashCons &hash_cons, const pugi::xml_node &node){
+			subtrees_.emplace(hash_cons.hash(node), std::make_pair(node, subtrees_.size()));
+		}
+
+	private:
+		std::unordered_multimap<uint64_t, std::pair<pugi::xml_node, size_t>> subtrees_;
+	};
+
+	inline uint64_t hash(const pugi::xml_node &node){
+		auto it = memo_.find(node.internal_object());
+		if(it != memo_.end()) return it->second;
+		uint64_t h = 14695981039346656037ull;
+		for(pugi::xml_attribute attr = node.first_attribute(); attr; attr = attr.next_attribute()){
+			h = mix(h, hash_str(attr.name()));
+			h = mix(h, hash_str(attr.value()));
+		}
+		for(pugi::xml_node child = node.first_child(); child; child = child.next_sibling()){
+			if(child.type() == pugi::node_element){
+				h = mix(h, hash_str(child.name()));
+				h = mix(h, hash(child));
+			}else{
+				h = mix(h, hash_str(child.value()));
+			}
+		}
+		memo_.emplace(node.internal_object(), h);
+		return h;
+	}
+
+	static inline bool equal(const pugi::xml_node &a, const pugi::xml_node &b){
+		pugi::xml_attribute x = a.first_attribute(), y = b.first_attribute();
+		for(; x && y; x = x.next_attribute(), y = y.next_attribute()){
+			if(std::strcmp(x.name(), y.name()) != 0 || std::strcmp(x.value(), y.value()) != 0) return false;
+		}
+		if(x || y) return false;
+		pugi::xml_node c = a.first_child(), d = b.first_child();
+		for(; c && d; c = c.next_sibling(), d = d.next_sibling()){
+			if(c.type() != d.type()) return false;
+			if(c.type() == pugi::node_element){
+				if(std::strcmp(c.name(), d.name()) != 0 || !equal(c, d)) return false;
+			}else if(std::strcmp(c.value(), d.value()) != 0){
+				return false;
+			}
+		}
+		return !c && !d;
+	}
+
+private:
+	static inline uint64_t hash_str(const char *str){
+		uint64_t h = 14695981039346656037ull;
+		for(; *str; str++){
+			h ^= (unsigned char)*str;
+			h *= 1099511628211ull;
+		}
+		return h;
+	}
+	static inline uint64_t mix(uint64_t h, uint64_t x){
+		return (h ^ (x + 0x9e3779b97f4a7c15ull + (h << 6) + (h >> 2))) * 1099511628211ull;
+	}
+
+	std::unordered_map<const void *, uint64_t> memo_;
+};
+"""
+
+id_index_includes = """#include <unordered_map>
+"""
+
+# The transcoder has its own IdIndex when foo_uxsdcxx.h is generated without
+# --ids, so it's guarded for when both have it.
+id_index_defn = """
+#ifndef UXSD_ID_INDEX
+#define UXSD_ID_INDEX
+/**
+ * Internal index of the xs:ID attributes and the xs:IDREF attributes seen during a load.
+ * Both are resolved when the document is loaded. Strings point into the PugiXML DOM,
+ * which outlives the index.
+ */
+class IdIndex {
+public:
+	/* An element with an ID: its type and its index in the list of contexts of that type. */
+	struct Entry {
+		int type;
+		size_t index;
+	};
+	/* An IDREF attribute, the index of its element's context and where it was found. */
+	struct Ref {
+		int attr;
+		size_t index;
+		const char *id;
+		ptrdiff_t offset;
+	};
+
+	/* Returns false if the ID is already in the index. */
+	inline bool insert(const char *id, int type, size_t index){
+		return ids_.emplace(id, Entry{type, index}).second;
+	}
+	inline const Entry *find(const char *id) const {
+		auto it = ids_.find(id);
+		return it == ids_.end() ? nullptr : &it->second;
+	}
+	inline void add_ref(const char *id, int attr, size_t index, ptrdiff_t offset){
+		refs_.push_back(Ref{attr, index, id, offset});
+	}
+	inline const std::vector<Ref> &refs() const {
+		return refs_;
+	}
+
+private:
+	struct Hash {
+		inline size_t operator()(const char *str) const {
+			size_t h = 14695981039346656037ull;
+			for(; *str; str++){
+				h ^= (unsigned char)*str;
+				h *= 1099511628211ull;
+			}
+			return h;
+		}
+	};
+	struct Equal {
+		inline bool operator()(const char *a, const char *b) const {
+			return std::strcmp(a, b) == 0;
+		}
+	};
+	std::unordered_map<const char *, Entry, Hash, Equal> ids_;
+	std::vector<Ref> refs_;
+};
+#endif
+"""
+
+snapshot_includes = """#include <fstream>
+#include <thread>
+#include <sys/stat.h>
+#include <unistd.h>
+"""
+
+snapshot_defn = """
+/**
+ * Internal helpers for load_*_cached.
+ *
+ * A snapshot records a document which was validated by a successful load: attribute
+ * and element tokens and parsed values, in document order. Its header records the
+ * XML file it was made from and the schema and machine it was written with, so a
+ * stale or foreign snapshot is never replayed.
+ */
+inline uint64_t snapshot_hash(const char *data, size_t size){
+	uint64_t h = 0x9e3779b97f4a7c15ull ^ size;
+	size_t i = 0;
+	for(; i + 8 <= size; i += 8){
+		uint64_t x;
+		std::memcpy(&x, data + i, 8);
+		h = (h ^ x) * 0xff51afd7ed558ccdull;
+		h ^= h >> 32;
+	}
+	for(; i < size; i++){
+		h = (h ^ (unsigned char)data[i]) * 1099511628211ull;
+	}
+	return h ^ (h >> 29);
+}
+
+struct SnapshotHeader {
+	char magic[8];
+	uint32_t byte_order;
+	char schema[64];
+	uint64_t xml_size;
+	int64_t xml_mtime;
+	uint64_t xml_hash;
+	/* Size and hash of the payload following the header. */
+	uint64_t size;
+	uint64_t hash;
+};
+
+class SnapshotWriter {
+public:
+	template<typename T>
+	inline void write(const T &x){
+		buf_.append((const char *)&x, sizeof(T));
+	}
+	inline void write_str(const char *str){
+		uint32_t len = std::strlen(str);
+		write(len);
+		buf_.append(str, len + 1);
+	}
+	/* Write a count which isn't known yet. Returns where to set_count it later. */
+	inline size_t reserve_count(){
+		size_t at = buf_.size();
+		write<uint32_t>(0);
+		return at;
+	}
+	inline void set_count(size_t at, uint32_t count){
+		std::memcpy(&buf_[at], &count, sizeof(count));
+	}
+	inline const std::string &data() const {
+		return buf_;
+	}
+
+private:
+	std::string buf_;
+};
+
+/* Snapshots are checked as a whole before replaying, so the reader doesn't check bounds. */
+class SnapshotReader {
+public:
+	SnapshotReader(const char *data) : p_(data) {}
+	template<typename T>
+	inline T read(){
+		T x;
+		std::memcpy(&x, p_, sizeof(T));
+		p_ += sizeof(T);
+		return x;
+	}
+	/* Strings are NUL-terminated in the snapshot, so they point into it. */
+	inline const char *read_str(){
+		uint32_t len = read<uint32_t>();
+		const char *str = p_;
+		p_ += len + 1;
+		return str;
+	}
+
+private:
+	const char *p_;
+};
+
+inline bool snapshot_read_file(const char *filename, std::string &out){
+	std::ifstream is(filename, std::ios::binary | std::ios::ate);
+	if(!is) return false;
+	std::streamoff size = is.tellg();
+	if(size < 0) return false;
+	out.resize(size);
+	is.seekg(0);
+	is.read(&out[0], size);
+	return (bool)is;
+}
+
+inline int64_t snapshot_mtime(const char *filename){
+	struct stat st;
+	if(stat(filename, &st) != 0) return -1;
+	return (int64_t)st.st_mtim.tv_sec * 1000000000 + st.st_mtim.tv_nsec;
+}
+
+inline SnapshotHeader snapshot_key(const char *schema, const char *filename, const std::string &xml){
+	SnapshotHeader key;
+	std::memset(&key, 0, sizeof(key));
+	std::memcpy(key.magic, "UXSDSNAP", sizeof(key.magic));
+	key.byte_order = 0x01020304;
+	std::strncpy(key.schema, schema, sizeof(key.schema) - 1);
+	key.xml_size = xml.size();
+	key.xml_mtime = snapshot_mtime(filename);
+	key.xml_hash = snapshot_hash(xml.data(), xml.size());
+	return key;
+}
+
+/* Check that snapshot was made from the same XML file as key, and is complete. */
+inline bool snapshot_matches(const SnapshotHeader &key, const std::string &snapshot){
+	if(snapshot.size() < sizeof(SnapshotHeader)) return false;
+	SnapshotHeader header;
+	std::memcpy(&header, snapshot.data(), sizeof(header));
+	if(std::memcmp(header.magic, key.magic, sizeof(key.magic)) != 0
+		|| header.byte_order != key.byte_order
+		|| std::strncmp(header.schema, key.schema, sizeof(key.schema)) != 0
+		|| header.xml_size != key.xml_size
+		|| header.xml_mtime != key.xml_mtime
+		|| header.xml_hash != key.xml_hash
+		|| header.size != snapshot.size() - sizeof(header)) return false;
+	return header.hash == snapshot_hash(snapshot.data() + sizeof(header), header.size);
+}
+
+/* Write the snapshot atomically, so that concurrent loads never see a partial file.
+ * The temporary file is unique to the thread. The snapshot is only a cache, so errors are ignored. */
+inline void snapshot_write_file(const std::string &filename, SnapshotHeader header, const std::string &payload){
+	header.size = payload.size();
+	header.hash = snapshot_hash(payload.data(), payload.size());
+	std::string tmp = filename + ".tmp" + std::to_string(getpid()) + "." + std::to_string(std::hash<std::thread::id>()(std::this_thread::get_id()));
+	{
+		std::ofstream os(tmp, std::ios::binary | std::ios::trunc);
+		os.write((const char *)&header, sizeof(header));
+		os.write(payload.data(), payload.size());
+		if(!os){
+			os.close();
+			std::remove(tmp.c_str());
+			return;
+		}
+	}
+	if(std::rename(tmp.c_str(), filename.c_str()) != 0) std::remove(tmp.c_str());
+}
+"""
+
+xml_batch_includes = """#include <atomic>
+#include <fstream>
+#include <mutex>
+#include <thread>
+"""
+
+xml_batch_defn = """
+/* Result of loading one file with load_*_xml_batch. */
+struct XmlBatchResult {
+	std::string filename;
+	bool ok = false;
+	/* what() of the exception thrown while loading the file, if any. */
+	std::string error;
+};
+
+/**
+ * Internal helper for load_*_xml_batch. Calls fn(i, arena) for every i in [0, n)
+ * on a fixed pool of num_threads threads, or one per core if num_threads is 0.
+ * Every thread passes its own XmlArena. fn must not throw.
+ */
+template<typename Fn>
+inline void run_batch(size_t n, size_t num_threads, Fn fn){
+	if(num_threads == 0) num_threads = std::thread::hardware_concurrency();
+	if(num_threads == 0) num_threads = 1;
+	if(num_threads > n) num_threads = n;
+	std::atomic<size_t> next(0);
+	auto worker = [&](){
+		XmlArena arena;
+		for(size_t i = next++; i < n; i = next++) fn(i, arena);
+	};
+	std::vector<std::thread> threads;
+	for(size_t i = 1; i < num_threads; i++) threads.emplace_back(worker);
+	if(num_threads > 0) worker();
+	for(auto &thread : threads) thread.join();
+}
+"""
+
+xml_write_profile_defn = """
+/**
+ * Output profiles of write_*_xml.
+ *
+ * PRETTY: Every element ends with a newline, and attributes with default values
+ *     are written even if they're equal to it.
+ * COMPACT: No whitespace, and attributes equal to their default are left out.
+ * CANONICAL: COMPACT, with attributes sorted by name and empty elements written
+ *     as start and end tag pairs. This is the Canonical XML form of the compact
+ *     output, so the same content always gives the same bytes.
+ */
+enum class XmlWriteProfile {PRETTY, COMPACT, CANONICAL};
+"""
+
+xml_write_parallel_includes = """#include <condition_variable>
+#include <mutex>
+#include <thread>
+"""
+
+xml_write_parallel_defn = """
+/**
+ * Internal helper for write_*_xml. Calls write_child(w, children[i], options)
+ * for every child, so that the output is the same as a serial loop.
+ *
+ * The children are split into ranges of options.range_size, which a pool of
+ * options.num_threads threads writes into buffers of their own. The calling
+ * thread appends the buffers to w in order, and reports the progress to
+ * progress as it goes, if it's non-null. At most two ranges per thread are
+ * buffered at a time. write_child gets serial options, so nested children are
+ * written on the same thread.
+ *
+ * If a thread throws, the others stop and the exception is rethrown here.
+ */
+template<typename C, typename Fn>
+inline void write_xml_parallel(XmlWriter &w, std::vector<C> &children, const XmlWriteOptions &options, ProgressReporter *progress, const char *element, Fn &write_child){
+	XmlWriteOptions serial;
+	serial.profile = options.profile;
+	size_t n = children.size();
+	size_t range_size = options.range_size ? options.range_size : 1;
+	size_t num_ranges = (n + range_size - 1) / range_size;
+	size_t num_threads = options.num_threads;
+	if(num_threads == 0) num_threads = std::thread::hardware_concurrency();
+	if(num_threads > num_ranges) num_threads = num_ranges;
+	if(num_threads <= 1){
+		for(size_t i = 0; i < n; i++){
+			write_child(w, children[i], serial);
+			if(progress && progress->tick(element, i+1))
+				progress->report(w.bytes());
+		}
+		return;
+	}
+
+	/* Range r is written into buffers[r % window]. A thread only takes range r
+	 * once range r - window has been appended, so buffers are reused in order. */
+	size_t window = 2 * num_threads;
+	std::vector<std::string> buffers(window);
+	std::vector<char> ready(window, 0);
+	size_t next = 0;
+	size_t appended = 0;
+	bool stop = false;
+	std::exception_ptr error;
+	std::mutex lock;
+	std::condition_variable cv;
+	auto fail = [&](std::exception_ptr e){
+		if(!error) error = e;
+		stop = true;
+		cv.notify_all();
+	};
+	auto worker = [&](){
+		std::unique_lock<std::mutex> guard(lock);
+		for(;;){
+			cv.wait(guard, [&]{ return stop || next >= num_ranges || next < appended + window; });
+			if(stop || next >= num_ranges) return;
+			size_t r = next++;
+			std::string &buffer = buffers[r % window];
+			guard.unlock();
+			try {
+				buffer.clear();
+				XmlWriter range_w(buffer);
+				for(size_t i = r*range_size; i < std::min(n, (r+1)*range_size); i++)
+					write_child(range_w, children[i], serial);
+				range_w.flush();
+			} catch(...) {
+				guard.lock();
+				fail(std::current_exception());
+				return;
+			}
+			guard.lock();
+			ready[r % window] = 1;
+			cv.notify_all();
+		}
+	};
+
+	std::vector<std::thread> threads;
+	for(size_t i = 0; i < num_threads; i++) threads.emplace_back(worker);
+	try {
+		for(size_t r = 0; r < num_ranges; r++){
+			{
+				std::unique_lock<std::mutex> guard(lock);
+				cv.wait(guard, [&]{ return stop || ready[r % window]; });
+				if(stop) break;
+			}
+			const std::string &buffer = buffers[r % window];
+			w.put(buffer.data(), buffer.size());
+			for(size_t i = r*range_size; progress && i < std::min(n, (r+1)*range_size); i++){
+				if(progress->tick(element, i+1))
+					progress->report(w.bytes());
+			}
+			std::lock_guard<std::mutex> guard(lock);
+			ready[r % window] = 0;
+			appended++;
+			cv.notify_all();
+		}
+	} catch(...) {
+		std::lock_guard<std::mutex> guard(lock);
+		fail(std::current_exception());
+	}
+	for(auto &thread : threads) thread.join();
+	if(error) std::rethrow_exception(error);
+}
+"""
+
+write_cursor_defn = """
+/**
+ * Position of write_*_xml or write_*_capnp in a list of repeated children,
+ * kept by the begin_* and next_* callbacks of the interface. value is the
+ * current child. index, size and state are free for implementations to keep
+ * their place, except that size should be the exact number of children when
+ * it's known at begin_*: write_*_capnp then allocates the list without
+ * collecting the children first.
+ */
+template<typename T>
+struct WriteCursor {
+	T value{};
+	size_t index = 0;
+	size_t size = SIZE_MAX;
+	void *state = nullptr;
+};
+"""
+
+progress_defn = """
+/* A progress report passed to the callback of a ProgressReporter. */
+struct ProgressInfo {
+	/* Bytes of input consumed or of output written so far, or -1 if unknown. */
+	int64_t bytes;
+	/* Name of the top-level repeated element last processed, or nullptr if none. */
+	const char *element;
+	/* Number of such elements processed so far under their parent. */
+	size_t records;
+	/* Seconds since the load or write started. */
+	double elapsed;
+	/* True for the last report, made when the load or write is finished. */
+	bool done;
+};
+
+/**
+ * Reports the progress of load_*_xml, load_*_capnp and write_*_xml to a callback
+ * every interval seconds. The generated code calls tick() once for every repeated
+ * element at the top of the document, such as the children of a list element
+ * directly under the root. tick() only looks at the clock every check_every calls,
+ * so an enabled reporter costs a counter decrement per record and a disabled one
+ * a null check.
+ *
+ * A reporter must not be shared between concurrent loads or writes.
+ */
+class ProgressReporter {
+public:
+	typedef std::function<void(const ProgressInfo &)> Callback;
+
+	ProgressReporter(Callback callback, double interval = 1.0, unsigned check_every = 1024)
+		: callback_(std::move(callback)), interval_(interval), check_every_(check_every ? check_every : 1) {
+		start();
+	}
+
+	/* Restart the clock. Called at the start of every load and write. */
+	void start(){
+		start_ = std::chrono::steady_clock::now();
+		last_ = start_;
+		countdown_ = check_every_;
+		element_ = nullptr;
+		records_ = 0;
+	}
+
+	/* Count a record. Returns true if a report is due, then the caller calls report(). */
+	inline bool tick(const char *element, size_t records){
+		element_ = element;
+		records_ = records;
+		if(--countdown_ != 0) return false;
+		countdown_ = check_every_;
+		auto now = std::chrono::steady_clock::now();
+		if(std::chrono::duration<double>(now - last_).count() < interval_) return false;
+		last_ = now;
+		return true;
+	}
+
+	void report(int64_t bytes, bool done = false){
+		ProgressInfo info;
+		info.bytes = bytes;
+		info.element = element_;
+		info.records = records_;
+		info.elapsed = std::chrono::duration<double>(std::chrono::steady_clock::now() - start_).count();
+		info.done = done;
+		callback_(info);
+	}
+
+	/* Make the last report. */
+	void finish(int64_t bytes){
+		report(bytes, true);
+	}
+
+private:
+	Callback callback_;
+	double interval_;
+	unsigned check_every_;
+	unsigned countdown_;
+	std::chrono::steady_clock::time_point start_;
+	std::chrono::steady_clock::time_point last_;
+	const char *element_;
+	size_t records_;
+};
+"""
+
+instrument_includes = """#include <algorithm>
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#endif
+"""
+
+instrument_defn = """
+/**
+ * Counters for builds generated with --instrument. Every load_*, lex_* and
+ * callback of the loader has a counter of its own, which counts its calls,
+ * the bytes of XML it covers where that makes sense, and the cycles spent
+ * in it, excluding the other instrumented functions it calls.
+ *
+ * Counters are per thread. Cycles come from the TSC on x86 and from
+ * std::chrono::steady_clock in nanoseconds elsewhere.
+ */
+inline uint64_t instrument_clock(){
+#if defined(__x86_64__) || defined(__i386__)
+	return __rdtsc();
+#else
+	return std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now().time_since_epoch()).count();
+#endif
+}
+
+struct InstrumentCounter;
+inline std::vector<InstrumentCounter *> &instrument_counters(){
+	static thread_local std::vector<InstrumentCounter *> counters;
+	return counters;
+}
+
+struct InstrumentCounter {
+	const char *name;
+	uint64_t calls = 0;
+	uint64_t bytes = 0;
+	uint64_t cycles = 0;
+	explicit InstrumentCounter(const char *name_) : name(name_) {
+		instrument_counters().push_back(this);
+	}
+};
+
+class InstrumentScope {
+public:
+	explicit InstrumentScope(InstrumentCounter &counter) : counter_(counter), parent_(current()), start_(instrument_clock()) {
+		counter_.calls++;
+		current() = this;
+	}
+	~InstrumentScope(){
+		uint64_t elapsed = instrument_clock() - start_;
+		counter_.cycles += elapsed - children_;
+		if(parent_ != nullptr) parent_->children_ += elapsed;
+		current() = parent_;
+	}
+	void add_bytes(uint64_t bytes){
+		counter_.bytes += bytes;
+	}
+private:
+	static InstrumentScope *&current(){
+		static thread_local InstrumentScope *scope = nullptr;
+		return scope;
+	}
+	InstrumentCounter &counter_;
+	InstrumentScope *parent_;
+	uint64_t start_;
+	uint64_t children_ = 0;
+};
+
+/**
+ * Write the counters of this thread to os, sorted by cycles, and reset them.
+ * Counters of the same name, such as ones in different instantiations of a
+ * load function, are added up.
+ */
+inline void instrument_report(std::ostream &os){
+	std::vector<InstrumentCounter> merged;
+	uint64_t total = 0;
+	for(InstrumentCounter *c : instrument_counters()){
+		if(c->calls == 0) continue;
+		auto it = std::find_if(merged.begin(), merged.end(), [&](const InstrumentCounter &m){ return std::strcmp(m.name, c->name) == 0; });
+		if(it == merged.end()){
+			merged.push_back(*c);
+		}else{
+			it->calls += c->calls;
+			it->bytes += c->bytes;
+			it->cycles += c->cycles;
+		}
+		total += c->cycles;
+		c->calls = c->bytes = c->cycles = 0;
+	}
+	std::sort(merged.begin(), merged.end(), [](const InstrumentCounter &a, const InstrumentCounter &b){ return a.cycles > b.cycles; });
+
+	char line[256];
+	std::snprintf(line, sizeof(line), "%-40s %12s %14s %16s %6s %10s\\n", "function", "calls", "bytes", "cycles", "%", "cycles/call");
+	os << line;
+	for(const InstrumentCounter &c : merged){
+		std::snprintf(line, sizeof(line), "%-40s %12llu %14llu %16llu %6.2f %10.1f\\n", c.name,
+			(unsigned long long)c.calls, (unsigned long long)c.bytes, (unsigned long long)c.cycles,
+			total ? 100.0 * c.cycles / total : 0.0, (double)c.cycles / c.calls);
+		os << line;
+	}
+}
+"""
+
+xml_decompressor_includes = """#include <condition_variable>
+#include <deque>
+#include <mutex>
+#include <new>
+#include <thread>
+#ifdef UXSD_ZLIB
+#include <zlib.h>
+#endif
+#ifdef UXSD_ZSTD
+#include <zstd.h>
+#endif
+"""
+
+# The transcoder reads compressed XML too when foo_uxsdcxx.h is generated
+# without --decompress, so this is guarded for when both have it.
+xml_decompressor_defn = """
+#ifndef UXSD_XML_DECOMPRESSOR
+#define UXSD_XML_DECOMPRESSOR
+/**
+ * Compression of an XML stream, as detected by detect_xml_compression from its
+ * magic bytes: 1f 8b for gzip and 28 b5 2f fd for zstd.
+ */
+enum class XmlCompression {NONE, GZIP, ZSTD};
+
+static const unsigned char xml_gzip_magic[] = {0x1f, 0x8b};
+static const unsigned char xml_zstd_magic[] = {0x28, 0xb5, 0x2f, 0xfd};
+
+/**
+ * Neither 0x1f nor 0x28 can start an XML document, so the stream is only read
+ * past its first byte if it starts with one of them. Matching magic bytes are
+ * consumed, and XmlDecompressor puts them back in front of the rest. Otherwise,
+ * the stream is rewound if it can be, and it doesn't parse as XML either way.
+ */
+inline XmlCompression detect_xml_compression(std::istream &is){
+	const unsigned char *magic;
+	size_t size;
+	XmlCompression compression;
+	switch(is.peek()){
+	case 0x1f:
+		magic = xml_gzip_magic, size = sizeof(xml_gzip_magic), compression = XmlCompression::GZIP;
+		break;
+	case 0x28:
+		magic = xml_zstd_magic, size = sizeof(xml_zstd_magic), compression = XmlCompression::ZSTD;
+		break;
+	default:
+		return XmlCompression::NONE;
+	}
+	std::streampos start = is.tellg();
+	char bytes[sizeof(xml_zstd_magic)];
+	is.read(bytes, size);
+	if(static_cast<size_t>(is.gcount()) == size && std::memcmp(bytes, magic, size) == 0)
+		return compression;
+	is.clear();
+	if(start != std::streampos(-1)) is.seekg(start);
+	return XmlCompression::NONE;
+}
+
+/**
+ * Internal: decompresses a gzip or zstd stream for load_*_xml.
+ *
+ * A background thread reads the compressed stream in chunks while the calling
+ * thread decompresses them, so that I/O overlaps with decompression. The output
+ * is written straight into a single buffer, which is parsed in place. It's
+ * allocated with PugiXML's allocation function, so that it comes from the
+ * XmlArena of the load if there is one.
+ *
+ * gzip needs UXSD_ZLIB and linking with -lz, zstd needs UXSD_ZSTD and -lzstd.
+ */
+class XmlDecompressor {
+public:
+	XmlDecompressor(std::istream &is, XmlCompression compression) : compression_(compression) {
+		/* detect_xml_compression consumed the magic bytes. */
+		const unsigned char *magic = compression == XmlCompression::GZIP ? xml_gzip_magic : xml_zstd_magic;
+		Chunk chunk;
+		chunk.size = compression == XmlCompression::GZIP ? sizeof(xml_gzip_magic) : sizeof(xml_zstd_magic);
+		chunk.data.reset(new char[chunk.size]);
+		std::memcpy(chunk.data.get(), magic, chunk.size);
+		chunks_.push_back(std::move(chunk));
+		reader_ = std::thread([this, &is](){ read(is); });
+	}
+	~XmlDecompressor(){
+		{
+			std::lock_guard<std::mutex> guard(lock_);
+			stop_ = true;
+		}
+		changed_.notify_all();
+		reader_.join();
+		if(data_ != nullptr) pugi::get_memory_deallocation_function()(data_);
+	}
+
+	/* Decompress all of the input. Throws std::runtime_error on errors. */
+	void run(){
+		switch(compression_){
+		case XmlCompression::GZIP:
+#ifdef UXSD_ZLIB
+			run_gzip();
+			break;
+#else
+			throw std::runtime_error("input is compressed with gzip, but uxsdcxx was compiled without UXSD_ZLIB");
+#endif
+		case XmlCompression::ZSTD:
+#ifdef UXSD_ZSTD
+			run_zstd();
+			break;
+#else
+			throw std::runtime_error("input is compressed with zstd, but uxsdcxx was compiled without UXSD_ZSTD");
+#endif
+		default:
+			throw std::runtime_error("input isn't compressed");
+		}
+	}
+
+	char *data(){ return data_; }
+	size_t size(){ return size_; }
+
+private:
+	static constexpr size_t kChunkSize = 1 << 20;
+	static constexpr size_t kMaxChunks = 4;
+
+	struct Chunk {
+		std::unique_ptr<char[]> data;
+		size_t size;
+	};
+
+	void read(std::istream &is){
+		while(true){
+			Chunk chunk;
+			chunk.data.reset(new char[kChunkSize]);
+			is.read(chunk.data.get(), kChunkSize);
+			chunk.size = is.gcount();
+
+			std::unique_lock<std::mutex> guard(lock_);
+			changed_.wait(guard, [&](){ return stop_ || chunks_.size() < kMaxChunks; });
+			if(stop_) return;
+			if(chunk.size > 0) chunks_.push_back(std::move(chunk));
+			if(!is){
+				bad_ = is.bad();
+				eof_ = true;
+			}
+			guard.unlock();
+			changed_.notify_all();
+			if(eof_) return;
+		}
+	}
+
+	/* Wait for the next chunk. Returns false at the end of the input. */
+	bool next(Chunk &chunk){
+		std::unique_lock<std::mutex> guard(lock_);
+		changed_.wait(guard, [&](){ return eof_ || !chunks_.empty(); });
+		if(chunks_.empty()){
+			if(bad_) throw std::runtime_error("read error");
+			return false;
+		}
+		chunk = std::move(chunks_.front());
+		chunks_.pop_front();
+		guard.unlock();
+		changed_.notify_all();
+		return true;
+	}
+
+	/* Make room for at least one more byte of output. */
+	void grow(size_t at_least){
+		size_t capacity = capacity_ * 2;
+		if(capacity < at_least) capacity = at_least;
+		char *data = static_cast<char *>(pugi::get_memory_allocation_function()(capacity));
+		if(data == nullptr) throw std::bad_alloc();
+		if(data_ != nullptr){
+			std::memcpy(data, data_, size_);
+			pugi::get_memory_deallocation_function()(data_);
+		}
+		data_ = data;
+		capacity_ = capacity;
+	}
+
+#ifdef UXSD_ZLIB
+	void run_gzip(){
+		z_stream z;
+		std::memset(&z, 0, sizeof(z));
+		/* 16 selects the gzip format. */
+		if(inflateInit2(&z, 15 + 16) != Z_OK) throw std::runtime_error("inflateInit2 failed");
+		std::unique_ptr<z_stream, int (*)(z_stream *)> guard(&z, inflateEnd);
+
+		bool ended = false;
+		Chunk chunk;
+		while(next(chunk)){
+			if(data_ == nullptr) grow(chunk.size * 4);
+			z.next_in = reinterpret_cast<Bytef *>(chunk.data.get());
+			z.avail_in = chunk.size;
+			while(z.avail_in > 0){
+				/* A gzip file can be made of many members. */
+				if(ended){
+					inflateReset(&z);
+					ended = false;
+				}
+				if(size_ == capacity_) grow(size_ + 1);
+				z.next_out = reinterpret_cast<Bytef *>(data_ + size_);
+				z.avail_out = capacity_ - size_;
+				int ret = inflate(&z, Z_NO_FLUSH);
+				size_ = capacity_ - z.avail_out;
+				if(ret == Z_STREAM_END) ended = true;
+				else if(ret != Z_OK && ret != Z_BUF_ERROR)
+					throw std::runtime_error(std::string("gzip: ") + (z.msg ? z.msg : "inflate failed"));
+			}
+		}
+		if(!ended) throw std::runtime_error("gzip: unexpected end of input");
+	}
+#endif
+
+#ifdef UXSD_ZSTD
+	void run_zstd(){
+		std::unique_ptr<ZSTD_DStream, size_t (*)(ZSTD_DStream *)> stream(ZSTD_createDStream(), ZSTD_freeDStream);
+		if(!stream || ZSTD_isError(ZSTD_initDStream(stream.get()))) throw std::runtime_error("ZSTD_initDStream failed");
+
+		size_t ret = 0;
+		Chunk chunk;
+		while(next(chunk)){
+			if(data_ == nullptr){
+				/* Allocate the whole output at once if the frame header knows its size. */
+				unsigned long long content_size = ZSTD_getFrameContentSize(chunk.data.get(), chunk.size);
+				if(content_size != ZSTD_CONTENTSIZE_UNKNOWN && content_size != ZSTD_CONTENTSIZE_ERROR)
+					grow(content_size + 1);
+				else
+					grow(chunk.size * 4);
+			}
+			ZSTD_inBuffer in = {chunk.data.get(), chunk.size, 0};
+			while(in.pos < in.size){
+				if(size_ == capacity_) grow(size_ + 1);
+				ZSTD_outBuffer out = {data_, capacity_, size_};
+				ret = ZSTD_decompressStream(stream.get(), &out, &in);
+				if(ZSTD_isError(ret)) throw std::runtime_error(std::string("zstd: ") + ZSTD_getErrorName(ret));
+				size_ = out.pos;
+			}
+		}
+		/* Flush what's left in the decoder. */
+		while(ret != 0){
+			if(size_ == capacity_) grow(size_ + 1);
+			ZSTD_inBuffer in = {nullptr, 0, 0};
+			ZSTD_outBuffer out = {data_, capacity_, size_};
+			ret = ZSTD_decompressStream(stream.get(), &out, &in);
+			if(ZSTD_isError(ret)) throw std::runtime_error(std::string("zstd: ") + ZSTD_getErrorName(ret));
+			if(out.pos == size_ && ret != 0) throw std::runtime_error("zstd: unexpected end of input");
+			size_ = out.pos;
+		}
+	}
+#endif
+
+	XmlCompression compression_;
+	std::thread reader_;
+	std::mutex lock_;
+	std::condition_variable changed_;
+	std::deque<Chunk> chunks_;
+	bool eof_ = false;
+	bool bad_ = false;
+	bool stop_ = false;
+
+	char *data_ = nullptr;
+	size_t size_ = 0;
+	size_t capacity_ = 0;
+};
+#endif
+"""
+
+xml_escape_defn = """
+/**
+ * Internal functions for XmlWriter, which find the bytes that have to be
+ * escaped in a string value.
+ *
+ * These are the characters which Canonical XML escapes. Text escapes &, < and >,
+ * and CR, which parsers would turn into LF. Attribute values escape &, < and ",
+ * and the whitespace characters which parsers would turn into spaces.
+ */
+inline bool xml_needs_escape(char c, bool attribute){
+	switch(c){
+	case '&': case '<': case '\\r':
+		return true;
+	case '>':
+		return !attribute;
+	case '"': case '\\t': case '\\n':
+		return attribute;
+	default:
+		return false;
+	}
+}
+"""
+
+xml_escape_simd_includes = """#if defined(__SSE2__) || defined(__AVX2__)
+#include <immintrin.h>
+#endif
+"""
+
+xml_escape_simd_defn = """
+/* Same as xml_needs_escape for 16 or 32 bytes at a time, giving a bitmask of matches. */
+#if defined(__SSE2__)
+inline unsigned xml_escape_mask(const char *data, bool attribute){
+	__m128i v = _mm_loadu_si128(reinterpret_cast<const __m128i *>(data));
+	__m128i m = _mm_or_si128(_mm_or_si128(_mm_cmpeq_epi8(v, _mm_set1_epi8('&')), _mm_cmpeq_epi8(v, _mm_set1_epi8('<'))),
+						_mm_cmpeq_epi8(v, _mm_set1_epi8('\\r')));
+	if(attribute){
+		m = _mm_or_si128(m, _mm_or_si128(_mm_cmpeq_epi8(v, _mm_set1_epi8('"')), _mm_cmpeq_epi8(v, _mm_set1_epi8('\\t'))));
+		m = _mm_or_si128(m, _mm_cmpeq_epi8(v, _mm_set1_epi8('\\n')));
+	} else {
+		m = _mm_or_si128(m, _mm_cmpeq_epi8(v, _mm_set1_epi8('>')));
+	}
+	return _mm_movemask_epi8(m);
+}
+#endif
+
+#if defined(__AVX2__)
+inline unsigned xml_escape_mask32(const char *data, bool attribute){
+	__m256i v = _mm256_loadu_si256(reinterpret_cast<const __m256i *>(data));
+	__m256i m = _mm256_or_si256(_mm256_or_si256(_mm256_cmpeq_epi8(v, _mm256_set1_epi8('&')), _mm256_cmpeq_epi8(v, _mm256_set1_epi8('<'))),
+						_mm256_cmpeq_epi8(v, _mm256_set1_epi8('\\r')));
+	if(attribute){
+		m = _mm256_or_si256(m, _mm256_or_si256(_mm256_cmpeq_epi8(v, _mm256_set1_epi8('"')), _mm256_cmpeq_epi8(v, _mm256_set1_epi8('\\t'))));
+		m = _mm256_or_si256(m, _mm256_cmpeq_epi8(v, _mm256_set1_epi8('\\n')));
+	} else {
+		m = _mm256_or_si256(m, _mm256_cmpeq_epi8(v, _mm256_set1_epi8('>')));
+	}
+	return _mm256_movemask_epi8(m);
+}
+#endif
+"""
+
+# The SIMD loops of XmlWriter::escaped, which scan for bytes to escape before
+# the scalar loop does the rest.
+xml_writer_simd_escape = """#if defined(__AVX2__)
+		for(; i+32 <= n; i += 32){
+			for(unsigned mask = xml_escape_mask32(x + i, attribute); mask != 0; mask &= mask-1){
+				size_t j = i + __builtin_ctz(mask);
+				escape_at(x, start, j);
+				start = j+1;
+			}
+		}
+#endif
+#if defined(__SSE2__)
+		for(; i+16 <= n; i += 16){
+			for(unsigned mask = xml_escape_mask(x + i, attribute); mask != 0; mask &= mask-1){
+				size_t j = i + __builtin_ctz(mask);
+				escape_at(x, start, j);
+				start = j+1;
+			}
+		}
+#endif
+"""
+
+xml_writer_defn = Template("""
+/**
+ * A buffered sink for write_*_xml. Output is collected in a large buffer, which
+ * is flushed to a file descriptor with write(2), to a std::ostream or to a
+ * std::string when it's full, on flush() and on destruction.
+ *
+ * Numbers are formatted with std::to_chars where it's available for floats,
+ * which gives the shortest text that reads back as the same value. Otherwise
+ * floats and doubles are written with the fewest significant digits from 6 up
+ * which read back as the same value.
+ */
+class XmlWriter {
+public:
+	explicit XmlWriter(int fd, size_t capacity = 1 << 20) : fd_(fd), os_(nullptr), str_(nullptr), data_(new char[capacity]), capacity_(capacity) {}
+	explicit XmlWriter(std::ostream &os, size_t capacity = 1 << 20) : fd_(-1), os_(&os), str_(nullptr), data_(new char[capacity]), capacity_(capacity) {}
+	/* Append to a string in memory. */
+	explicit XmlWriter(std::string &str, size_t capacity = 1 << 16) : fd_(-1), os_(nullptr), str_(&str), data_(new char[capacity]), capacity_(capacity) {}
+	XmlWriter(const XmlWriter &) = delete;
+	XmlWriter &operator=(const XmlWriter &) = delete;
+	~XmlWriter(){
+		try { flush(); } catch(...) {}
+	}
+
+	/* Write a string literal. Its length is known at compile time. */
+	template<size_t N>
+	inline void put(const char (&text)[N]){
+		put(text, N-1);
+	}
+
+	inline void put(const char *text, size_t n){
+		if(n > capacity_ - size_){
+			flush();
+			if(n > capacity_){
+				sink(text, n);
+				return;
+			}
+		}
+		std::memcpy(data_.get() + size_, text, n);
+		size_ += n;
+	}
+
+	/* Write a string as text content, escaping the characters which need it. */
+	inline void value(const char *x){
+		if(x != nullptr) escaped(x, std::strlen(x), false);
+	}
+	/* Write a string as an attribute value. Other types are written as by value(). */
+	inline void attribute(const char *x){
+		if(x != nullptr) escaped(x, std::strlen(x), true);
+	}
+	template<typename V>
+	inline void attribute(V x){
+		value(x);
+	}
+	/* Write a string which is known not to need escaping, such as an enum token. */
+	inline void token(const char *x){
+		put(x, std::strlen(x));
+	}
+	inline void value(bool x){
+		put(x ? "1" : "0", 1);
+	}
+	template<typename I, typename std::enable_if<std::is_integral<I>::value, int>::type = 0>
+	inline void value(I x){
+		char *p = reserve(24);
+#if defined(__cpp_lib_to_chars)
+		p = std::to_chars(p, p + 24, x).ptr;
+#else
+		typedef typename std::make_unsigned<I>::type U;
+		U u = static_cast<U>(x);
+		if(x < 0){
+			*p++ = '-';
+			u = U(0) - u;
+		}
+		char digits[24];
+		int n = 0;
+		do { digits[n++] = '0' + u % 10; u /= 10; } while(u != 0);
+		while(n > 0) *p++ = digits[--n];
+#endif
+		size_ = p - data_.get();
+	}
+	inline void value(float x){
+		char *p = reserve(32);
+#if defined(__cpp_lib_to_chars)
+		size_ = std::to_chars(p, p + 32, x).ptr - data_.get();
+#else
+		int n = 0;
+		for(int digits = 6; digits <= 9; digits++){
+			n = std::snprintf(p, 32, "%.*g", digits, x);
+			if(std::strtof(p, nullptr) == x) break;
+		}
+		size_ += n;
+#endif
+	}
+	inline void value(double x){
+		char *p = reserve(32);
+#if defined(__cpp_lib_to_chars)
+		size_ = std::to_chars(p, p + 32, x).ptr - data_.get();
+#else
+		int n = 0;
+		for(int digits = 6; digits <= 17; digits++){
+			n = std::snprintf(p, 32, "%.*g", digits, x);
+			if(std::strtod(p, nullptr) == x) break;
+		}
+		size_ += n;
+#endif
+	}
+
+	/* Bytes written so far, including the ones still in the buffer. */
+	inline size_t bytes() const {
+		return flushed_ + size_;
+	}
+
+	void flush(){
+		size_t n = size_;
+		size_ = 0;
+		sink(data_.get(), n);
+	}
+
+private:
+	/* Copy clean runs in bulk and replace only the bytes which need escaping.
+	 * start is the first byte which isn't written yet. */
+	inline void escaped(const char *x, size_t n, bool attribute){
+		size_t start = 0, i = 0;
+$simd_escape		for(; i<n; i++){
+			if(xml_needs_escape(x[i], attribute)){
+				escape_at(x, start, i);
+				start = i+1;
+			}
+		}
+		put(x + start, n - start);
+	}
+
+	/* Write the clean run x[start, i) and the escaped form of x[i]. */
+	inline void escape_at(const char *x, size_t start, size_t i){
+		put(x + start, i - start);
+		switch(x[i]){
+		case '&': put("&amp;"); break;
+		case '<': put("&lt;"); break;
+		case '>': put("&gt;"); break;
+		case '"': put("&quot;"); break;
+		case '\\t': put("&#x9;"); break;
+		case '\\n': put("&#xA;"); break;
+		case '\\r': put("&#xD;"); break;
+		}
+	}
+
+	/* Make room for n bytes and return where they start. */
+	inline char *reserve(size_t n){
+		if(n > capacity_ - size_) flush();
+		return data_.get() + size_;
+	}
+
+	void sink(const char *data, size_t n){
+		flushed_ += n;
+		if(os_ != nullptr){
+			os_->write(data, n);
+			return;
+		}
+		if(str_ != nullptr){
+			str_->append(data, n);
+			return;
+		}
+		while(n > 0){
+			ssize_t written = ::write(fd_, data, n);
+			if(written < 0){
+				if(errno == EINTR) continue;
+				throw std::runtime_error(std::string("Unable to write XML: ") + std::strerror(errno));
+			}
+			data += written;
+			n -= written;
+		}
+	}
+
+	int fd_;
+	std::ostream *os_;
+	std::string *str_;
+	std::unique_ptr<char[]> data_;
+	size_t capacity_;
+	size_t size_ = 0;
+	size_t flushed_ = 0;
+};
+""")
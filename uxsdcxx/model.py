@@ -0,0 +1,366 @@
+from typing import Dict, List, Tuple, Union
+
+from . import cpp_templates, utils
+from .cpp import pass_at_init, _gen_attribute_arg, _gen_required_attribute_arg_list, _gen_stub_suffix, _gen_default_literal
+from .utils import checked
+from .version import __version__
+from .schema import (
+	UxsdSchema,
+	UxsdComplex,
+	UxsdDfa,
+	UxsdAll,
+	UxsdLeaf,
+	UxsdElement,
+	UxsdEnum,
+	UxsdSimple,
+	UxsdString,
+	UxsdAttribute,
+)
+
+# Sizes of the C++ types of simple types, for ordering struct fields to minimize padding.
+cpp_type_sizes = {
+	"const char *": 8,
+	"bool": 1,
+	"float": 4,
+	"int": 4,
+	"long": 8,
+	"short": 2,
+	"char": 1,
+	"unsigned int": 4,
+	"unsigned long": 8,
+	"unsigned short": 2,
+	"unsigned byte": 1,
+	"double": 8,
+}
+
+def _size_of(t: UxsdSimple) -> int:
+	if isinstance(t, UxsdEnum):
+		return 1 if len(t.enumeration) < 256 else 4
+	return cpp_type_sizes.get(t.cpp, 8)
+
+def _gen_default(a: UxsdAttribute) -> str:
+	"""Generate the initializer of a struct field for an attribute."""
+	if a.default_value is None:
+		if isinstance(a.type, UxsdString):
+			return "nullptr"
+		return "(%s)0" % a.type.cpp
+	return _gen_default_literal(a)
+
+def _gen_pool_name(t: UxsdComplex) -> str:
+	return "%s_pool_" % t.name
+
+def _gen_canonical_name(t: UxsdComplex) -> str:
+	return "%s_canonical_" % t.name
+
+def _gen_simple_pool_name(e: UxsdElement, parent: str) -> str:
+	return "%s_pool_" % _gen_stub_suffix(e, parent)
+
+def struct_from_complex_type(t: UxsdComplex) -> str:
+	"""Generate a compact C++ struct t_foo from an UxsdComplex.
+
+	Complex children are stored in per-type pools and referred to by 32-bit
+	indices. Repeated children are a collapsed_vec into the pool. Fields are
+	sorted by size to minimize padding, and the has_* flags of optional complex
+	children are packed into bitfields at the end of the struct.
+	"""
+	# (size, declaration) pairs.
+	fields: List[Tuple[int, str]] = []
+	flags: List[str] = []
+	for attr in t.attrs:
+		fields.append((_size_of(attr.type), "%s %s = %s;" % (attr.type.cpp, checked(attr.name), _gen_default(attr))))
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		for e in t.content.children:
+			if e.many:
+				fields.append((4, "collapsed_vec %s;" % checked(e.name)))
+			elif isinstance(e.type, UxsdComplex):
+				fields.append((4, "uint32_t %s = 0;" % checked(e.name)))
+				if e.optional:
+					flags.append("has_%s" % e.name)
+			elif isinstance(e.type, UxsdString):
+				fields.append((8, "%s %s = nullptr;" % (e.type.cpp, checked(e.name))))
+			else:
+				fields.append((_size_of(e.type), "%s %s = (%s)0;" % (e.type.cpp, checked(e.name), e.type.cpp)))
+	elif isinstance(t.content, UxsdLeaf):
+		if isinstance(t.content.type, UxsdString):
+			fields.append((8, "%s value = nullptr;" % t.content.type.cpp))
+		else:
+			fields.append((_size_of(t.content.type), "%s value = (%s)0;" % (t.content.type.cpp, t.content.type.cpp)))
+
+	# Stable sort keeps the declaration order among fields of the same size.
+	fields.sort(key=lambda x: -x[0])
+	out = ""
+	out += "struct %s {\n" % t.cpp
+	if flags:
+		out += "\t%s() : %s {}\n" % (t.cpp, ", ".join("%s(0)" % x for x in flags))
+	for _, field in fields:
+		out += "\t%s\n" % field
+	for flag in flags:
+		out += "\tunsigned %s : 1;\n" % flag
+	out += "};\n"
+	return out
+
+def _gen_set_value(t: UxsdSimple, value: str) -> str:
+	if isinstance(t, UxsdString):
+		return "strings_.intern(%s)" % value
+	return value
+
+def _gen_model_impl(t: UxsdComplex) -> str:
+	"""Generate the interface functions of Model<Root> for a complex type."""
+	fields = []
+
+	def _add_field(ret: str, verb: str, what: str, args: str, impl: str):
+		fields.append("inline %s %s_%s_%s(%s) override {\n%s}\n" % (ret, verb, t.name, what, args, utils.indent(impl)))
+
+	def _gen_set_required_attrs(e: UxsdElement) -> str:
+		impl = ""
+		for attr in sorted(e.type.attrs, key=lambda attr: attr.name):
+			if pass_at_init(attr):
+				impl += "child->{name} = {value};\n".format(
+						name=checked(attr.name),
+						value=_gen_set_value(attr.type, checked(attr.name)))
+		return impl
+
+	def _add_set(e: Union[UxsdElement, UxsdAttribute]):
+		impl = "ctx->{name} = {value};\n".format(
+				name=checked(e.name),
+				value=_gen_set_value(e.type, checked(e.name)))
+		_add_field("void", "set", e.name, "{}, {} *&ctx".format(_gen_attribute_arg(e), t.cpp), impl)
+
+	def _add_get(e: Union[UxsdElement, UxsdAttribute]):
+		_add_field(e.type.cpp, "get", e.name, "%s *&ctx" % t.cpp, "return ctx->%s;\n" % checked(e.name))
+
+	def _add_init(e: UxsdElement):
+		assert isinstance(e.type, UxsdComplex)
+		impl = ""
+		impl += "uint32_t index = {pool}.emplace_back();\n".format(pool=_gen_pool_name(e.type))
+		impl += "ctx->{name} = index;\n".format(name=checked(e.name))
+		if e.optional:
+			impl += "ctx->has_{name} = 1;\n".format(name=e.name)
+		impl += "{canonical}.push_back(index);\n".format(canonical=_gen_canonical_name(e.type))
+		impl += "{cpp} *child = &{pool}[index];\n".format(cpp=e.type.cpp, pool=_gen_pool_name(e.type))
+		impl += _gen_set_required_attrs(e)
+		impl += "return child;\n"
+		_add_field("%s *" % e.type.cpp, "init", e.name, _gen_required_attribute_arg_list("%s *" % t.cpp, e.type.attrs), impl)
+		_add_field("void", "finish", e.name, "%s *&ctx" % e.type.cpp, "(void)ctx;\n")
+		impl = ""
+		impl += "ctx->{name} = {canonical}[canonical_id];\n".format(name=checked(e.name), canonical=_gen_canonical_name(e.type))
+		if e.optional:
+			impl += "ctx->has_{name} = 1;\n".format(name=e.name)
+		_add_field("void", "ref", e.name, "%s *&ctx, size_t canonical_id" % t.cpp, impl)
+
+	def _add_add_complex(e: UxsdElement):
+		assert isinstance(e.type, UxsdComplex)
+		impl = "reserve_range({pool}, ctx->{name}, size);\n".format(pool=_gen_pool_name(e.type), name=checked(e.name))
+		_add_field("void", "preallocate", e.name, "%s *&ctx, size_t size" % t.cpp, impl)
+		impl = ""
+		impl += "uint32_t index = append_to_range({pool}, ctx->{name});\n".format(
+				pool=_gen_pool_name(e.type),
+				name=checked(e.name))
+		impl += "{canonical}.push_back(index);\n".format(canonical=_gen_canonical_name(e.type))
+		impl += "{cpp} *child = &{pool}[index];\n".format(cpp=e.type.cpp, pool=_gen_pool_name(e.type))
+		impl += _gen_set_required_attrs(e)
+		impl += "return child;\n"
+		_add_field("%s *" % e.type.cpp, "add", e.name, _gen_required_attribute_arg_list("%s *" % t.cpp, e.type.attrs), impl)
+		_add_field("void", "finish", e.name, "%s *&ctx" % e.type.cpp, "(void)ctx;\n")
+		# Relocating a range copies it, so the canonical index still holds an equal struct.
+		impl = ""
+		impl += "uint32_t index = append_to_range({pool}, ctx->{name});\n".format(
+				pool=_gen_pool_name(e.type),
+				name=checked(e.name))
+		impl += "{pool}[index] = {pool}[{canonical}[canonical_id]];\n".format(
+				pool=_gen_pool_name(e.type),
+				canonical=_gen_canonical_name(e.type))
+		_add_field("void", "ref", e.name, "%s *&ctx, size_t canonical_id" % t.cpp, impl)
+
+	def _add_add_simple(e: UxsdElement):
+		impl = "reserve_range({pool}, ctx->{name}, size);\n".format(pool=_gen_simple_pool_name(e, t.name), name=checked(e.name))
+		_add_field("void", "preallocate", e.name, "%s *&ctx, size_t size" % t.cpp, impl)
+		impl = "{pool}[append_to_range({pool}, ctx->{name})] = {value};\n".format(
+				pool=_gen_simple_pool_name(e, t.name),
+				name=checked(e.name),
+				value=_gen_set_value(e.type, checked(e.name)))
+		_add_field("void", "add", e.name, "{}, {} *&ctx".format(_gen_attribute_arg(e), t.cpp), impl)
+
+	def _add_get_complex(e: UxsdElement):
+		impl = "return &{pool}[ctx->{name}];\n".format(pool=_gen_pool_name(e.type), name=checked(e.name))
+		_add_field("%s *" % e.type.cpp, "get", e.name, "%s *&ctx" % t.cpp, impl)
+
+	def _add_get_complex_many(e: UxsdElement):
+		impl = "return &{pool}[ctx->{name}.offset + n];\n".format(pool=_gen_pool_name(e.type), name=checked(e.name))
+		_add_field("%s *" % e.type.cpp, "get", e.name, "int n, %s *&ctx" % t.cpp, impl)
+
+	def _add_get_simple_many(e: UxsdElement):
+		impl = "return {pool}[ctx->{name}.offset + n];\n".format(pool=_gen_simple_pool_name(e, t.name), name=checked(e.name))
+		_add_field(e.type.cpp, "get", e.name, "int n, %s *&ctx" % t.cpp, impl)
+
+	def _add_num(e: UxsdElement):
+		_add_field("size_t", "num", e.name, "%s *&ctx" % t.cpp, "return ctx->%s.size;\n" % checked(e.name))
+
+	def _add_has(e: UxsdElement):
+		_add_field("bool", "has", e.name, "%s *&ctx" % t.cpp, "return ctx->has_%s;\n" % e.name)
+
+	for attr in t.attrs:
+		_add_get(attr)
+		if not pass_at_init(attr):
+			_add_set(attr)
+
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		for e in t.content.children:
+			if isinstance(e.type, UxsdComplex):
+				if e.many:
+					_add_add_complex(e)
+					_add_num(e)
+					_add_get_complex_many(e)
+				else:
+					_add_init(e)
+					_add_get_complex(e)
+					if e.optional: _add_has(e)
+			elif isinstance(e.type, UxsdSimple):
+				if e.many:
+					_add_add_simple(e)
+					_add_num(e)
+					_add_get_simple_many(e)
+				else:
+					_add_set(e)
+					_add_get(e)
+			else:
+				raise TypeError(e)
+	elif isinstance(t.content, UxsdLeaf):
+		impl = "ctx->value = %s;\n" % _gen_set_value(t.content.type, "value")
+		_add_field("void", "set", "value", "{} value, {} *&ctx".format(t.content.type.cpp, t.cpp), impl)
+		_add_field(t.content.type.cpp, "get", "value", "%s *&ctx" % t.cpp, "return ctx->value;\n")
+
+	return "\n".join(fields)
+
+def _collect_pools(schema: UxsdSchema) -> Tuple[List[UxsdComplex], List[Tuple[str, str]]]:
+	"""Find the complex types which occur as children and the repeated simple elements.
+	Each of them gets a pool in Model<Root>."""
+	complex_pools: Dict[UxsdComplex, None] = {}
+	simple_pools: List[Tuple[str, str]] = []
+	for t in schema.complex_types:
+		if not isinstance(t.content, (UxsdDfa, UxsdAll)):
+			continue
+		for e in t.content.children:
+			if isinstance(e.type, UxsdComplex):
+				complex_pools[e.type] = None
+			elif e.many:
+				simple_pools.append((e.type.cpp, _gen_simple_pool_name(e, t.name)))
+	return list(complex_pools), simple_pools
+
+def gen_model_class(schema: UxsdSchema) -> str:
+	"""Generate Model<Root>, an implementation of <Root>Base which stores the
+	document in the compact structs."""
+	root = schema.root_element
+	assert isinstance(root.type, UxsdComplex)
+	pname = utils.to_pascalcase(root.name)
+	complex_pools, simple_pools = _collect_pools(schema)
+
+	out = ""
+	out += "struct Model{pname}ContextTypes : public Default{pname}ContextTypes {{\n\t".format(pname=pname)
+	out += "\n\t".join("using {}ReadContext = {} *;".format(utils.to_pascalcase(t.name), t.cpp) for t in schema.complex_types)
+	out += "\n\t"
+	out += "\n\t".join("using {}WriteContext = {} *;".format(utils.to_pascalcase(t.name), t.cpp) for t in schema.complex_types)
+	out += "\n};\n"
+	out += "\n"
+
+	out += "/**\n"
+	out += " * Implementation of {pname}Base which keeps the document in compact structs.\n".format(pname=pname)
+	out += " * Complex types live in per-type pools, repeated children are ranges in\n"
+	out += " * these pools and strings are interned. Contexts are pointers to the structs.\n"
+	out += " * preallocate_* reserves the children of an element in their pool, so these\n"
+	out += " * stay valid during a load. Adding more children than were preallocated may\n"
+	out += " * move the range, and then pointers to its earlier children go stale.\n"
+	out += " *\n"
+	out += " *     Model{pname} model;\n".format(pname=pname)
+	out += " *     auto root = model.root();\n"
+	out += " *     load_{name}_xml(model, root, filename, is);\n".format(name=root.name)
+	out += " */\n"
+	out += "class Model{pname} : public {pname}Base<Model{pname}ContextTypes> {{\n".format(pname=pname)
+	out += "public:\n"
+	out += "\tModel{pname}() {{}}\n\n".format(pname=pname)
+
+	out += "\t{cpp} *root() {{\n".format(cpp=root.type.cpp)
+	out += "\t\treturn &root_;\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* Free all pools and interned strings. */\n"
+	out += "\tvoid clear() {\n"
+	out += "\t\troot_ = %s();\n" % root.type.cpp
+	for t in complex_pools:
+		out += "\t\t%s.clear();\n" % _gen_pool_name(t)
+	for _, name in simple_pools:
+		out += "\t\t%s.clear();\n" % name
+	out += "\t\tstrings_.clear();\n"
+	out += "\t}\n"
+	out += "\n"
+	out += "\t/* Approximate heap memory used by the model in bytes. */\n"
+	out += "\tsize_t memory_usage() const {\n"
+	out += "\t\tsize_t out = strings_.memory_usage();\n"
+	for t in complex_pools:
+		out += "\t\tout += %s.memory_usage();\n" % _gen_pool_name(t)
+	for _, name in simple_pools:
+		out += "\t\tout += %s.memory_usage();\n" % name
+	out += "\t\treturn out;\n"
+	out += "\t}\n"
+	out += "\n"
+
+	out += "\tvoid start_load(const std::function<void(const char *)> *report_error_in) override {\n"
+	out += "\t\treport_error = report_error_in;\n"
+	out += "\t}\n"
+	out += "\tvoid finish_load() override {\n"
+	for t in complex_pools:
+		out += "\t\tstd::vector<uint32_t>().swap(%s);\n" % _gen_canonical_name(t)
+	out += "\t}\n"
+	out += "\tvoid start_write() override {}\n"
+	out += "\tvoid finish_write() override {}\n"
+	out += "\tvoid error_encountered(const char * file, int line, const char *message) override {\n"
+	out += "\t\tstd::stringstream msg;\n"
+	out += "\t\tmsg << message << \" occured at file: \" << file << \" line: \" << line;\n"
+	out += "\t\tthrow std::runtime_error(msg.str());\n"
+	out += "\t}\n"
+
+	for t in schema.complex_types:
+		out += utils.indent(_gen_model_impl(t))
+	out += "private:\n"
+	out += "\tconst std::function<void(const char *)> *report_error = nullptr;\n"
+	out += "\t%s root_;\n" % root.type.cpp
+	for t in complex_pools:
+		out += "\ttyped_pool<%s> %s;\n" % (t.cpp, _gen_pool_name(t))
+	for cpp, name in simple_pools:
+		out += "\ttyped_pool<%s> %s;\n" % (cpp, name)
+	out += "\tstring_pool strings_;\n"
+	out += "\t/* Pool indices of the structs made by init_* or add_* during a load, by type. ref_* shares them. */\n"
+	for t in complex_pools:
+		out += "\tstd::vector<uint32_t> %s;\n" % _gen_canonical_name(t)
+	out += "};\n"
+	return out
+
+def render_model_header_file(schema: UxsdSchema, cmdline: str, input_file: str, interface_header_file_name: str) -> str:
+	"""Render a C++ header file with the compact model to a string."""
+	out = ""
+	x = {"version": __version__,
+		"cmdline": cmdline,
+		"input_file": input_file,
+		"md5": utils.md5(input_file)}
+	out += cpp_templates.header_comment.substitute(x)
+	out += "#include <cstdint>\n"
+	out += "#include <cstring>\n"
+	out += "#include <memory>\n"
+	out += "#include <sstream>\n"
+	out += "#include <stdexcept>\n"
+	out += "#include <unordered_set>\n"
+	out += "#include <vector>\n"
+	out += "\n"
+	out += '#include "{}"\n'.format(interface_header_file_name)
+	out += "\n/* All uxsdcxx functions and structs live in this namespace. */\n"
+	out += "namespace uxsd {\n"
+	out += cpp_templates.model_pools_defn
+
+	out += "\n/* Structs for the complex types. */\n"
+	out += "\n".join(struct_from_complex_type(t) for t in schema.complex_types)
+
+	out += "\n/* Implementation of the interface over the structs. */\n"
+	out += gen_model_class(schema)
+
+	out += "\n} /* namespace uxsd */\n"
+	return out
@@ -1,6 +1,6 @@
 import re
 
-from typing import List, Union, Optional
+from typing import List, Tuple, Union, Optional
 from functools import lru_cache
 from xml.etree import ElementTree as ET # type: ignore
 
@@ -81,28 +81,43 @@ class UxsdString(UxsdAtomic):
 	def __init__(self):
 		self.name = "string"
 
+class UxsdId(UxsdString):
+	"""xs:ID. It's a string, but the loader also indexes it."""
+	pass
+
+class UxsdIdRef(UxsdString):
+	"""xs:IDREF. It's a string, but the loader also resolves it to the element with that ID."""
+	pass
+
 class UxsdAttribute:
 	name: str
 	default_value: Optional[str]
 	optional: bool
 	type: UxsdSimple
+	# Whether uxsdcap stores the value as an index into the strings table of the
+	# root. Set by uxsdcxx.capnp.intern_strings.
+	interned: bool
 	def __init__(self, name, default_value, optional, type):
 		self.name = name
 		self.default_value = default_value
 		self.optional = optional
 		self.type = type
+		self.interned = False
 
 class UxsdElement(UxsdSourcable):
 	name: str
 	many: bool
 	optional: bool
 	type: UxsdType
+	# As for UxsdAttribute.
+	interned: bool
 	def __init__(self, name, many, optional, type, xml_elem):
 		self.name = name
 		self.many = many
 		self.optional = optional
 		self.type = type
 		self.xml_elem = xml_elem
+		self.interned = False
 
 class UxsdContentType:
 	def __init__(self):
@@ -234,7 +249,11 @@ class UxsdSchema:
 		if "w3.org" in t.name:
 			name = t.name.split("}")[1]
 		if isinstance(t, XsdAtomicBuiltin):
-			if name in ["string", "IDREF", "ID", "NCName"]:
+			if name == "ID":
+				out = UxsdId()
+			elif name == "IDREF":
+				out = UxsdIdRef()
+			elif name in ["string", "NCName"]:
 				out = UxsdString()
 			else:
 				out = UxsdNumber(name)
@@ -343,3 +362,29 @@ class UxsdSchema:
 	def has_attr(self) -> bool:
 		x = [True for x in self.complex_types if x.attrs]
 		return any(x)
+
+	@property
+	def id_types(self) -> List[UxsdComplex]:
+		"""Complex types with an xs:ID attribute."""
+		return [x for x in self.complex_types if any(isinstance(a.type, UxsdId) for a in x.attrs)]
+
+	@property
+	def idref_attrs(self) -> List[Tuple[UxsdComplex, UxsdAttribute]]:
+		"""xs:IDREF attributes, with the complex types they are found in."""
+		return [(x, a) for x in self.complex_types for a in x.attrs if isinstance(a.type, UxsdIdRef)]
+
+	@property
+	def has_ids(self) -> bool:
+		return bool(self.id_types or self.idref_attrs)
+
+	@property
+	def top_level_types(self) -> List[UxsdComplex]:
+		"""The root element's type and the complex types of its children, whose
+		repeated children are counted as records when reporting progress."""
+		root = self.root_element.type
+		out = [root]
+		if isinstance(root.content, (UxsdDfa, UxsdAll)):
+			for e in root.content.children:
+				if isinstance(e.type, UxsdComplex) and e.type not in out:
+					out.append(e.type)
+		return out
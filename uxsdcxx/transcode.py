@@ -0,0 +1,608 @@
+from typing import Optional, Union
+
+from . import cpp_templates, utils
+from .cpp import _gen_load_simple as _gen_lex_simple, _gen_put, _merge_puts, _gen_stub_suffix, gen_id_enums
+from .capnp import to_type, _uses_strings, _gen_load_field, _gen_load_simple, _gen_set_field, _gen_set_simple
+from .version import __version__
+from .schema import (
+	UxsdSchema,
+	UxsdAttribute,
+	UxsdElement,
+	UxsdComplex,
+	UxsdEnum,
+	UxsdAll,
+	UxsdDfa,
+	UxsdLeaf,
+	UxsdString,
+	UxsdId,
+	UxsdIdRef,
+)
+
+# Fused transcoders between XML and Cap'n Proto. They walk the PugiXML DOM or
+# the Cap'n Proto reader and write the other format directly, with the lexers,
+# DFA tables and XmlWriter of the XML header, without going through FooBase.
+
+def _gen_state_type(schema: UxsdSchema) -> str:
+	return "%sTranscodeState" % utils.to_pascalcase(schema.root_element.name)
+
+def gen_transcode_state(schema: UxsdSchema) -> str:
+	root = schema.root_element
+	assert isinstance(root.type, UxsdComplex)
+	out = ""
+	out += "/* The state of a single transcode_%s_* call. */\n" % root.name
+	out += "struct %s {\n" % _gen_state_type(schema)
+	out += "\tconst std::function<void(const char *)> *report_error;\n"
+	out += "\t/* The offset of the XML node being read, for the line of an error. */\n"
+	out += "\tptrdiff_t offset_debug = 0;\n"
+	if schema.has_ids:
+		out += "\t/* If set, the IDs and IDREFs of the XML document are checked at the end. */\n"
+		out += "\tbool strict_ids = false;\n"
+		out += "\tIdIndex ids;\n"
+	if _uses_strings(root.type):
+		out += "\tCapnpStringTable string_table;\n"
+		out += "\tCapnpStrings strings;\n"
+	out += "};\n"
+	return out
+
+#
+
+def _gen_xml_value(f: Union[UxsdAttribute, UxsdElement], input: str) -> str:
+	"""The value of an XML attribute or element as the argument of a capnp setter."""
+	return _gen_set_field(f, _gen_lex_simple(f.type, input), "state->string_table.")
+
+def _gen_check_id(a: UxsdAttribute, t: UxsdComplex, value: str) -> str:
+	"""Add an ID or IDREF to the IdIndex if the transcode is strict. The targets
+	don't need to be found, since capnp has the IDREFs as strings, but duplicate
+	IDs and dangling IDREFs are reported."""
+	out = ""
+	if isinstance(a.type, UxsdId):
+		out += "if(state->strict_ids && !state->ids.insert(%s, (int)id_type::%s, 0))\n" % (value, utils.to_token(t.name))
+		out += "\tnoreturn_report(report_error, (\"Duplicate ID `\" + std::string(%s) + \"`.\").c_str());\n" % value
+	elif isinstance(a.type, UxsdIdRef):
+		out += "if(state->strict_ids) state->ids.add_ref(%s, (int)idref_attr::%s, 0, state->offset_debug);\n" % (value, utils.to_token(_gen_stub_suffix(a, t.name)))
+	return out
+
+def _gen_xml_attrs(t: UxsdComplex) -> str:
+	"""Set the attributes of root, validating them as load_foo and
+	load_foo_required_attributes do."""
+	if not t.attrs:
+		out = ""
+		out += "if(root.first_attribute())\n"
+		out += "\tnoreturn_report(report_error, \"Unexpected attribute in <%s>.\");\n" % t.name
+		return out
+	N = len(t.attrs)
+	out = ""
+	out += "std::bitset<%d> astate = 0;\n" % N
+	out += "for(pugi::xml_attribute attr = root.first_attribute(); attr; attr = attr.next_attribute()){\n"
+	out += "\tatok_%s in = lex_attr_%s(attr.name(), report_error);\n" % (t.cpp, t.cpp)
+	out += "\tif(astate[(int)in] == 0) astate[(int)in] = 1;\n"
+	out += "\telse noreturn_report(report_error, (\"Duplicate attribute \" + std::string(attr.name()) + \" in <%s>.\").c_str());\n" % t.name
+	out += "\tswitch(in){\n"
+	for a in t.attrs:
+		out += "\tcase atok_%s::%s:\n" % (t.cpp, utils.to_token(a.name))
+		out += "\t\tbuilder.set%s(%s);\n" % (utils.to_pascalcase(a.name), _gen_xml_value(a, "attr.value()"))
+		out += utils.indent(_gen_check_id(a, t, "attr.value()"), 2)
+		out += "\t\tbreak;\n"
+	out += "\tdefault: break; /* Not possible. */\n"
+	out += "\t}\n"
+	out += "}\n"
+	mask = "".join(["1" if x.optional else "0" for x in t.attrs][::-1])
+	out += "std::bitset<%d> test_astate = astate | std::bitset<%d>(0b%s);\n" % (N, N, mask)
+	out += "if(!test_astate.all()) attr_error(test_astate, atok_lookup_%s, report_error);\n" % t.cpp
+	return out
+
+def _gen_xml_child(e: UxsdElement) -> str:
+	"""Transcode the child node e into builder. Repeated children go into the
+	list initialized with their count."""
+	name = utils.to_pascalcase(e.name)
+	if isinstance(e.type, UxsdComplex):
+		if e.many:
+			child = "{tag}_list[{tag}_i++]".format(tag=e.name)
+		else:
+			child = "builder.init%s()" % name
+		return "transcode_%s_xml_to_capnp(node, %s, state);\n" % (e.type.name, child)
+	value = _gen_xml_value(e, "node.child_value()")
+	if e.many:
+		return "{tag}_list.set({tag}_i++, {value});\n".format(tag=e.name, value=value)
+	return "builder.set%s(%s);\n" % (name, value)
+
+def _gen_xml_dfa(t: UxsdComplex) -> str:
+	"""Validate and transcode the children of root, like _gen_load_dfa. If there
+	are repeated children, they're counted to size their lists on a first pass,
+	which also validates, so the second one only lexes. The DFA tables are the
+	ones of the XML header, which has the start and accepting states too."""
+	assert isinstance(t.content, UxsdDfa)
+	dfa = t.content.dfa
+	many = [e for e in t.content.children if e.many]
+
+	validate = ""
+	validate += "next = gstate_%s[dfa_state][(int)in];\n" % t.cpp
+	validate += "if(next == -1)\n"
+	validate += "\tdfa_error(gtok_lookup_%s[(int)in], gstate_%s[dfa_state], gtok_lookup_%s, %d, report_error);\n" % (t.cpp, t.cpp, t.cpp, len(dfa.alphabet))
+	validate += "dfa_state = next;\n"
+	end = "if(!gstate_accepts_%s(dfa_state)) dfa_error(\"end of input\", gstate_%s[dfa_state], gtok_lookup_%s, %d, report_error);\n"\
+			% (t.cpp, t.cpp, t.cpp, len(dfa.alphabet))
+
+	out = ""
+	if many:
+		for e in many:
+			out += "size_t {tag}_count = 0;\n".format(tag=e.name)
+		out += "{\n"
+		out += "\tint next, dfa_state = START_%s_STATE;\n" % t.cpp.upper()
+		out += "\tfor(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
+		out += "\t\tstate->offset_debug = node.offset_debug();\n"
+		out += "\t\tgtok_%s in = lex_node_%s(node.name(), report_error);\n" % (t.cpp, t.cpp)
+		out += utils.indent(validate, 2)
+		out += "\t\tswitch(in){\n"
+		for e in many:
+			out += "\t\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(e.name))
+			out += "\t\t\t{tag}_count += 1;\n".format(tag=e.name)
+			out += "\t\t\tbreak;\n"
+		out += "\t\tdefault: break;\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+		out += utils.indent(end)
+		out += "}\n"
+		for e in many:
+			out += "auto {tag}_list = builder.init{pname}({tag}_count);\n".format(
+					tag=e.name,
+					pname=utils.pluralize(utils.to_pascalcase(e.name)))
+			out += "unsigned int {tag}_i = 0;\n".format(tag=e.name)
+	else:
+		out += "int next, dfa_state = START_%s_STATE;\n" % t.cpp.upper()
+
+	out += "for(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
+	out += "\tstate->offset_debug = node.offset_debug();\n"
+	out += "\tgtok_%s in = lex_node_%s(node.name(), report_error);\n" % (t.cpp, t.cpp)
+	if not many:
+		out += utils.indent(validate)
+	out += "\tswitch(in){\n"
+	for e in t.content.children:
+		out += "\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(e.name))
+		out += utils.indent(_gen_xml_child(e), 2)
+		out += "\t\tbreak;\n"
+	out += "\tdefault: break; /* Not possible. */\n"
+	out += "\t}\n"
+	out += "}\n"
+	if not many:
+		out += end
+	return out
+
+def _gen_xml_all(t: UxsdComplex) -> str:
+	"""Validate and transcode the children of root, like _gen_load_all."""
+	assert isinstance(t.content, UxsdAll)
+	N = len(t.content.children)
+	out = ""
+	out += "std::bitset<%d> gstate = 0;\n" % N
+	out += "for(pugi::xml_node node = root.first_child(); node; node = node.next_sibling()){\n"
+	out += "\tstate->offset_debug = node.offset_debug();\n"
+	out += "\tgtok_%s in = lex_node_%s(node.name(), report_error);\n" % (t.cpp, t.cpp)
+	out += "\tif(gstate[(int)in] == 0) gstate[(int)in] = 1;\n"
+	out += "\telse noreturn_report(report_error, (\"Duplicate element \" + std::string(node.name()) + \" in <%s>.\").c_str());\n" % t.name
+	out += "\tswitch(in){\n"
+	for e in t.content.children:
+		out += "\tcase gtok_%s::%s:\n" % (t.cpp, utils.to_token(e.name))
+		out += utils.indent(_gen_xml_child(e), 2)
+		out += "\t\tbreak;\n"
+	out += "\tdefault: break; /* Not possible. */\n"
+	out += "\t}\n"
+	out += "}\n"
+	mask = "".join(["1" if x.optional else "0" for x in t.content.children][::-1])
+	out += "std::bitset<%d> test_gstate = gstate | std::bitset<%d>(0b%s);\n" % (N, N, mask)
+	out += "if(!test_gstate.all()) all_error(test_gstate, gtok_lookup_%s, report_error);\n" % t.cpp
+	return out
+
+def _gen_xml_to_capnp_decl(t: UxsdComplex, schema: UxsdSchema) -> str:
+	return "inline void transcode_{name}_xml_to_capnp(const pugi::xml_node &root, ucap::{cname}::Builder builder, {state} *state)".format(
+			name=t.name,
+			cname=to_type(t),
+			state=_gen_state_type(schema))
+
+def xml_to_capnp_fn_from_complex_type(t: UxsdComplex, schema: UxsdSchema) -> str:
+	"""Generate transcode_foo_xml_to_capnp, which validates the DOM node root
+	of type t as load_foo does, and sets its attributes and children in the
+	builder directly."""
+	out = ""
+	out += _gen_xml_to_capnp_decl(t, schema) + "{\n"
+	out += "\tconst std::function<void(const char *)> *report_error = state->report_error;\n"
+	out += "\tstate->offset_debug = root.offset_debug();\n"
+	out += "\n"
+	out += utils.indent(_gen_xml_attrs(t))
+	out += "\n"
+	if isinstance(t.content, UxsdDfa):
+		out += utils.indent(_gen_xml_dfa(t))
+	elif isinstance(t.content, UxsdAll):
+		out += utils.indent(_gen_xml_all(t))
+	elif isinstance(t.content, UxsdLeaf):
+		out += "\tbuilder.setValue(%s);\n" % _gen_set_simple(t.content.type, _gen_lex_simple(t.content.type, "root.child_value()"))
+	if not isinstance(t.content, (UxsdDfa, UxsdAll)):
+		out += "\tif(root.first_child().type() == pugi::node_element)\n"
+		out += "\t\tnoreturn_report(report_error, \"Unexpected child element in <%s>.\");\n" % t.name
+	out += "}\n"
+	return out
+
+#
+
+def _gen_capnp_value(f: Union[UxsdAttribute, UxsdElement], input: str, attribute: bool, state: str = "state->") -> str:
+	"""Write the value of a capnp field to w, as the XML writer does. state is
+	the prefix of the members of the transcode state."""
+	value = _gen_load_field(f, input, state + "report_error", state + "strings.")
+	if isinstance(f.type, UxsdEnum):
+		return "w.token(lookup_%s[(int)%s]);\n" % (f.type.name, value)
+	elif attribute:
+		return "w.attribute(%s);\n" % value
+	else:
+		return "w.value(%s);\n" % value
+
+def _gen_capnp_has(f: Union[UxsdAttribute, UxsdElement], reader: str) -> str:
+	"""Whether an optional field without a default is written. Strings are
+	written if they're set, and other values if they're nonzero, as in the XML
+	writer."""
+	name = utils.to_pascalcase(f.name)
+	if f.interned:
+		return "%s.get%s() != 0" % (reader, name)
+	elif isinstance(f.type, UxsdString):
+		return "%s.has%s()" % (reader, name)
+	else:
+		return "(bool)%s.get%s()" % (reader, name)
+
+def _gen_capnp_attr(a: UxsdAttribute, reader: str, state: str = "state->") -> str:
+	write = _gen_put(" %s=\"" % a.name)
+	write += _gen_capnp_value(a, "%s.get%s()" % (reader, utils.to_pascalcase(a.name)), True, state)
+	write += _gen_put("\"")
+	if not a.optional or a.default_value is not None:
+		return write
+	out = ""
+	out += "if(%s){\n" % _gen_capnp_has(a, reader)
+	out += utils.indent(write)
+	out += "}\n"
+	return out
+
+def _gen_capnp_element_body(e: UxsdElement, reader: str) -> str:
+	"""Write a complex element with its attributes, and its content with
+	transcode_<type>_capnp_to_xml, in the pretty profile."""
+	assert isinstance(e.type, UxsdComplex)
+	out = ""
+	if e.type.attrs:
+		out += _gen_put("<%s" % e.name)
+		out += "".join(_gen_capnp_attr(a, reader) for a in e.type.attrs)
+		if e.type.content:
+			out += _gen_put(">")
+		else:
+			out += _gen_put("/>\n")
+	elif e.type.content:
+		out += _gen_put("<%s>\n" % e.name)
+	else:
+		out += _gen_put("<%s/>\n" % e.name)
+	if e.type.content:
+		out += "transcode_%s_capnp_to_xml(%s, w, state);\n" % (e.type.name, reader)
+		out += _gen_put("</%s>\n" % e.name)
+	return out
+
+def _gen_capnp_element(e: UxsdElement) -> str:
+	name = utils.to_pascalcase(e.name)
+	out = ""
+	if isinstance(e.type, UxsdComplex):
+		if e.many:
+			out += "for(auto child : reader.get%s()){\n" % utils.pluralize(name)
+			out += utils.indent(_gen_capnp_element_body(e, "child"))
+			out += "}\n"
+		elif e.optional:
+			out += "if(reader.has%s()){\n" % name
+			out += "\tauto child = reader.get%s();\n" % name
+			out += utils.indent(_gen_capnp_element_body(e, "child"))
+			out += "}\n"
+		else:
+			out += "{\n"
+			out += "\tauto child = reader.get%s();\n" % name
+			out += utils.indent(_gen_capnp_element_body(e, "child"))
+			out += "}\n"
+		return out
+
+	def write(value: str) -> str:
+		return _gen_put("<%s>" % e.name) + _gen_capnp_value(e, value, False) + _gen_put("</%s>\n" % e.name)
+	if e.many:
+		out += "for(auto value : reader.get%s()){\n" % utils.pluralize(name)
+		out += utils.indent(write("value"))
+		out += "}\n"
+	elif e.optional:
+		out += "if(%s){\n" % _gen_capnp_has(e, "reader")
+		out += utils.indent(write("reader.get%s()" % name))
+		out += "}\n"
+	else:
+		out += write("reader.get%s()" % name)
+	return out
+
+def _gen_capnp_to_xml_decl(t: UxsdComplex, schema: UxsdSchema) -> str:
+	return "inline void transcode_{name}_capnp_to_xml(const ucap::{cname}::Reader &reader, XmlWriter &w, {state} *state)".format(
+			name=t.name,
+			cname=to_type(t),
+			state=_gen_state_type(schema))
+
+def capnp_to_xml_fn_from_complex_type(t: UxsdComplex, schema: UxsdSchema) -> str:
+	"""Generate transcode_foo_capnp_to_xml, which writes the content of a
+	reader of type t as write_foo does in the pretty profile. Like write_foo,
+	the parent writes the tag and the attributes."""
+	out = ""
+	out += _gen_capnp_to_xml_decl(t, schema) + "{\n"
+	out += "\t(void)reader;\n"
+	out += "\t(void)w;\n"
+	out += "\t(void)state;\n"
+	if isinstance(t.content, (UxsdDfa, UxsdAll)):
+		for e in t.content.children:
+			out += utils.indent(_gen_capnp_element(e))
+	elif isinstance(t.content, UxsdLeaf):
+		out += "\tw.value(%s);\n" % _gen_load_simple(t.content.type, "reader.getValue()", "state->report_error")
+	out += "}\n"
+	return _merge_puts(out)
+
+#
+
+def transcode_fns_from_root_element(schema: UxsdSchema) -> str:
+	e = schema.root_element
+	assert isinstance(e.type, UxsdComplex)
+	strings = _uses_strings(e.type)
+	fmt = {"name": e.name,
+		"type": e.type.name,
+		"cname": to_type(e),
+		"pname": utils.to_pascalcase(e.name),
+		"state": _gen_state_type(schema)}
+	# Strict checks of IDs and IDREFs are opt-in, as in XmlLoadOptions.
+	fmt["strict_arg"] = ", bool strict_ids = false" if schema.has_ids else ""
+	fmt["strict"] = ", strict_ids" if schema.has_ids else ""
+	out = ""
+	out += "/**\n"
+	out += " * Transcode an already parsed document into the message of root. filename\n"
+	out += " * and source are only used for the lines of errors, as in load_{name}_document.\n".format(**fmt)
+	out += " * Errors are thrown as std::runtime_error.\n"
+	if schema.has_ids:
+		out += " * If strict_ids is set, duplicate IDs and dangling IDREFs are errors.\n"
+	out += " */\n"
+	out += "inline void transcode_{name}_xml_to_capnp_document(const pugi::xml_document &doc, ucap::{cname}::Builder root, const char *filename, const char *source = nullptr, size_t source_size = 0{strict_arg}){{\n".format(**fmt)
+	out += "\t{state} state;\n".format(**fmt)
+	if schema.has_ids:
+		out += "\tstate.strict_ids = strict_ids;\n"
+	out += "\tstd::function<void(const char *)> report_error = [filename, source, source_size, &state](const char *message){\n"
+	out += "\t\tint line, col;\n"
+	out += "\t\tif(source != nullptr) get_line_number(source, source_size, state.offset_debug, &line, &col);\n"
+	out += "\t\telse get_line_number(filename, state.offset_debug, &line, &col);\n"
+	out += "\t\tstd::stringstream msg;\n"
+	out += "\t\tmsg << message << \" occured at file: \" << filename << \" line: \" << line;\n"
+	out += "\t\tthrow std::runtime_error(msg.str());\n"
+	out += "\t};\n"
+	out += "\tstate.report_error = &report_error;\n"
+	out += "\tbool found = false;\n"
+	out += "\tfor(pugi::xml_node node = doc.first_child(); node; node = node.next_sibling()){\n"
+	out += "\t\tif(std::strcmp(node.name(), \"{name}\") == 0 && !found){{\n".format(**fmt)
+	out += "\t\t\t/* If errno is set up to this point, it messes with strtol errno checking. */\n"
+	out += "\t\t\terrno = 0;\n"
+	out += "\t\t\ttranscode_{type}_xml_to_capnp(node, root, &state);\n".format(**fmt)
+	out += "\t\t\tfound = true;\n"
+	out += "\t\t} else {\n"
+	out += "\t\t\tstate.offset_debug = node.offset_debug();\n"
+	out += "\t\t\treport_error((\"Invalid root-level element \" + std::string(node.name())).c_str());\n"
+	out += "\t\t}\n"
+	out += "\t}\n"
+	if schema.has_ids:
+		out += "\tfor(const IdIndex::Ref &ref : state.ids.refs()){\n"
+		out += "\t\tif(state.ids.find(ref.id) == nullptr){\n"
+		out += "\t\t\tstate.offset_debug = ref.offset;\n"
+		out += "\t\t\tnoreturn_report(&report_error, (\"Dangling IDREF `\" + std::string(ref.id) + \"`.\").c_str());\n"
+		out += "\t\t}\n"
+		out += "\t}\n"
+	if strings:
+		out += "\tstate.string_table.write(root.initStrings(state.string_table.pending()));\n"
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Transcode the XML document in is, which may be compressed with gzip or zstd,\n"
+	out += " * into the message of root. The result is the message which load_{name}_xml\n".format(**fmt)
+	out += " * builds with Capnp{pname}.\n".format(**fmt)
+	out += " */\n"
+	out += "inline void transcode_{name}_xml_to_capnp(std::istream &is, ucap::{cname}::Builder root, const char *filename{strict_arg}){{\n".format(**fmt)
+	out += "\tpugi::xml_document doc;\n"
+	out += "\tXmlCompression compression = detect_xml_compression(is);\n"
+	out += "\tif(compression != XmlCompression::NONE){\n"
+	out += "\t\tXmlDecompressor decompressor(is, compression);\n"
+	out += "\t\ttry {\n"
+	out += "\t\t\tdecompressor.run();\n"
+	out += "\t\t} catch(const std::exception &ex) {\n"
+	out += "\t\t\tthrow std::runtime_error(\"Unable to decompress XML file '\" + std::string(filename) + \"', \" + ex.what());\n"
+	out += "\t\t}\n"
+	out += "\t\tpugi::xml_parse_result result = doc.load_buffer_inplace(decompressor.data(), decompressor.size());\n"
+	out += utils.indent(_gen_parse_error("decompressor.data(), decompressor.size()"), 2)
+	out += "\t\ttranscode_{name}_xml_to_capnp_document(doc, root, filename, decompressor.data(), decompressor.size(){strict});\n".format(**fmt)
+	out += "\t\treturn;\n"
+	out += "\t}\n"
+	out += "\tpugi::xml_parse_result result = doc.load(is);\n"
+	out += utils.indent(_gen_parse_error())
+	out += "\ttranscode_{name}_xml_to_capnp_document(doc, root, filename, nullptr, 0{strict});\n".format(**fmt)
+	out += "}\n"
+	out += "\n"
+	out += "/**\n"
+	out += " * Transcode the XML file xml_filename into a message file in an encoding. The\n"
+	out += " * message is built in one segment sized from the XML file.\n"
+	out += " */\n"
+	out += "inline void transcode_{name}_xml_to_capnp_file(const char *xml_filename, const char *capnp_filename, CapnpEncoding encoding = CapnpEncoding::FLAT{strict_arg}){{\n".format(**fmt)
+	out += "\tstd::ifstream is(xml_filename, std::ios::binary | std::ios::ate);\n"
+	out += "\tif(!is) throw std::runtime_error(\"Unable to open XML file '\" + std::string(xml_filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "\t::capnp::MallocMessageBuilder builder(Capnp{pname}::first_segment_words(is.tellg()));\n".format(**fmt)
+	out += "\tis.seekg(0);\n"
+	out += "\ttranscode_{name}_xml_to_capnp(is, builder.initRoot<ucap::{cname}>(), xml_filename{strict});\n".format(**fmt)
+	out += "\tint fd = open(capnp_filename, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);\n"
+	out += "\tif(fd == -1) throw std::runtime_error(\"Unable to open Cap'n Proto file '\" + std::string(capnp_filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "\ttry {\n"
+	out += "\t\twrite_capnp_message(fd, builder, encoding);\n"
+	out += "\t} catch(...) {\n"
+	out += "\t\tclose(fd);\n"
+	out += "\t\tthrow;\n"
+	out += "\t}\n"
+	out += "\tif(close(fd) == -1) throw std::runtime_error(\"Unable to write Cap'n Proto file '\" + std::string(capnp_filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "}\n"
+	out += "\n"
+
+	body = ""
+	body += _gen_put("<%s" % e.name)
+	body += "".join(_gen_capnp_attr(a, "root", "state.") for a in e.type.attrs)
+	body += _gen_put(">\n")
+	body += "transcode_{type}_capnp_to_xml(root, w, &state);\n".format(**fmt)
+	body += _gen_put("</%s>\n" % e.name)
+	out += "/**\n"
+	out += " * Write the message of root to w as XML, as write_{name}_xml does with\n".format(**fmt)
+	out += " * Capnp{pname} and the pretty profile, and flush w. filename is only used\n".format(**fmt)
+	out += " * for errors, which are thrown as std::runtime_error.\n"
+	out += " */\n"
+	out += "inline void transcode_{name}_capnp_to_xml(const ucap::{cname}::Reader &root, XmlWriter &w, const char *filename){{\n".format(**fmt)
+	out += "\t{state} state;\n".format(**fmt)
+	out += "\tstd::function<void(const char *)> report_error = [filename](const char *message){\n"
+	out += "\t\tthrow std::runtime_error(std::string(message) + \" occured at file: \" + filename);\n"
+	out += "\t};\n"
+	out += "\tstate.report_error = &report_error;\n"
+	if strings:
+		out += "\tstate.strings.add(root.getStrings());\n"
+	out += utils.indent(_merge_puts(body))
+	out += "\tw.flush();\n"
+	out += "}\n"
+	out += "\n"
+	out += "/* Transcode a message file in any CapnpEncoding into the XML file xml_filename. */\n"
+	out += "inline void transcode_{name}_capnp_to_xml_file(const char *capnp_filename, const char *xml_filename){{\n".format(**fmt)
+	out += "\tstd::unique_ptr<CapnpMappedFile> file;\n"
+	out += "\tkj::Array<::capnp::word> decoded;\n"
+	out += "\tkj::ArrayPtr<const ::capnp::word> words;\n"
+	out += "\ttry {\n"
+	out += "\t\tfile.reset(new CapnpMappedFile(capnp_filename));\n"
+	out += "\t\twords = capnp_decode_message(file->bytes(), decoded);\n"
+	out += "\t} catch(std::runtime_error &ex) {\n"
+	out += "\t\tthrow std::runtime_error(\"Unable to read Cap'n Proto file '\" + std::string(capnp_filename) + \"', \" + ex.what() + \".\");\n"
+	out += "\t}\n"
+	out += "\t::capnp::ReaderOptions opts;\n"
+	out += "\topts.traversalLimitInWords = std::numeric_limits<uint64_t>::max();\n"
+	out += "\t::capnp::FlatArrayMessageReader reader(words, opts);\n"
+	out += "\tint fd = open(xml_filename, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0666);\n"
+	out += "\tif(fd == -1) throw std::runtime_error(\"Unable to open XML file '\" + std::string(xml_filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "\ttry {\n"
+	out += "\t\tXmlWriter w(fd);\n"
+	out += "\t\ttranscode_{name}_capnp_to_xml(reader.getRoot<ucap::{cname}>(), w, capnp_filename);\n".format(**fmt)
+	out += "\t} catch(...) {\n"
+	out += "\t\tclose(fd);\n"
+	out += "\t\tthrow;\n"
+	out += "\t}\n"
+	out += "\tif(close(fd) == -1) throw std::runtime_error(\"Unable to write XML file '\" + std::string(xml_filename) + \"', \" + std::strerror(errno) + \".\");\n"
+	out += "}\n"
+	return out
+
+def _gen_parse_error(source: Optional[str] = None) -> str:
+	"""Like cpp._gen_report_parse_error, but throws the error."""
+	out = ""
+	out += "if(!result) {\n"
+	out += "\tint line, col;\n"
+	if source is not None:
+		out += "\tget_line_number(%s, result.offset, &line, &col);\n" % source
+	else:
+		out += "\tget_line_number(filename, result.offset, &line, &col);\n"
+	out += "\tstd::stringstream msg;\n"
+	out += "\tmsg << \"Unable to load XML file '\" << filename << \"', \";\n"
+	out += "\tmsg << result.description() << \" (line: \" << line;\n"
+	out += "\tmsg << \" col: \" << col << \")\";\n"
+	out += "\tthrow std::runtime_error(msg.str());\n"
+	out += "}\n"
+	return out
+
+def render_transcode_header_file(schema: UxsdSchema, cmdline: str, header_file_name: str, capnp_header_file_name: str, capnp_impl_header_file_name: str, input_file: str) -> str:
+	out = ""
+	x = {"version": __version__,
+		"cmdline": cmdline,
+		"input_file": input_file,
+		"md5": utils.md5(input_file)}
+	out += cpp_templates.header_comment.substitute(x)
+	out += "#include <bitset>\n"
+	out += "#include <cerrno>\n"
+	out += "#include <cstring>\n"
+	out += "#include <fstream>\n"
+	out += "#include <limits>\n"
+	out += "#include <memory>\n"
+	out += "#include <sstream>\n"
+	out += "#include <stdexcept>\n"
+	out += "#include <fcntl.h>\n"
+	out += "#include <unistd.h>\n"
+	out += cpp_templates.xml_decompressor_includes
+	if schema.has_ids:
+		out += cpp_templates.id_index_includes
+	out += '#include "capnp/message.h"\n'
+	out += '#include "capnp/serialize.h"\n'
+	out += '#include "{}"\n'.format(header_file_name)
+	out += '#include "{}"\n'.format(capnp_header_file_name)
+	out += '#include "{}"\n'.format(capnp_impl_header_file_name)
+	out += "\n/* All uxsdcxx functions and structs live in this namespace. */\n"
+	out += "namespace uxsd {\n"
+	out += cpp_templates.xml_decompressor_defn
+	if schema.has_ids:
+		out += cpp_templates.id_index_defn
+		out += gen_id_enums(schema)
+	out += "\n"
+	out += gen_transcode_state(schema)
+	out += "\n/* Declarations of the fused transcoders of the complex types. */\n"
+	for t in schema.complex_types:
+		out += _gen_xml_to_capnp_decl(t, schema) + ";\n"
+		out += _gen_capnp_to_xml_decl(t, schema) + ";\n"
+	out += "\n/* XML to Cap'n Proto */\n"
+	out += "\n".join(xml_to_capnp_fn_from_complex_type(t, schema) for t in schema.complex_types)
+	out += "\n/* Cap'n Proto to XML */\n"
+	out += "\n".join(capnp_to_xml_fn_from_complex_type(t, schema) for t in schema.complex_types)
+	out += "\n"
+	out += transcode_fns_from_root_element(schema)
+	out += "\n} /* namespace uxsd */\n"
+	return out
+
+def render_transcode_main_file(schema: UxsdSchema, cmdline: str, transcode_header_file_name: str, input_file: str) -> str:
+	"""Render a command line tool which transcodes files with the fused transcoders."""
+	name = schema.root_element.name
+	out = ""
+	x = {"version": __version__,
+		"cmdline": cmdline,
+		"input_file": input_file,
+		"md5": utils.md5(input_file)}
+	out += cpp_templates.impl_comment.substitute(x)
+	out += "#include <cstring>\n"
+	out += "#include <iostream>\n"
+	out += "#include <string>\n"
+	out += '#include "{}"\n'.format(transcode_header_file_name)
+	out += "\n"
+	out += "static int usage(const char *argv0){\n"
+	out += "\tstd::cerr << \"Usage: \" << argv0 << \" to-capnp [--packed|--zstd]%s <%s.xml> <%s.bin>\\n\";\n" % (" [--strict-ids]" if schema.has_ids else "", name, name)
+	out += "\tstd::cerr << \"       \" << argv0 << \" to-xml <%s.bin> <%s.xml>\\n\";\n" % (name, name)
+	out += "\tstd::cerr << \"Transcodes between XML and Cap'n Proto messages of <%s>.\\n\";\n" % name
+	out += "\tstd::cerr << \"Compressed XML and messages in any encoding are detected when reading.\\n\";\n"
+	if schema.has_ids:
+		out += "\tstd::cerr << \"--strict-ids reports duplicate IDs and dangling IDREFs as errors.\\n\";\n"
+	out += "\treturn 2;\n"
+	out += "}\n"
+	out += "\n"
+	out += "int main(int argc, char **argv){\n"
+	out += "\tif(argc < 2) return usage(argv[0]);\n"
+	out += "\tstd::string mode = argv[1];\n"
+	out += "\ttry {\n"
+	out += "\t\tif(mode == \"to-capnp\" && argc >= 4){\n"
+	out += "\t\t\tuxsd::CapnpEncoding encoding = uxsd::CapnpEncoding::FLAT;\n"
+	if schema.has_ids:
+		out += "\t\t\tbool strict_ids = false;\n"
+	out += "\t\t\tfor(int i = 2; i < argc - 2; i++){\n"
+	out += "\t\t\t\tif(std::strcmp(argv[i], \"--packed\") == 0) encoding = uxsd::CapnpEncoding::PACKED;\n"
+	out += "\t\t\t\telse if(std::strcmp(argv[i], \"--zstd\") == 0) encoding = uxsd::CapnpEncoding::ZSTD;\n"
+	if schema.has_ids:
+		out += "\t\t\t\telse if(std::strcmp(argv[i], \"--strict-ids\") == 0) strict_ids = true;\n"
+	out += "\t\t\t\telse return usage(argv[0]);\n"
+	out += "\t\t\t}\n"
+	out += "\t\t\tuxsd::transcode_%s_xml_to_capnp_file(argv[argc-2], argv[argc-1], encoding%s);\n" % (name, ", strict_ids" if schema.has_ids else "")
+	out += "\t\t} else if(mode == \"to-xml\" && argc == 4){\n"
+	out += "\t\t\tuxsd::transcode_%s_capnp_to_xml_file(argv[2], argv[3]);\n" % name
+	out += "\t\t} else {\n"
+	out += "\t\t\treturn usage(argv[0]);\n"
+	out += "\t\t}\n"
+	out += "\t} catch(const std::exception &ex) {\n"
+	out += "\t\tstd::cerr << argv[0] << \": \" << ex.what() << std::endl;\n"
+	out += "\t\treturn 1;\n"
+	out += "\t}\n"
+	out += "\treturn 0;\n"
+	out += "}\n"
+	return out
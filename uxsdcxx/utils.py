@@ -28,6 +28,22 @@ def to_token(x: str) -> str:
 def to_union_field_name(x: str) -> str:
 	return "as_%s" % re.sub(r"[^a-zA-Z0-9_]", "_", x)
 
+def to_c_string(x: str) -> str:
+	"""Quote x as a C string literal. Backslashes, quotes and question marks,
+	which could start a trigraph, are escaped, and so are control and non-ASCII
+	bytes of its UTF-8 encoding, as three-digit octal escapes which can't run
+	into the characters after them."""
+	out = ""
+	for b in x.encode("utf-8"):
+		c = chr(b)
+		if c in "\\\"?":
+			out += "\\" + c
+		elif b < 0x20 or b >= 0x7f:
+			out += "\\%03o" % b
+		else:
+			out += c
+	return "\"%s\"" % out
+
 def to_comment_body(x: str) -> str:
 	return "\n".join([" * " + line for line in x.split("\n") if line])
 